@@ -1,5 +1,7 @@
+import collections
 import re
 import threading
+import time
 import typing
 from re import Pattern
 
@@ -8,11 +10,23 @@ from aiogram import Bot, Dispatcher
 from aiogram.utils.exceptions import BadRequest
 from aiogram.utils.markdown import escape_md, quote_html
 
+from bot_broadcast import Broadcast, BroadcastProgress, BroadcastTargets_t, OnBroadcastProgress
+from bot_callback import CallbackAnswers
+from bot_executor import ExecutorPool, TResult_t, executors
 from bot_ilogic import ILogic
 from bot_imessage import BotIMessage, OnMessageApplyEvent
-from bot_keyboard import KeyboardType
+from bot_journal import ChatJournal, JournalStorage, journalCallback, journalDump, journalMessage
+from bot_keyboard import KeyboardTemplate, KeyboardType
+from bot_media import MediaLoader
+from bot_outbox import Outbox, jsonMarkup
+from bot_planner import CALL_DELETE, CALL_EDIT_CAPTION, CALL_EDIT_MARKUP, CALL_EDIT_MEDIA, CALL_EDIT_TEXT, \
+    MessageState, Payload_t, REPLY_KEYBOARDS, payloadHash, planCalls
+from bot_timers import timers
+from bot_trace import span, tracer
 from bot_types import *
 from bot_users import BotUser, BotUsers
+from bot_webhook import WebhookServer
+from bot_watchdog import LoopWatchdog
 from settings import *
 from utils import *
 
@@ -33,8 +47,9 @@ class Waiter:
     """Class which is used to filter received messages and callbacks and pass execution to
     user logic.
     """
+    __slots__ = ('chat', 'messge_id', 'isModal', '_completed', '_future', '_on_message', '_on_callback', '_wakeSpan')
     chat: 'BotChat'
-    isModal: bool = False
+    isModal: bool
 
     def __init__(self, chat: 'BotChat', messge_id: MessageId_t, /,
                  on_message: typing.Optional[OnMessageEvent] = None,
@@ -48,10 +63,13 @@ class Waiter:
         """
         self.chat = chat
         self.messge_id = messge_id
-        self._completed = asyncio.Event()
-        self._completed.clear()
+        self.isModal = False
+        # future is created only when somebody waits, most of non-modal waiters are never awaited
+        self._completed = False
+        self._future: typing.Optional[asyncio.Future] = None
         self._on_message = on_message
         self._on_callback = on_callback
+        self._wakeSpan = None
 
     async def isWaitingThisMessage(self, chat: 'BotChat', message: Message_t) -> bool:
         """Check if this waiter process specified message"""
@@ -67,25 +85,42 @@ class Waiter:
             return True
         return False
 
+    def detached(self):
+        """Called after waiter is removed from chat queue"""
+        pass
+
     def notify_complete(self):
         """Used to notify waiting user logic, what wait is complete. Called from bot loop to inform user logic"""
         LOG('notify_complete')
-        self._completed.set()
+        self._wakeSpan = tracer.current()
+        self._completed = True
+        if self._future is not None and not self._future.done():
+            self._future.set_result(True)
+
+    async def _waitCompleted(self):
+        if self._completed: return
+        self._future = asyncio.get_running_loop().create_future()
+        try:
+            await self._future
+        finally:
+            self._future = None
 
     async def wait(self, timeout: float = None) -> bool:
         """Wait until complete. Called from user logic to wait waiter condition."""
+        tracer.suspend()
         if timeout and timeout >= 0:
             try:
                 LOG(f'waiting', 'modal', self.isModal, 'tm', timeout)
-                await asyncio.wait_for(self._completed.wait(), timeout)
-                return True
+                async with timers.timeout(timeout):
+                    await self._waitCompleted()
             except asyncio.TimeoutError:
                 self.chat.waiterRemove(self)
                 return False
         else:
             LOG(f'waiting', 'modal', self.isModal)
-            await self._completed.wait()
-            return True
+            await self._waitCompleted()
+        tracer.resume(self._wakeSpan, 'logic', chat=self.chat.chat_id)
+        return True
 
 
 class ModalWaiter(Waiter):
@@ -94,6 +129,8 @@ class ModalWaiter(Waiter):
     data dispatching will stop. If modal waiter indicate data as UNknown, waiter data dispatching
     will stop but waiter leave in waiters queue.
     """
+    __slots__ = ('_remove_unused',)
+
     def __init__(self, chat: 'BotChat', messge_id: MessageId_t, /,
                  on_message: typing.Optional[OnMessageEvent] = None,
                  on_callback: typing.Optional[OnCallbackEvent] = None,
@@ -115,13 +152,14 @@ class CommandsWaiter(Waiter):
     """Waiter for commands. Can process list of commands or defined by user callback. Any number of commands waiters
     may be used at a time.
     """
+    __slots__ = ('on_command', 'commands')
     on_command: typing.Optional[OnCommandEvent]
     commands: typing.Optional[typing.List[str]]
 
     def __init__(self, chat: 'BotChat', messge_id: MessageId_t,
                  on_command: OnCommandEvent, commands: typing.Optional[typing.List[str]] = None):
         super().__init__(chat, messge_id)
-        if on_command is not None and not isinstance(self.on_command, typing.Callable):
+        if on_command is not None and not isinstance(on_command, typing.Callable):
             raise ValueError('Command callback must be Callable')
         if commands is not None and not isinstance(commands, typing.List):
             raise ValueError('Commands must be List[str]')
@@ -149,14 +187,161 @@ class CommandsWaiter(Waiter):
             return await self.on_command(chat, cmd, params)
 
 
+StreamFilter_t = typing.Callable[[typing.Union[Message_t, Callback_t]], bool]
+"""Stream filter. Returns True for messages or callbacks which must be passed to stream"""
+
+
+class StreamWaiter(Waiter):
+    """Persistent waiter which puts matched messages or callbacks to bounded queue. Stays in chat
+    queue until stream is closed, so there is no waiter per received item and input arrived while
+    logic is busy is not lost. If queue is full the oldest item is dropped.
+    """
+    __slots__ = ('queue', 'maxsize', 'dropped', 'closed', 'callbacks', '_filter')
+
+    def __init__(self, chat: 'BotChat', messge_id: MessageId_t, /,
+                 filter: typing.Optional[StreamFilter_t] = None,
+                 maxsize: int = 100,
+                 callbacks: bool = False):
+        """Create stream waiter
+
+        :param chat: parent chat
+        :param messge_id: message id to get callbacks from or NoMessageId for any
+        :param filter: items filter
+        :param maxsize: max number of not consumed items
+        :param callbacks: collect callbacks instead of messages
+        """
+        super().__init__(chat, messge_id)
+        self.queue: typing.Deque[typing.Union[Message_t, Callback_t]] = collections.deque()
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+        self.callbacks = callbacks
+        self._filter = filter
+
+    async def isWaitingThisMessage(self, chat: 'BotChat', message: Message_t) -> bool:
+        if self.callbacks or (self._filter and not self._filter(message)): return False
+        self._put(message)
+        return True
+
+    async def isWaitingThisCallback(self, chat: 'BotChat', cbd: Callback_t) -> bool:
+        if not self.callbacks or (self.messge_id and cbd.message.message_id != self.messge_id) or \
+                (self._filter and not self._filter(cbd)):
+            return False
+        self._put(cbd)
+        return True
+
+    def _put(self, item: typing.Union[Message_t, Callback_t]):
+        if len(self.queue) >= self.maxsize:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(item)
+
+    def notify_complete(self):
+        # waiter is not completed by item, just wake up consumer
+        self._wakeSpan = tracer.current()
+        if self._future is not None and not self._future.done():
+            self._future.set_result(True)
+
+    def detached(self):
+        self.closed = True
+        if self._future is not None and not self._future.done():
+            self._future.set_result(True)
+
+    async def get(self, timeout: float = None) -> typing.Union[Message_t, Callback_t, None]:
+        """Get next item
+
+        :param timeout: max time to wait for item
+        :return: item or None on timeout or if waiter is removed from chat
+        """
+        while not self.queue:
+            if self.closed: return None
+            self._future = asyncio.get_running_loop().create_future()
+            tracer.suspend()
+            try:
+                if timeout and timeout >= 0:
+                    async with timers.timeout(timeout):
+                        await self._future
+                else:
+                    await self._future
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                self._future = None
+            tracer.resume(self._wakeSpan, 'logic', chat=self.chat.chat_id)
+        return self.queue.popleft()
+
+
+class UpdateStream:
+    """Async iterator over messages or callbacks received by chat. Created by ``BotChat.messages()``
+    and ``BotMessage.callbacks()``, starts to collect items at once.
+
+    Iteration stops on timeout, when logic ends or when message is deleted (for callbacks). Stream
+    is closed on iteration end, on exit from ``async with`` or when object is released.
+
+    Usage::
+
+        async for message in chat.messages(lambda m: m.text, timeout=60):
+            ...
+    """
+    __slots__ = ('chat', 'waiter', 'timeout')
+
+    def __init__(self, chat: 'BotChat', waiter: StreamWaiter, timeout: float = None):
+        self.chat = chat
+        self.waiter = waiter
+        self.timeout = timeout
+        chat.waiterAdd(waiter)
+
+    @property
+    def dropped(self) -> int:
+        """Number of items dropped by queue overflow"""
+        return self.waiter.dropped
+
+    def close(self):
+        if self.waiter.closed: return
+        self.waiter.closed = True
+        self.chat.waiterRemove(self.waiter)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> typing.Union[Message_t, Callback_t]:
+        cb = self.waiter.callbacks
+        kind = 'cb' if cb else 'wait'
+        journal = self.chat.journal
+        rc = journal.replay(kind) if journal else None
+        if rc is not None:
+            item = (journalCallback if cb else journalMessage)(rc[1]) if rc[0] else None
+            if item is not None and not cb: self.chat.lastReceivedMessage = item
+        else:
+            item = await self.waiter.get(self.timeout)
+            if journal: journal.record(kind, item is not None, journalDump(item) if item is not None else None)
+
+        if item is None:
+            self.close()
+            raise StopAsyncIteration
+        return item
+
+    async def __aenter__(self) -> 'UpdateStream':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
 # ------------------------------------------------------------------------
 # ChatMessage
 # ------------------------------------------------------------------------
 
 class BotMessage(BotIMessage):
     """BotIMessage implementation for manipulate with channel"""
+    __slots__ = ('chat', 'waiter', '_delivered')
     chat: 'BotChat'
     waiter: typing.Optional[Waiter]
+    _delivered: typing.Optional[Payload_t]
+    """``payloadHash()`` of the last content actually sent to API"""
 
     def __init__(
             self, chat: 'BotChat',
@@ -175,6 +360,7 @@ class BotMessage(BotIMessage):
         super().__init__(**filterArgs(locals(), ['chat']))
         self.chat = chat
         self.waiter = None
+        self._delivered = None
 
     def _delWaiter(self):
         if self.waiter:
@@ -182,120 +368,226 @@ class BotMessage(BotIMessage):
             self.chat.waiterRemove(self.waiter)
             self.waiter = None
 
-    @staticmethod
-    def _loadMedia(media):
-        if isinstance(media, str) and \
-                not media.startswith('http:') and \
-                not media.startswith('https:'):
-            f = open(media, 'rb')
-            if f: return f
-        return media
+    def _loadMedia(self) -> typing.AsyncContextManager[BotMedia_t]:
+        return self.chat.session.media.input(self.media, self.chat.run_blocking)
 
     async def _deleteMessage(self) -> bool:
         return await self.chat.delete(self)
 
     async def _createMessage(self) -> MessageId_t:
+        self.keyboard.keyboard_id = self.chat.nextKeyboardId()
+        journal = self.chat.journal
+        if journal:
+            rc = journal.replay('msg')
+            if rc is not None:
+                # keyboard must have the same id as in already shown message to catch its buttons
+                self.keyboard.keyboard_id = rc[1]
+                self._delivered = payloadHash(self.chat.escape_soft(self.text), self.media, self.keyboard.markup)
+                return rc[0]
+
         reply_to_message_id = self.reply_to_message_id
         if not reply_to_message_id: reply_to_message_id = None
+        text = self.chat.escape_soft(self.text)
+        markup = self.keyboard.markup
 
+        key = self.chat.nextOpKey()
         if self.media:
-            msg = await self.chat.bot.send_photo(
-                self.chat.chat_id, parse_mode=self.chat.bot.parse_mode,
-                photo=self._loadMedia(self.media), caption=self.chat.escape_soft(self.text),
-                reply_markup=self.keyboard.markup,
-                reply_to_message_id=reply_to_message_id)
+            async def _send():
+                async with self._loadMedia() as photo:
+                    with span('api.send_photo'):
+                        return await self.chat.bot.send_photo(
+                            self.chat.chat_id, parse_mode=self.chat.bot.parse_mode,
+                            photo=photo, caption=text,
+                            reply_markup=markup,
+                            reply_to_message_id=reply_to_message_id)
+
+            # only media which can be loaded again on replay goes through outbox
+            if isinstance(self.media, str):
+                msg = await self.chat.outboxCall(
+                    key, 'send_photo', _send,
+                    parse_mode=self.chat.bot.parse_mode, photo=self.media, caption=text,
+                    reply_markup=jsonMarkup(markup), reply_to_message_id=reply_to_message_id)
+            else:
+                msg = await _send()
         else:
-            msg = await self.chat.bot.send_message(
-                self.chat.chat_id,
-                text=self.chat.escape_soft(self.text), reply_markup=self.keyboard.markup,
-                reply_to_message_id=reply_to_message_id)
+            async def _send():
+                with span('api.send_message'):
+                    return await self.chat.bot.send_message(
+                        self.chat.chat_id,
+                        text=text, reply_markup=markup,
+                        reply_to_message_id=reply_to_message_id)
+
+            msg = await self.chat.outboxCall(
+                key, 'send_message', _send,
+                text=text, reply_markup=jsonMarkup(markup), reply_to_message_id=reply_to_message_id)
 
         LOG('new msg', msg.message_id, 'text', self.text)
+        self._delivered = payloadHash(text, self.media, markup)
+        self.chat.seenMessage(msg.message_id)
+        if journal: journal.record('msg', msg.message_id, self.keyboard.keyboard_id)
         return msg.message_id
 
     async def _updateMessage(self) -> None:
-        if self.media:
-            if self._media.changed:
-                await self.chat.bot.edit_message_media(
-                    media=types.InputMedia(
-                        type='photo',
-                        media=self._loadMedia(self.media),
-                        caption=self.chat.escape_soft(self.text)
-                    ),
-                    chat_id=self.chat.chat_id, message_id=self.message_id,
-                    reply_markup=self.keyboard.markup)
-            elif self._text.changed:
-                await self.chat.bot.edit_message_caption(
-                    chat_id=self.chat.chat_id, message_id=self.message_id,
-                    caption=self.chat.escape_soft(self.text), reply_markup=self.keyboard.markup
-                )
-        else:
-            if self._text.changed:
-                await self.chat.bot.edit_message_text(
-                    text=self.chat.escape_soft(self.text),
-                    chat_id=self.chat.chat_id, message_id=self.message_id,
-                    reply_markup=self.keyboard.markup
-                )
-            elif self.keyboard.changed:
+        if self.chat.replaying or self.chat.deletePending(self.message_id): return
+        # do not waste request for message known to be deleted
+        if self.chat.isDeadMessage(self.message_id):
+            raise aiogram.utils.exceptions.MessageToEditNotFound('Message to edit not found')
+        try:
+            await self._editMessage()
+        except aiogram.utils.exceptions.MessageToEditNotFound:
+            self.chat.deadMessage(self.message_id)
+            raise
+
+    def _states(self) -> typing.Tuple[MessageState, MessageState]:
+        """Get states of shown message and of message to show"""
+        kbd = self.keyboard
+        # noinspection PyProtectedMember
+        return (
+            MessageState(self._text.old, self._media.old,
+                         kbd._keyboard_type.old, kbd._buttons.old, kbd._placeholder.old),
+            MessageState(self._text.value, self._media.value,
+                         kbd._keyboard_type.value, kbd._buttons.value, kbd._placeholder.value)
+        )
+
+    def _replaceable(self) -> bool:
+        return CALL_DELETE not in planCalls(*self._states())
+
+    async def _editMessage(self) -> None:
+        text = self.chat.escape_soft(self.text)
+        markup = self.keyboard.markup
+        payload = payloadHash(text, self.media, markup)
+        if payload == self._delivered:
+            # content was changed back or re-assigned with the same value
+            self.chat.session.edits_skipped += 1
+            return
+
+        # reply keyboards can not be passed to edit requests, they are left unchanged by planner
+        if self.keyboard.keyboard_type in REPLY_KEYBOARDS: markup = None
+
+        for call in planCalls(*self._states()):
+            if call == CALL_EDIT_MEDIA:
+                async with self._loadMedia() as photo:
+                    with span('api.edit_message_media', message=self.message_id):
+                        await self.chat.bot.edit_message_media(
+                            media=types.InputMedia(
+                                type='photo',
+                                media=photo,
+                                caption=text
+                            ),
+                            chat_id=self.chat.chat_id, message_id=self.message_id,
+                            reply_markup=markup)
+            elif call == CALL_EDIT_CAPTION:
+                with span('api.edit_message_caption', message=self.message_id):
+                    await self.chat.outboxCall(
+                        self.chat.nextOpKey(), call,
+                        lambda: self.chat.bot.edit_message_caption(
+                            chat_id=self.chat.chat_id, message_id=self.message_id,
+                            caption=text, reply_markup=markup
+                        ),
+                        message_id=self.message_id, caption=text, reply_markup=jsonMarkup(markup))
+            elif call == CALL_EDIT_TEXT:
+                with span('api.edit_message_text', message=self.message_id):
+                    await self.chat.outboxCall(
+                        self.chat.nextOpKey(), call,
+                        lambda: self.chat.bot.edit_message_text(
+                            text=text,
+                            chat_id=self.chat.chat_id, message_id=self.message_id,
+                            reply_markup=markup
+                        ),
+                        message_id=self.message_id, text=text, reply_markup=jsonMarkup(markup))
+            elif call == CALL_EDIT_MARKUP:
                 try:
-                    await self.chat.bot.edit_message_reply_markup(
-                        chat_id=self.chat.chat_id, message_id=self.message_id,
-                        reply_markup=self.keyboard.markup
-                    )
+                    with span('api.edit_message_reply_markup', message=self.message_id):
+                        await self.chat.outboxCall(
+                            self.chat.nextOpKey(), call,
+                            lambda: self.chat.bot.edit_message_reply_markup(
+                                chat_id=self.chat.chat_id, message_id=self.message_id,
+                                reply_markup=markup
+                            ),
+                            message_id=self.message_id, reply_markup=jsonMarkup(markup))
                 # just mask unchanged error instead complex keyboard comparison
                 except aiogram.utils.exceptions.MessageNotModified:
                     pass
+            else:
+                raise ValueError(f'Unexpected update call "{call}"')
+        self._delivered = payload
 
     async def _OnDeleteMessage(self) -> None:
         self._delWaiter()
+        # stop callbacks streams of this message
+        self.chat.waiterMessageRemove(self.message_id)
+        self._delivered = None
 
-    async def _OnShowMessage(self, isCreate: bool) -> None:
-        async def _OnCallback(chat: 'BotChat', cbd: Callback_t) -> bool:
-            self._result = self.keyboard.known(callback=cbd)
-            if self._result.known:
-                LOG('SM: known', self._result.data, self._result.index)
-                _rc = True
-                if self.on_callback:
-                    old = cbd.data
-                    cbd.data = self._result.data
-                    _rc = await self.on_callback(chat, cbd)
-                    cbd.data = old
-                if _rc:
-                    return True
-            else:
-                if self.on_callback: await self.on_callback(chat, cbd)
+    def callbacks(self, filter: typing.Optional[StreamFilter_t] = None, timeout: float = None,
+                  maxsize: int = 100) -> UpdateStream:
+        """Stream of callbacks from INLINE buttons of this message. Message must be shown.
 
-            await self._display()
-            return False
+        Usage::
 
-        async def _OnMessage(chat: 'BotChat', message: Message_t) -> bool:
-            self._result = self.keyboard.known(message=message)
-            if self._result.known:
-                LOG('SM: ok: ', self._result)
-                if not self.on_message or await self.on_message(chat, message):
-                    return True
-            else:
-                LOG('SM: unk: ', message.text)
-                if self.on_message: await self.on_message(chat, message)
+            async for cb in msg.callbacks():
+                rc = msg.keyboard.known(callback=cb)
 
-            if self.remove_unused:
-                await chat.delete(message)
+        :param filter: callbacks filter. By default only buttons of current keyboard are passed
+        :param timeout: max time to wait for every callback
+        :param maxsize: max number of not processed callbacks
+        """
+        if filter is None:
+            def filter(cbd: Callback_t) -> bool:
+                return self.keyboard.known(callback=cbd).known
+        return UpdateStream(self.chat, StreamWaiter(self.chat, self.message_id, filter, maxsize, True), timeout)
+
+    async def _OnDelay(self, delay: float) -> None:
+        if not self.chat.replaying:
+            await super()._OnDelay(delay)
+
+    # waiter handlers of non-modal message. Methods instead of closures to not hold extra objects per message
+    async def _showCallback(self, chat: 'BotChat', cbd: Callback_t) -> bool:
+        self._result = self.keyboard.known(callback=cbd)
+        if self._result.known:
+            LOG('SM: known', self._result.data, self._result.index)
+            _rc = True
+            if self.on_callback:
+                old = cbd.data
+                cbd.data = self._result.data
+                _rc = await self.on_callback(chat, cbd)
+                cbd.data = old
+            if _rc:
+                return True
+        else:
+            if self.on_callback: await self.on_callback(chat, cbd)
 
-            await self._display()
-            return False
+        await self._display()
+        return False
+
+    async def _showMessage(self, chat: 'BotChat', message: Message_t) -> bool:
+        self._result = self.keyboard.known(message=message)
+        if self._result.known:
+            LOG('SM: ok: ', self._result)
+            if not self.on_message or await self.on_message(chat, message):
+                return True
+        else:
+            LOG('SM: unk: ', message.text)
+            if self.on_message: await self.on_message(chat, message)
 
+        if self.remove_unused:
+            await chat.delete(message)
+
+        await self._display()
+        return False
+
+    async def _OnShowMessage(self, isCreate: bool) -> None:
         if isCreate:
             self._result = RESULT_NONE
             self._delWaiter()
 
         if self.keyboard.keyboard_type == KeyboardType.KEYBOARD:
             if not self.waiter:
-                self.waiter = Waiter(self.chat, self.message_id, on_message=_OnMessage)
+                self.waiter = Waiter(self.chat, self.message_id, on_message=self._showMessage)
                 LOG('SM: add KBD waiter', self.waiter)
                 self.chat.waiterAdd(self.waiter)
         elif self.keyboard.keyboard_type == KeyboardType.INLINE:
             if not self.waiter:
-                self.waiter = Waiter(self.chat, self.message_id, on_callback=_OnCallback)
+                self.waiter = Waiter(self.chat, self.message_id, on_callback=self._showCallback)
                 LOG('SM: add INL waiter', self.waiter)
                 self.chat.waiterAdd(self.waiter)
 
@@ -342,14 +634,22 @@ class BotMessage(BotIMessage):
 
             if self.keyboard.keyboard_type == KeyboardType.KEYBOARD or \
                     self.keyboard.keyboard_type == KeyboardType.INLINE:
+                journal = self.chat.journal
+                rc = journal.replay('popup') if journal else None
+                if rc is not None:
+                    self.chat.lastReceivedMessage = journalMessage(rc[3])
+                    return BotKeyboardResult(rc[0], rc[1], rc[2]) if rc[0] else RESULT_NONE
+
                 LOG('PM: add waiter')
-                if await self.chat.waiterAdd(
+                if not await self.chat.waiterAdd(
                         ModalWaiter(self.chat, self.message_id, on_callback=_OnCallback, on_message=_OnMessage)
                 ).wait(self.timeout):
-                    LOG('PM: lrc: ', localResult)
-                    return localResult
-                else:
-                    return RESULT_NONE
+                    localResult = RESULT_NONE
+                LOG('PM: lrc: ', localResult)
+                if journal:
+                    journal.record('popup', localResult.known, localResult.data, localResult.index,
+                                   journalDump(self.chat.lastReceivedMessage))
+                return localResult
             else:
                 raise ValueError('Unsupported keyboard type for popup')
 
@@ -365,6 +665,13 @@ _LEAVE_CHANNEL_ON_EXIT = 'leaveChannelAfterExit'
 _RESTART_DELAY = 'restartDelay'
 _MASK_EXCEPTIONS = 'maskExceptions'
 _BOT_DOWN_MESSAGE = 'botDownMessage'
+_EXECUTOR_QUOTA = 'executorQuota'
+_BACKGROUND_DELETE = 'backgroundDelete'
+_DELETE_INTERVAL = 'deleteInterval'
+_CHAT_STATE = 'state'
+_DELETE_BATCH = 100
+_DEAD_MESSAGES = 256
+_CLOSED_POPUPS = 16
 
 _CHAT_SETTINGS = {
     _RESTART_LOGIC_ON_EXCEPT: False,
@@ -375,6 +682,9 @@ _CHAT_SETTINGS = {
     _RESTART_DELAY: 5,
     _MASK_EXCEPTIONS: False,
     _BOT_DOWN_MESSAGE: 'The Bot is down. To force start it use /start command',
+    _EXECUTOR_QUOTA: 2,
+    _BACKGROUND_DELETE: True,
+    _DELETE_INTERVAL: 0.1,
 }
 
 
@@ -391,21 +701,88 @@ class BotChat(ISettings):
     # ==== props
     chat_id: ChatId_t
     alive: bool = True
+    lastActive: float = 0.0
+    _processing: int = 0
 
     def __init__(self, session: 'BotSession', chat_id: ChatId_t):
-        ISettings.__init__(self, session.sub_cfg(f'chats.{chat_id}'))
+        # settings view and logic object are created on first use, see ``_cfg`` and ``logic``
         self.chat_id = chat_id
         self.session = session
         self.bot = session.bot
-        self.gopt('', _CHAT_SETTINGS)
+        self.lastActive = time.monotonic()
         self._initMsg()
         self._initLogic()
         self._initWaiters()
+        self._initJobs()
+        self._initDeletes()
+        self.rehydrated = self._restoreState()
+
+    _cfgView: typing.Optional[ISettings] = None
+
+    @property
+    def _cfg(self) -> ISettings:
+        """Chat settings view. Created and synchronized with chat defaults on first access"""
+        if self._cfgView is None:
+            self._cfgView = self.session.sub_cfg(f'chats.{self.chat_id}')
+            self._cfgView.gopt('', _CHAT_SETTINGS)
+        return self._cfgView
 
     async def chat_done(self):
         await self._closeLogic()
+        self._closeJobs()
+        # queued messages must be deleted even if chat is closed
+        await self.deleteFlush()
+        self._closeDeletes()
+        self._closeWaiters()
+        self._closeMsg()
+
+    # -----------------------
+    # eviction
+    # -----------------------
+    @property
+    def evictable(self) -> bool:
+        """Check if chat can be removed from memory and recreated later from settings without loosing anything.
+        Running logic coroutine can not be stored, so only chats with finished (or never started) logic
+        and without pending jobs or deletes (queued or in flight) can be evicted.
+        """
+        return not self.logicWorking and not self.jobs and not self._processing and \
+            not self._deleteQueue and self._deleteTask is None
+
+    def _storeState(self):
+        if self._cfgView is None and not self.rehydrated and \
+                not self.logicRestartCount and not self.logicStopped and not self.logicErrorStopped:
+            return
+        self.sopt(_CHAT_STATE, {
+            'restartCount': self.logicRestartCount,
+            'stopped': self.logicStopped,
+            'errorStopped': self.logicErrorStopped,
+        })
+
+    def _restoreState(self) -> bool:
+        # look into session settings directly to not create settings view for new chats
+        chats = self.session.gopt('chats', None)
+        st = chats.get(str(self.chat_id), {}).get(_CHAT_STATE) if isinstance(chats, typing.Dict) else None
+        if not st: return False
+        self.logicRestartCount = st.get('restartCount', 0)
+        self.logicStopped = st.get('stopped', False)
+        self.logicErrorStopped = st.get('errorStopped', False)
+        return True
+
+    def evict(self):
+        """Store chat state to settings and free all resources. Chat object is not usable after this call.
+        Called by ``BotChats`` for evictable chats only.
+        """
+        self._storeState()
+        self._closeJobs()
+        self._closeDeletes()
         self._closeWaiters()
         self._closeMsg()
+        self._logicCreated = True
+        self._logic = None
+        self.lastReceivedMessage = None
+        self.lastReceivedCallback = None
+        self.lastMessage = None
+        self.alive = False
 
     # -----------------------
     # utils
@@ -434,18 +811,25 @@ class BotChat(ISettings):
 
     def _closeWaiters(self):
         self._waitersDeleteAll()
+        self._closedPopups = None
+
+    def _waitersSet(self, waiters: typing.List[Waiter]):
+        """Replace waiters queue and notify removed waiters"""
+        with self.waitersLock:
+            old, self.waiters = self.waiters, waiters
+        for w in old:
+            if w not in waiters: w.detached()
 
     def _waitersDeleteAll(self):
         LOG('waitersDeleteAll')
-        with self.waitersLock:
-            self.waiters = []
+        self._waitersSet([])
 
     def waiterRemove(self, waiter: Waiter):
         """Remove waiter from queue"""
         if not waiter: return
         LOG(f'CH: del waiter', len(self.waiters), 'm:', waiter.isModal, 'w:', waiter)
         with self.waitersLock:
-            self.waiters = [i for i in self.waiters if i is not waiter]
+            self._waitersSet([i for i in self.waiters if i is not waiter])
         LOG(f'CH: waiter deleted', len(self.waiters))
 
     def waiterMessageRemove(self, message_id: MessageId_t):
@@ -453,7 +837,7 @@ class BotChat(ISettings):
         if not message_id: return
         LOG(f'CH: del waiter', len(self.waiters), 'msg', message_id)
         with self.waitersLock:
-            self.waiters = [i for i in self.waiters if i.messge_id != message_id]
+            self._waitersSet([i for i in self.waiters if i.messge_id != message_id])
         LOG(f'CH: waiter deleted', len(self.waiters))
 
     def waiterAdd(self, waiter: Waiter) -> Waiter:
@@ -462,6 +846,8 @@ class BotChat(ISettings):
         with self.waitersLock:
             if waiter not in self.waiters:
                 self.waiters.append(waiter)
+        # message is used by logic again
+        if self._closedPopups: self._closedPopups.pop(waiter.messge_id, None)
         LOG(f'CH: waiter added[{len(self.waiters)}]')
         return waiter
 
@@ -469,7 +855,12 @@ class BotChat(ISettings):
         """Process received data or message thru waiters queue"""
         if not message and not data: return False
 
-        with PROC('logic', self.logicWorking):
+        with PROC('logic', self.logicWorking), span('waitProcess', waiters=len(self.waiters)):
+            # logic without coroutine process all updates itself
+            if self.logic.stackless:
+                await self.logic.OnUpdate(self, message, data)
+                return
+
             # start/restart bot logic
             if message and message.text[0] == '/':
                 LOG('WP: cmd: ', message.text)
@@ -497,12 +888,15 @@ class BotChat(ISettings):
             # bot logic is down
             if not self.logicWorking:
                 if not await self.logic.OnDownDecide(self, self.last):
-                    await self.last.reply(
+                    # snapshot has no ``reply()``, answer to the last message directly
+                    await self.bot.send_message(
+                        self.chat_id,
                         f"""
                         {self.opt(_BOT_DOWN_MESSAGE)}\n
                         Restarted {self.logicRestartCount} times\n
                         Last run with error: {self.logicErrorStopped}
-                        """)
+                        """,
+                        reply_to_message_id=self.last_id or None)
                     LOG('!decide')
                     return
                 self.logicStart()
@@ -519,14 +913,17 @@ class BotChat(ISettings):
                         idx -= 1
                         try:
                             w = self.waiters[idx]
-                            if message:
-                                rc = await w.isWaitingThisMessage(self, message)
-                            elif data:
-                                rc = await w.isWaitingThisCallback(self, data)
+                            with span('waiter', modal=w.isModal, message=w.messge_id):
+                                if message:
+                                    rc = await w.isWaitingThisMessage(self, message)
+                                elif data:
+                                    rc = await w.isWaitingThisCallback(self, data)
 
                             LOG(f'WP', idx, 'modal', w.isModal, 'rc', rc)
                             if rc:
-                                if w.isModal: self.waiters = self.waiters[:idx]
+                                if w.isModal:
+                                    self._waitersSet(self.waiters[:idx])
+                                    self._popupClosed(w.messge_id)
                                 w.notify_complete()
                             if rc or w.isModal:
                                 LOG('WP', 'ret', len(self.waiters))
@@ -536,6 +933,41 @@ class BotChat(ISettings):
                             raise
                 LOG('WP', 'pass', len(self.waiters))
 
+    # -----------------------
+    # callbacks debounce
+    # -----------------------
+    _lastCallback: typing.Optional[typing.Tuple[MessageId_t, str, float]] = None
+    _closedPopups: typing.Optional[typing.OrderedDict[MessageId_t, None]] = None
+
+    def _popupClosed(self, message_id: MessageId_t):
+        """Remember message which modal popup is completed. Callbacks from it are not processed anymore"""
+        if not message_id: return
+        if self._closedPopups is None: self._closedPopups = collections.OrderedDict()
+        self._closedPopups[message_id] = None
+        while len(self._closedPopups) > _CLOSED_POPUPS:
+            self._closedPopups.popitem(last=False)
+
+    def callbackSuppressed(self, data: Callback_t) -> bool:
+        """Check if callback must be dropped before dispatching: repeated click on the same button
+        in 'callbackDebounce' seconds (if set) or click in message which modal popup is already completed.
+        """
+        mid = data.message.message_id
+        if self._closedPopups and mid in self._closedPopups and \
+                not any(w.messge_id == mid for w in self.waiters):
+            self.session.callbacks_stale += 1
+            return True
+
+        # fast repeated clicks can be real input, so debounce is disabled by default
+        window = self.session.opt(_CALLBACK_DEBOUNCE)
+        if window <= 0: return False
+        now = time.monotonic()
+        last = self._lastCallback
+        if last is not None and last[0] == mid and last[1] == data.data and now - last[2] < window:
+            self.session.callbacks_debounced += 1
+            return True
+        self._lastCallback = (mid, data.data, now)
+        return False
+
     # -----------------------
     # bot logic
     # -----------------------
@@ -543,15 +975,25 @@ class BotChat(ISettings):
     logicRestartCount = 0
     logicStopped = False
     logicErrorStopped = False
-    logic: type(ILogic) = None
+    _logic: typing.Optional[ILogic] = None
+    _logicCreated: bool = False
 
     def _initLogic(self):
-        self.logic = self.session.logic(self, self.sub_cfg('bot logic'))
+        pass
+
+    @property
+    def logic(self) -> typing.Optional[ILogic]:
+        """User logic object. Created on first access"""
+        if not self._logicCreated:
+            self._logicCreated = True
+            self._logic = self.session.logic(self, self.sub_cfg('bot logic'))
+        return self._logic
 
     async def _closeLogic(self):
         if self.logicWorking:
             await self.logicCancel('chat is stopped')
-        self.logic = None
+        self._logicCreated = True
+        self._logic = None
 
     @property
     def logicWorking(self) -> bool:
@@ -562,19 +1004,20 @@ class BotChat(ISettings):
         """Stop user logic. Will wait until logic actually stops"""
         if not self.logicWorking: return
         self.logicTask.cancel(msg)
+        self._cancelJobs()
 
-        tasks = [self.logicTask, asyncio.create_task(asyncio.sleep(5))]
-        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        await timers.wait_done(self.logicTask, 5)
         if self.logicTask and not self.logicTask.cancelled():
             self.log.error('Logic cancellation took too long!')
 
         self.logicTask = None
 
-    def logicStart(self, force: bool = False, params: str = None) -> bool:
+    def logicStart(self, force: bool = False, params: str = None, resume: bool = False) -> bool:
         """
         Check if bot_logic coro can be started and start it.
         :param force: force to start
         :param params: parameters passed as "/start@params" or "/restart@params"
+        :param resume: logic is started to replay journal, see ``logicResume()``
         :return: True if bot logic was succ started or already working
         """
 
@@ -582,12 +1025,17 @@ class BotChat(ISettings):
 
         async def _wrapper():
             self.log.error(f'Start bot logic task')
+            tracer.resume(tracer.current(), 'logic', chat=self.chat_id)
             try:
                 if self.logicRestartCount > 0 and self.opt(_RESTART_DELAY) >= 0:
-                    await asyncio.sleep(self.opt(_RESTART_DELAY))
+                    await timers.sleep(self.opt(_RESTART_DELAY))
+
+                if self.journal and not resume:
+                    self.journal.start(params if params else '', journalDump(self.lastReceivedMessage))
 
                 await self.logic.main(self, params if params else '')
                 self.logicTask = None
+                if self._journal: self._journal.finish()
 
                 if self.opt(_LEAVE_CHANNEL_ON_EXIT):
                     await self.leave_channel()
@@ -604,11 +1052,13 @@ class BotChat(ISettings):
                 self.log.fatal('Logic was terminated by error!')
                 self.log.exception('Logic error', exc_info=e)
                 self.logicErrorStopped = True
+                if self._journal: self._journal.finish()
             finally:
                 self._waitersDeleteAll()
                 self.logicRestartCount += 1
                 self.logicStopped = True
                 self.logicTask = None
+                tracer.suspend()
                 self.log.error(f'Stopped bot logic task')
 
         def _stopped(task):
@@ -640,14 +1090,185 @@ class BotChat(ISettings):
 
         self.logicStopped = False
         self.logicErrorStopped = False
-        self.logicTask = asyncio.get_event_loop().create_task(_wrapper())
+        self.logicTask = asyncio.get_event_loop().create_task(_wrapper(), name=f'logic:{self.chat_id}')
         self.logicTask.add_done_callback(_stopped)
         return True
 
+    def logicResume(self) -> bool:
+        """Start logic again after process restart if chat has replay journal.
+        Logic is executed without API calls until it reaches journal end and continues live after that.
+
+        :return: True if logic was started
+        """
+        journal = self.journal
+        if journal is None or self.logicWorking or self.logic.stackless: return False
+
+        journal.load()
+        rc = journal.replay('start')
+        if rc is None:
+            journal.finish()
+            return False
+
+        self.log.error(f'Resume bot logic from journal with {len(journal.entries)} entries')
+        self.lastReceivedMessage = journalMessage(rc[1])
+        return self.logicStart(True, rc[0], resume=True)
+
+    # -----------------------
+    # replay journal
+    # -----------------------
+    _journal: typing.Optional[ChatJournal] = None
+
+    @property
+    def journal(self) -> typing.Optional[ChatJournal]:
+        """Replay journal of chat or None if session has no journal storage"""
+        if self._journal is None and self.session.journal is not None:
+            self._journal = ChatJournal(self.session.journal, self.chat_id)
+        return self._journal
+
+    @property
+    def replaying(self) -> bool:
+        """True while logic replays journal. No API calls are made in this mode"""
+        return self._journal is not None and self._journal.replaying
+
+
+    # -----------------------
+    # executor jobs
+    # -----------------------
+    jobs: typing.Set[asyncio.Task]
+    _jobsQuota: typing.Optional[asyncio.Semaphore] = None
+
+    def _initJobs(self):
+        self.jobs = set()
+
+    def _closeJobs(self):
+        self._cancelJobs()
+
+    def _cancelJobs(self):
+        for j in list(self.jobs):
+            j.cancel()
+
+    async def _runJob(self, fn: typing.Callable[..., TResult_t], args, kwargs, cpu: bool) -> TResult_t:
+        self._ensureSelf()
+        if self._jobsQuota is None:
+            self._jobsQuota = asyncio.Semaphore(max(1, self.opt(_EXECUTOR_QUOTA)))
+
+        job = asyncio.ensure_future(self.session.executor.run(fn, args, kwargs, cpu=cpu, quota=self._jobsQuota))
+        self.jobs.add(job)
+        job.add_done_callback(self.jobs.discard)
+        return await job
+
+    async def run_blocking(self, fn: typing.Callable[..., TResult_t], /, *args, **kwargs) -> TResult_t:
+        """Run blocking function (file or network IO, sync libraries) in shared thread pool and wait for result.
+        Number of simultaneous jobs for chat is limited by 'executorQuota' option.
+        Pending jobs are cancelled by ``logicCancel()``.
+        """
+        return await self._runJob(fn, args, kwargs, False)
+
+    async def run_cpu(self, fn: typing.Callable[..., TResult_t], /, *args, **kwargs) -> TResult_t:
+        """Run CPU-bound function in shared process pool and wait for result.
+        Function and all arguments must be picklable.
+        Number of simultaneous jobs for chat is limited by 'executorQuota' option.
+        Pending jobs are cancelled by ``logicCancel()``.
+        """
+        return await self._runJob(fn, args, kwargs, True)
+
+    # -----------------------
+    # background deletion
+    # -----------------------
+    _deleteQueue: typing.Dict[MessageId_t, None]
+    _deleteTask: typing.Optional[asyncio.Task] = None
+    _deadMessages: typing.Dict[MessageId_t, None]
+
+    def _initDeletes(self):
+        self._deleteQueue = {}
+        self._deadMessages = {}
+
+    def isDeadMessage(self, message_id: MessageId_t) -> bool:
+        """Check if message is known to be deleted or not existent"""
+        return message_id in self._deadMessages
+
+    def deadMessage(self, message_id: MessageId_t):
+        """Remember message as deleted. Only last 256 ids are kept"""
+        if message_id in self._deadMessages: return
+        self._deadMessages[message_id] = None
+        if len(self._deadMessages) > _DEAD_MESSAGES:
+            del self._deadMessages[next(iter(self._deadMessages))]
+
+    def _closeDeletes(self):
+        if self._deleteQueue or self._deleteTask:
+            self.log.error(f'Chat {self.chat_id} is closed with {len(self._deleteQueue)} queued deletes, '
+                           f'batch in flight: {self._deleteTask is not None}')
+        self._deleteQueue = {}
+        if self._deleteTask:
+            self._deleteTask.cancel()
+            self._deleteTask = None
+
+    def deletePending(self, message_id: MessageId_t) -> bool:
+        """Check if message is queued to deletion"""
+        return message_id in self._deleteQueue
+
+    def _deleteEnqueue(self, message_id: MessageId_t) -> bool:
+        self._deleteQueue[message_id] = None
+        if self._deleteTask is None:
+            self._deleteTask = asyncio.get_event_loop().create_task(
+                self._deleteWorker(), name=f'delete:{self.chat_id}')
+        return True
+
+    async def _deleteWorker(self):
+        try:
+            while self._deleteQueue:
+                ids = []
+                for message_id in self._deleteQueue:
+                    ids.append(message_id)
+                    if len(ids) >= _DELETE_BATCH: break
+                for message_id in ids:
+                    del self._deleteQueue[message_id]
+                await self._deleteBatch(ids)
+        finally:
+            self._deleteTask = None
+
+    async def _deleteBatch(self, ids: typing.List[MessageId_t]):
+        # look into class to not be fooled by dynamic attributes
+        if len(ids) > 1 and getattr(type(self.bot), 'delete_messages', None):
+            try:
+                with span('api.delete_messages', count=len(ids)):
+                    await self.outboxCall(
+                        self.nextOpKey(), 'delete_messages',
+                        lambda: self.bot.delete_messages(chat_id=self.chat_id, message_ids=ids),
+                        message_ids=ids)
+                # not existent messages are skipped by bulk delete, so all of them are gone
+                for message_id in ids: self.deadMessage(message_id)
+                return
+            except BadRequest as e:
+                self.log.error(f'!delete_messages: {e}')
+                return
+            except Exception as e:
+                self.log.error(f'!delete_messages: {e}, try one by one')
+
+        interval = self.opt(_DELETE_INTERVAL)
+        for n, message_id in enumerate(ids):
+            if n and interval > 0: await timers.sleep(interval)
+            try:
+                with span('api.delete_message', message=message_id):
+                    await self.outboxCall(
+                        self.nextOpKey(), 'delete_message',
+                        lambda: self.bot.delete_message(chat_id=self.chat_id, message_id=message_id),
+                        message_id=message_id)
+                self.deadMessage(message_id)
+            except aiogram.utils.exceptions.MessageToDeleteNotFound:
+                self.deadMessage(message_id)
+            except Exception as e:
+                self.log.error(f'!delete: {e}')
+
+    async def deleteFlush(self):
+        """Wait until all queued messages are deleted"""
+        while self._deleteTask is not None:
+            await asyncio.wait([self._deleteTask])
+
     # -----------------------
     # MESSAGE
     # -----------------------
-    lastReceivedMessage: typing.Optional[Message_t] = None
+    _lastReceived: typing.Optional[MessageSnapshot] = None
     lastReceivedCallback: typing.Optional[Callback_t] = None
     lastMessage: typing.Optional[BotIMessage] = None
 
@@ -658,37 +1279,129 @@ class BotChat(ISettings):
         pass
 
     @property
-    def last(self) -> Message_t:
+    def lastReceivedMessage(self) -> typing.Optional[MessageSnapshot]:
+        """Snapshot of the last message received by this channel. Full message object is held only
+        if ``keepMessages`` session option is set, see ``MessageSnapshot``"""
+        return self._lastReceived
+
+    @lastReceivedMessage.setter
+    def lastReceivedMessage(self, message: typing.Union[Message_t, MessageSnapshot, None]):
+        if message is not None and not isinstance(message, MessageSnapshot):
+            message = MessageSnapshot(message, self.session.opt(_KEEP_MESSAGES))
+        self._lastReceived = message
+
+    @property
+    def last(self) -> MessageSnapshot:
         """Get last message receive by this channel"""
-        return self.lastReceivedMessage if self.lastReceivedMessage else Message_t()
+        return self._lastReceived if self._lastReceived else MessageSnapshot()
 
     @property
     def last_id(self) -> MessageId_t:
         """Get last message id received by this channel"""
         return self.lastReceivedMessage.message_id if self.lastReceivedMessage else NoMessageId
 
+    _topMessageId: MessageId_t = NoMessageId
+    _keyboardSeq: int = 0
+
+    def seenMessage(self, message_id: MessageId_t):
+        """Remember newest message id of chat. Used to build keyboard ids"""
+        if message_id and message_id > self._topMessageId:
+            self._topMessageId = message_id
+
+    def nextKeyboardId(self) -> str:
+        """Get id for keyboard of new message.
+
+        Id is built from chat id, newest message id known in chat and per-chat counter, so it does not
+        depend on process and is not repeated in chat after restart (message ids only grow). Callbacks
+        are also checked against id of message keyboard is shown in, see ``BotKeyboard.message_id``.
+        """
+        self._keyboardSeq += 1
+        return f'{toBase36(self.chat_id)}.{toBase36(self._topMessageId)}.{toBase36(self._keyboardSeq)}'
+
+    # -----------------------
+    # OUTBOX
+
+    def nextOpKey(self) -> str:
+        """Get idempotency key for outgoing request which has no own id.
+        Counter is kept by session, so keys are not repeated by chat recreated after eviction or close.
+        """
+        return f'{toBase36(self.chat_id)}.{self.session.nextOpId()}'
+
+    async def outboxCall(self, key: str, method: str, call: typing.Callable[[], typing.Awaitable], /, **kwargs):
+        """Execute API request through session outbox.
+
+        Request is stored in outbox before ``call()`` is executed and acknowledged after it completes
+        or fails, so request interrupted by process exit or cancelled is sent by ``BotSession.outboxReplay()``
+        on next start. Request with already completed ``key`` is not executed again.
+
+        :param key: idempotency key
+        :param method: bot method name, see ``bot_outbox.REPLAYABLE``
+        :param call: request to execute
+        :param kwargs: JSON compatible arguments of ``method`` (except ``chat_id``) to replay it
+        :return: result of ``call()``
+        """
+        outbox = self.session.outbox
+        if outbox is None or self.replaying: return await call()
+
+        done, rc = outbox.result(key)
+        if done: return journalMessage(rc) if isinstance(rc, dict) else rc
+
+        await outbox.put(key, self.chat_id, method, kwargs)
+        try:
+            rc = await call()
+        except Exception:
+            # request is completed with error, cancelled one is left to replay
+            outbox.ack(key)
+            raise
+        outbox.ack(key, journalDump(rc) if isinstance(rc, Message_t) else rc)
+        return rc
+
     async def process_message(self, message: Message_t):
         if not self.alive: return
         self.lastReceivedMessage = message
+        self.seenMessage(message.message_id)
+        self._processing += 1
         try:
-            if self.session.OnMessage and await self.session.OnMessage(self, message):
-                return
-        except Exception as e:
-            self.log.error(f'session.OnMessage: exception {e}')
-            raise
-        await self.waitProcess(message=message)
+            try:
+                if self.session.OnMessage and await self.session.OnMessage(self, message):
+                    return
+            except Exception as e:
+                self.log.error(f'session.OnMessage: exception {e}')
+                raise
+            await self.waitProcess(message=message)
+        finally:
+            self._processing -= 1
 
     async def process_callback(self, data: types.CallbackQuery):
-        if not self.alive: return
+        if not self.alive or self.callbackSuppressed(data): return
         self.lastReceivedMessage = data.message
+        self.seenMessage(data.message.message_id)
+        self._processing += 1
         try:
-            if self.session.OnCallback:
-                if await self.session.OnCallback(self, data):
-                    return
-        except Exception as e:
-            self.log.error(f'session.OnCallback: exception {e}')
-            raise
-        await self.waitProcess(data=data)
+            try:
+                if self.session.OnCallback:
+                    if await self.session.OnCallback(self, data):
+                        return
+            except Exception as e:
+                self.log.error(f'session.OnCallback: exception {e}')
+                raise
+            await self.waitProcess(data=data)
+        finally:
+            self._processing -= 1
+
+    async def answer(self, data: Callback_t, text: str = None, show_alert: bool = None,
+                     url: str = None, cache_time: int = None) -> bool:
+        """Answer callback query. If callbacks are acknowledged automatically ('autoAnswerCallbacks' session
+        option) must be used instead of ``data.answer()``: answer sent in 'callbackAnswerWindow' seconds
+        after receiving replaces acknowledgement, later one is dropped.
+
+        :return: True if answer was sent
+        """
+        if self.replaying: return False
+        if not self.session.opt(_AUTO_ANSWER):
+            return await self.bot.answer_callback_query(
+                data.id, text=text, show_alert=show_alert, url=url, cache_time=cache_time)
+        return await self.session.answers.answer(self.bot, data, text, show_alert, url, cache_time)
 
     # -----------------------
     # User interface
@@ -696,7 +1409,7 @@ class BotChat(ISettings):
     def _getMessageId(self, message: BotMessageTypes_t) -> MessageId_t:
         mid = NoMessageId
         if not mid and isinstance(message, int): mid = message
-        if not mid and isinstance(message, Message_t): mid = message.message_id
+        if not mid and isinstance(message, (Message_t, MessageSnapshot)): mid = message.message_id
         if not mid and isinstance(message, BotIMessage): mid = message.message_id
         return mid
 
@@ -759,27 +1472,47 @@ class BotChat(ISettings):
         return False
 
     # no exceptions, ret bool
-    async def delete(self, message: BotMessageTypes_t = None) -> bool:
+    async def delete(self, message: BotMessageTypes_t = None, wait: bool = None) -> bool:
         """Delete message. Mask exception about deleting non-existent messages.
 
-        :return: True: If message was successfully deleted.
+        If 'backgroundDelete' option is set message is queued and call returns at once. Queue is processed
+        by background task in batches: by single bulk request if bot supports it or by single requests
+        with 'deleteInterval' seconds between them. Repeated deletes of queued message are ignored.
+
+        :param wait: delete message right now and wait for result. Option value is used if not set
+        :return: True: If message was successfully deleted or queued.
         False: If error happen of message_id is not set
         """
         with PROC('msg', message):
             self._ensureSelf()
 
             message_id = self.last_id if message is None else self._getMessageId(message)
-            if not message_id: return True
+            if not message_id or message_id in self._deadMessages: return True
+            if wait is None: wait = not self.opt(_BACKGROUND_DELETE)
 
             LOG('del=', message_id)
             try:
-                if await self.bot.delete_message(chat_id=self.chat_id, message_id=message_id):
+                if self.replaying:
+                    rc = True
+                elif not wait:
+                    rc = self._deleteEnqueue(message_id)
+                else:
+                    self._deleteQueue.pop(message_id, None)
+                    with span('api.delete_message', message=message_id):
+                        rc = await self.outboxCall(
+                            self.nextOpKey(), 'delete_message',
+                            lambda: self.bot.delete_message(chat_id=self.chat_id, message_id=message_id),
+                            message_id=message_id)
+                    if rc: self.deadMessage(message_id)
+                if rc:
                     if self.last_id == message_id:
                         self.lastReceivedMessage.message_id = NoMessageId
                         self.waiterMessageRemove(message_id)
                     return True
             except BadRequest as e:
                 self.log.error(f'!delete: {e}')
+                if isinstance(e, aiogram.utils.exceptions.MessageToDeleteNotFound):
+                    self.deadMessage(message_id)
                 if not self.opt(_MASK_EXCEPTIONS):
                     raise
             return False
@@ -795,7 +1528,32 @@ class BotChat(ISettings):
         async def _onMessage(chat, message) -> bool:
             return True
 
-        return await self.waiterAdd(ModalWaiter(self, NoMessageId, on_message=_onMessage)).wait(timeout)
+        journal = self.journal
+        rc = journal.replay('wait') if journal else None
+        if rc is not None:
+            self.lastReceivedMessage = journalMessage(rc[1])
+            return rc[0]
+
+        rc = await self.waiterAdd(ModalWaiter(self, NoMessageId, on_message=_onMessage)).wait(timeout)
+        if journal: journal.record('wait', rc, journalDump(self.lastReceivedMessage) if rc else None)
+        return rc
+
+    def messages(self, filter: typing.Optional[StreamFilter_t] = None, timeout: float = None,
+                 maxsize: int = 100) -> UpdateStream:
+        """Stream of received messages. Unlike ``waitmsg()`` in a loop, messages arrived while logic
+        processes previous one are queued, not lost.
+
+        Usage::
+
+            async for message in chat.messages():
+                await chat.delete(message)
+
+        :param filter: messages filter. Not passed messages go to other waiters
+        :param timeout: max time to wait for every message
+        :param maxsize: max number of not processed messages
+        """
+        self._ensureSelf()
+        return UpdateStream(self, StreamWaiter(self, NoMessageId, filter, maxsize), timeout)
 
     # MENU
     def build(self,
@@ -948,7 +1706,7 @@ class BotChat(ISettings):
         :return: Index of button selected or -1 on timeout or error
         """
         if not buttons:
-            buttons = [['YES','NO']]
+            buttons = _YES_NO
         elif not isinstance(buttons,typing.List):
             raise ValueError('Buttons must be a list with buttons cations')
         elif len(buttons) < 2:
@@ -957,34 +1715,110 @@ class BotChat(ISettings):
             buttons = [ [buttons[0], buttons[1] ] ]
         return await self.ask( **filterArgs(locals()) )
 
+_YES_NO = KeyboardTemplate([['YES', 'NO']])
+"""Default ``askYesNo()`` buttons"""
+
+
 # ------------------------------------------------------------------
 class BotChats(typing.Dict[str, typing.Optional[BotChat]]):
-    """List of chats since bot start"""
+    """Resident chats.
+
+    Chats are ordered from least to most recently used. If 'maxChats' session option is set, least recently
+    used evictable chats are removed from memory when limit is reached. If 'chatIdleTime' option is set,
+    evictable chats idle longer than it are removed too. Evicted chat state is stored in settings and
+    chat is transparently recreated by ``chat()`` on next update.
+    """
     session: 'BotSession'
+    _SWEEP_LIMIT = 1000
 
     def __init__(self, session: 'BotSession'):
         super(BotChats, self).__init__()
         self.session = session
+        self._lastSweep = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.rehydrations = 0
+        self.evictions = 0
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        """Get chat cache metrics"""
+        total = self.hits + self.misses
+        return {
+            'resident': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'rehydrations': self.rehydrations,
+            'evictions': self.evictions,
+        }
 
     def chat(self, message: Message_t) -> BotChat:
-        chat_id = message.chat.id  # let it traps here if something wrong w data
+        return self.chat_by_id(message.chat.id)  # let it traps here if something wrong w data
 
-        c = self.setdefault(chat_id, None)
-        if not c:
+    def chat_by_id(self, chat_id: ChatId_t) -> BotChat:
+        now = time.monotonic()
+
+        c = self.pop(chat_id, None)
+        if c:
+            self.hits += 1
+        else:
+            self.misses += 1
             c = BotChat(self.session, chat_id)
-            self[chat_id] = c
+            if c.rehydrated: self.rehydrations += 1
+        # move to the end as most recently used
+        self[chat_id] = c
+        c.lastActive = now
+
+        self._evict(c, now)
         return c
 
+    def _evict(self, current: BotChat, now: float):
+        maxChats = self.session.opt(_MAX_CHATS)
+        idle = self.session.opt(_CHAT_IDLE_TIME)
+        sweep = idle > 0 and now - self._lastSweep >= idle / 4
+        if not sweep and (maxChats <= 0 or len(self) <= maxChats): return
+        if sweep: self._lastSweep = now
+
+        victims = []
+        over = len(self) - maxChats if maxChats > 0 else 0
+        checked = 0
+        for chat_id, c in self.items():
+            if checked >= self._SWEEP_LIMIT or c is current: break
+            checked += 1
+            isIdle = sweep and now - c.lastActive >= idle
+            if not isIdle and len(victims) >= over: break
+            if (isIdle or len(victims) < over) and c.evictable:
+                victims.append(chat_id)
+
+        for chat_id in victims:
+            self.pop(chat_id).evict()
+            self.evictions += 1
+
     async def chat_done(self, chat: BotChat):
         if not chat: return
-        self[chat.chat_id] = None
+        self.pop(chat.chat_id, None)
         await chat.chat_done()
 
 
 # ------------------------------------------------------------------
 # BotSession
 # ------------------------------------------------------------------
+_MAX_CHATS = 'maxChats'
+_CHAT_IDLE_TIME = 'chatIdleTime'
+_MAX_USERS = 'maxUsers'
+_KEEP_MESSAGES = 'keepMessages'
+_AUTO_ANSWER = 'autoAnswerCallbacks'
+_ANSWER_WINDOW = 'callbackAnswerWindow'
+_CALLBACK_DEBOUNCE = 'callbackDebounce'
+
 _BOT_SETTINGS = {
+    _MAX_CHATS: 0,
+    _CHAT_IDLE_TIME: 0,
+    _MAX_USERS: 10000,
+    _KEEP_MESSAGES: False,
+    _AUTO_ANSWER: False,
+    _ANSWER_WINDOW: 0.1,
+    _CALLBACK_DEBOUNCE: 0.0,
 }
 
 class BotSession(ISettings):
@@ -995,11 +1829,24 @@ class BotSession(ISettings):
     log = logging.getLogger('BotSession')
     # ==== private
     storage: typing.Optional[SettingsIStorage] = None
+    executor: ExecutorPool
+    media: MediaLoader
+    watchdog: typing.Optional[LoopWatchdog] = None
+    journal: typing.Optional[JournalStorage] = None
+    outbox: typing.Optional[Outbox] = None
+    webhook_server: typing.Optional[WebhookServer] = None
+    answers: CallbackAnswers
     dispatcher: Dispatcher
     bot: Bot
     # ==== props
     chats: BotChats
     users: BotUsers
+    edits_skipped: int = 0
+    """Number of message edits skipped because content was the same as already sent"""
+    callbacks_debounced: int = 0
+    """Number of repeated clicks on the same button dropped by ``BotChat.callbackSuppressed()``"""
+    callbacks_stale: int = 0
+    """Number of clicks in completed modal popups dropped by ``BotChat.callbackSuppressed()``"""
     # ==== events
     OnMessage: typing.Optional[OnMessageEvent] = None
     OnCallback: typing.Optional[OnCallbackEvent] = None
@@ -1008,7 +1855,26 @@ class BotSession(ISettings):
     def __init__(self, dispatcher: Dispatcher, logic: type(ILogic), /,
                  on_message: OnMessageEvent = None,
                  on_callback: OnCallbackEvent = None,
-                 storage: typing.Optional[SettingsIStorage] = None):
+                 storage: typing.Optional[SettingsIStorage] = None,
+                 watchdog: typing.Optional[LoopWatchdog] = None,
+                 executor: typing.Optional[ExecutorPool] = None,
+                 journal: typing.Optional[JournalStorage] = None,
+                 outbox: typing.Optional[Outbox] = None,
+                 on_answer: OnAnswerEvent = None):
+        """Create bot session
+
+        :param dispatcher: aiogram dispatcher
+        :param logic: class of user logic, will be created for every chat
+        :param on_message: hook called for every message before chat processing
+        :param on_callback: hook called for every callback before chat processing
+        :param storage: settings storage
+        :param watchdog: event loop lag watchdog. Will be started on first update
+        :param executor: pools for ``BotChat.run_blocking()`` and ``BotChat.run_cpu()``. Shared ``executors`` by default
+        :param journal: storage for replay journals. If set, linear logic is resumed in place after restart by ``resume()``
+        :param outbox: durable queue for outgoing requests. If set, requests interrupted by restart are sent by ``outboxReplay()``
+        :param on_answer: fast hook to decide callback answer at receiving if 'autoAnswerCallbacks' option is set,
+            see ``CallbackAnswers``
+        """
         super(BotSession, self).__init__(newSettings())
         self.dispatcher = dispatcher
         self.bot = dispatcher.bot
@@ -1020,10 +1886,19 @@ class BotSession(ISettings):
         self.OnMessage = on_message
         self.OnCallback = on_callback
         self.logic = logic
+        self.watchdog = watchdog
+        self.executor = executor if executor is not None else executors
+        self.media = MediaLoader(self.executor)
+        self.journal = journal
+        self.outbox = outbox
+        self.answers = CallbackAnswers(on_answer=on_answer)
+        # keys of previous runs are replayed from outbox, so process has own prefix
+        self._opNonce = toBase36(int(time.time() * 1000))
+        self._opSeq = 0
 
         # last since they may need chat initialized
         self.chats = BotChats(self)
-        self.users = BotUsers(self.sub_cfg('users'))
+        self.users = BotUsers(self.sub_cfg('users'), lambda: self.opt(_MAX_USERS))
 
     # ----------------------
     # utils
@@ -1035,7 +1910,7 @@ class BotSession(ISettings):
         return self.chats.chat(message)
 
     def chat_done(self, chat: BotChat):
-        self.chats.chat_done(chat)
+        asyncio.get_event_loop().create_task(self.chats.chat_done(chat), name=f'chat_done:{chat.chat_id}')
 
     def user(self, message: Message_t) -> BotUser:
         return self.users.user(message)
@@ -1043,17 +1918,200 @@ class BotSession(ISettings):
     def saveSettings(self):
         self.storage.save(self)
 
+    def nextOpId(self) -> str:
+        """Get id unique for process run and not repeated by next runs. Used for outbox keys"""
+        self._opSeq += 1
+        return f'{self._opNonce}.op{toBase36(self._opSeq)}'
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        """Get current session metrics"""
+        return {
+            'chats': self.chats.metrics(),
+            'users': self.users.metrics(),
+            'executor': self.executor.metrics(),
+            'media': self.media.metrics(),
+            'edits_skipped': self.edits_skipped,
+            'callbacks_debounced': self.callbacks_debounced,
+            'callbacks_stale': self.callbacks_stale,
+            'outbox': self.outbox.metrics() if self.outbox is not None else None,
+            'webhook': self.webhook_server.metrics() if self.webhook_server is not None else None,
+            'answers': self.answers.metrics(),
+        }
+
+    async def outboxReplay(self) -> int:
+        """Send requests stored in outbox but not completed before process exit.
+        Must be called before updates processing and before ``resume()``, f.i. from dispatcher ``on_startup``.
+
+        :return: number of sent requests
+        """
+        if self.outbox is None: return 0
+        return await self.outbox.replay(self.bot, self.media)
+
+    def resume(self) -> int:
+        """Resume logic of all chats which have replay journal.
+        Must be called from running event loop before updates processing, f.i. from dispatcher ``on_startup``.
+
+        :return: number of resumed chats
+        """
+        if self.journal is None: return 0
+        n = 0
+        for chat_id in self.journal.chats():
+            if self.chats.chat_by_id(chat_id).logicResume(): n += 1
+        return n
+
+    async def broadcast(self, targets: BroadcastTargets_t, text: str,
+                        media: BotMedia_t = None,
+                        keyboard_type: KeyboardType = None,
+                        buttons: BotUserKeyboard_t = None, /,
+                        checkpoint: str = None,
+                        on_progress: OnBroadcastProgress = None,
+                        **kwargs) -> BroadcastProgress:
+        """Send the same message to many chats with respect to API limits. See ``Broadcast`` for details.
+        Messages are not bound to chat objects: callbacks from INLINE buttons come to ``OnCallback``
+        with ``keyboard_id`` prefix ('bc' by default).
+
+        :param targets: chat ids list or (async) iterable
+        :param text: message text, is soft escaped like for all other messages
+        :param media: photo to send with message
+        :param keyboard_type: keyboard type
+        :param buttons: keyboard buttons
+        :param checkpoint: file name to store progress and resume broadcast after crash
+        :param on_progress: progress notification
+        :param kwargs: other ``Broadcast`` parameters: rate, chat_interval, concurrency, etc.
+        :return: final progress with delivery counters and throughput
+        """
+        if self.bot.parse_mode and self.bot.parse_mode.casefold() in \
+                (PARSE_MARKDOWNV2.casefold(), PARSE_MARKDOWN.casefold()):
+            text = re.sub(pattern=BotChat.MARKDOWN_SOFT_QUOTE_PATTERN, repl=r"\\\1", string=text)
+        b = Broadcast(self.bot, text, media, keyboard_type, buttons,
+                      checkpoint=checkpoint, on_progress=on_progress,
+                      loader=self.media, executor=self.executor, **kwargs)
+        with span('session.broadcast'):
+            rc = await b.run(targets)
+        self.log.info(f'Broadcast finished: {rc}')
+        return rc
+
+    def webhook(self, url: str = None, /, host: str = None, port: int = None, **kwargs):
+        """Receive updates by webhook instead of long polling. Runs server until interrupted.
+
+        :param url: public URL of the endpoint to register webhook with
+        :param host: local interface to listen
+        :param port: local port to listen
+        :param kwargs: other ``WebhookServer`` parameters: path, secret_token, queue_size, etc.
+        """
+        self.webhook_server = WebhookServer(self, url, **kwargs)
+        self.webhook_server.run(host, port)
+
     def loadSettings(self):
         self.storage.load(self)
 
     # ----------------------
     # bot event dispatchers
     # ----------------------
+    def _ensureStarted(self):
+        if self.watchdog and not self.watchdog.running:
+            self.watchdog.start()
+
     async def process_message(self, message: Message_t):
         """Must be called for all new messages processed by the bot"""
-        await self.chat(message).process_message(message)
+        self._ensureStarted()
+        with span('update.message', chat=message.chat.id, message=message.message_id):
+            await self.chat(message).process_message(message)
 
     async def process_callback(self, cbd: types.CallbackQuery):
         """Must be called for all new callback data processed by the bot"""
-        c = self.chat(cbd.message)
-        await c.process_callback(cbd)
+        self._ensureStarted()
+        with span('update.callback', chat=cbd.message.chat.id, message=cbd.message.message_id):
+            c = self.chat(cbd.message)
+            if self.opt(_AUTO_ANSWER): await self.answers.receive(c, cbd, self.opt(_ANSWER_WINDOW))
+            await c.process_callback(cbd)
+
+
+# ------------------------------------------------------------------------
+# BENCHMARK
+# ------------------------------------------------------------------------
+def _bench_BotChat(count: int = 10000):
+    """Measure per-chat construction time and resident size for lazy chats (ignored after first message)
+    and for chats with created settings view and logic object"""
+    import tracemalloc
+
+    def _run(name: str, materialize: bool):
+        session = BotSession(Dispatcher(Bot(token='123456:BENCH')), ILogic)
+        msgs = [types.Message(chat=types.Chat(id=n + 1), message_id=1) for n in range(count)]
+
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        tm = time.perf_counter()
+        for m in msgs:
+            c = session.chat(m)
+            if materialize: c.logic.gopt('', {})
+        tm = time.perf_counter() - tm
+        size = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        print(f'{name:12}: {tm / count * 1e6:.1f}us, {size / count:.0f} bytes per chat')
+
+    _run('lazy', False)
+    _run('materialized', True)
+
+# _bench_BotChat()
+
+
+def _bench_lastMessage(count: int = 10000):
+    """Measure memory held by idle chats for the last received message: compact snapshot vs full
+    aiogram object (``keepMessages`` option)"""
+    import tracemalloc
+
+    def _message(n: int) -> Message_t:
+        user = {'id': n + 1, 'is_bot': False, 'first_name': 'User', 'last_name': f'N{n}', 'username': f'user{n}',
+                'language_code': 'en'}
+        return Message_t.to_object({
+            'message_id': 10, 'date': 1700000000, 'from': user,
+            'chat': {'id': n + 1, 'type': 'private', 'first_name': 'User', 'last_name': f'N{n}', 'username': f'user{n}'},
+            'text': f'/start {n}', 'entities': [{'offset': 0, 'length': 6, 'type': 'bot_command'}]})
+
+    def _run(name: str, keep: bool):
+        session = BotSession(Dispatcher(Bot(token='123456:BENCH')), ILogic)
+        session.sopt(_KEEP_MESSAGES, keep)
+        chats = [session.chats.chat_by_id(n + 1) for n in range(count)]
+
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        for n, c in enumerate(chats):
+            c.lastReceivedMessage = _message(n)
+        size = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        print(f'{name:8}: {size / count:.0f} bytes per idle chat')
+
+    _run('snapshot', False)
+    _run('full', True)
+
+# _bench_lastMessage()
+
+
+def _bench_BotMessage(count: int = 10000):
+    """Measure resident size of live non-modal menus: message object with inline keyboard, built markup
+    and registered waiter. No API calls are made"""
+    import tracemalloc
+
+    async def _main():
+        session = BotSession(Dispatcher(Bot(token='123456:BENCH')), ILogic)
+        chat = session.chats.chat_by_id(1)
+        menus = []
+
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        for n in range(count):
+            m = chat.build(f'Menu {n}', buttons=[[('One', 'one'), ('Two', 'two')], [('Three', 'three')]])
+            # noinspection PyProtectedMember
+            m._message_id = n + 1
+            m.keyboard.message_id = n + 1
+            _ = m.keyboard.markup
+            await m._OnShowMessage(True)
+            menus.append(m)
+        size = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        print(f'{count} live menus: {size / count:.0f} bytes per menu')
+
+    asyncio.run(_main())
+
+# _bench_BotMessage()
@@ -0,0 +1,348 @@
+import asyncio
+import collections
+import inspect
+import json
+import logging
+import os
+import time
+import typing
+
+from aiogram import Bot
+from aiogram.utils import exceptions
+
+from bot_executor import ExecutorPool, executors
+from bot_keyboard import BotKeyboard, KeyboardType
+from bot_media import MediaLoader
+from bot_timers import timers
+from bot_trace import span
+from bot_types import *
+
+BroadcastTargets_t = typing.Union[typing.Iterable[ChatId_t], typing.AsyncIterable[ChatId_t]]
+"""List of chat ids or any (async) iterable, f.i. database query. Must return the same sequence on resume"""
+
+
+class BroadcastProgress:
+    """Broadcast state
+
+    :var total: number of targets if known
+    :var position: number of targets processed in order. Broadcast is resumed from this position
+    :var sent: number of delivered messages
+    :var failed: number of failed deliveries
+    :var blocked: number of chats which blocked bot or do not exist anymore (included in ``failed``)
+    :var retries: number of flood wait errors got from API
+    :var elapsed: seconds spent in all runs
+    :var done: True if all targets are processed
+    """
+    __slots__ = ('total', 'position', 'sent', 'failed', 'blocked', 'retries', 'elapsed', 'done', 'file_id', 'errors')
+
+    def __init__(self, total: typing.Optional[int] = None):
+        self.total = total
+        self.position = 0
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retries = 0
+        self.elapsed = 0.0
+        self.done = False
+        self.file_id: typing.Optional[str] = None
+        self.errors: typing.Dict[str, int] = collections.Counter()
+
+    @property
+    def rate(self) -> float:
+        """Delivered messages per second"""
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def asDict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'total': self.total, 'position': self.position, 'sent': self.sent, 'failed': self.failed,
+            'blocked': self.blocked, 'retries': self.retries, 'elapsed': self.elapsed, 'done': self.done,
+            'file_id': self.file_id, 'errors': dict(self.errors),
+        }
+
+    def __str__(self):
+        return f'{self.position}/{self.total if self.total is not None else "?"}: sent {self.sent}, ' \
+               f'failed {self.failed} (blocked {self.blocked}), retries {self.retries}, {self.rate:.1f} msg/s'
+
+
+OnBroadcastProgress = typing.Callable[[BroadcastProgress], typing.Union[None, typing.Awaitable[None]]]
+"""Called periodically and after broadcast finish"""
+
+_BLOCKED = (exceptions.BotBlocked, exceptions.ChatNotFound, exceptions.UserDeactivated, exceptions.BotKicked)
+
+
+class _RateLimiter:
+    """Spreads calls evenly: not more than ``rate`` calls per second"""
+    __slots__ = ('interval', '_next')
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        t = max(self._next, now)
+        self._next = t + self.interval
+        if t > now: await timers.sleep(t - now)
+
+    def pause(self, delay: float):
+        """Do not allow calls for ``delay`` seconds"""
+        self._next = max(self._next, time.monotonic() + delay)
+
+
+class Broadcast:
+    """Send the same message to many chats.
+
+    - not more than ``rate`` messages per second are sent in total and not more than one message
+      per ``chat_interval`` seconds to the same chat
+    - flood wait errors pause the whole broadcast for requested time, message is retried
+    - local media is uploaded once, all other messages use ``file_id`` of the first one
+    - up to ``concurrency`` requests are running at the same time
+    - if ``checkpoint`` file is set, progress is stored to it, so broadcast interrupted by crash is
+      resumed from the last stored position. Completed broadcast is not repeated.
+
+    Usage::
+
+        progress = await botSession.broadcast(chat_ids, 'News!', checkpoint='news.json', on_progress=print)
+    """
+    log = logging.getLogger('Broadcast')
+
+    def __init__(self, bot: Bot, text: str,
+                 media: BotMedia_t = None,
+                 keyboard_type: KeyboardType = None,
+                 buttons: BotUserKeyboard_t = None,
+                 keyboard_id: str = 'bc',
+                 rate: float = 25,
+                 chat_interval: float = 1,
+                 concurrency: int = 10,
+                 retries: int = 3,
+                 checkpoint: str = None,
+                 checkpoint_interval: float = 1,
+                 progress_every: int = 100,
+                 on_progress: OnBroadcastProgress = None,
+                 loader: MediaLoader = None,
+                 executor: ExecutorPool = None):
+        """Create broadcast
+
+        :param bot: bot to send messages
+        :param text: message text (or caption for media) ready to send with bot parse mode
+        :param media: photo to send with message
+        :param keyboard_type: keyboard type
+        :param buttons: keyboard buttons
+        :param keyboard_id: prefix for INLINE buttons callback data
+        :param rate: max messages per second for the whole broadcast
+        :param chat_interval: min seconds between messages to the same chat
+        :param concurrency: max number of simultaneous requests
+        :param retries: max number of flood wait retries for single message
+        :param checkpoint: file name to store progress
+        :param checkpoint_interval: min seconds between checkpoint writes
+        :param progress_every: call ``on_progress`` after every such number of processed targets
+        :param on_progress: progress notification
+        :param loader: loader for local media files
+        :param executor: pools used to write checkpoint
+        """
+        self.bot = bot
+        self.text = text
+        self.media = media
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.progress_every = max(1, progress_every)
+        self.on_progress = on_progress
+        self.executor = executor if executor is not None else executors
+        self.loader = loader if loader is not None else MediaLoader(self.executor)
+
+        kbd = BotKeyboard(keyboard_type=keyboard_type, buttons=buttons)
+        kbd.keyboard_id = keyboard_id
+        self.markup = kbd.markup
+
+        self.progress = BroadcastProgress()
+        self._limiter = _RateLimiter(rate)
+        self._lastSent: typing.Dict[ChatId_t, float] = {}
+        self._completed: typing.Set[int] = set()
+        self._saved = 0.0
+        self._notified = 0
+        self._started = 0.0
+        self._elapsed = 0.0
+
+    # -----------------------
+    def _loadCheckpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint): return
+        with open(self.checkpoint, 'r', encoding='utf-8') as f:
+            st = json.load(f)
+        p = self.progress
+        for nm in ('position', 'sent', 'failed', 'blocked', 'retries', 'elapsed', 'done', 'file_id'):
+            setattr(p, nm, st.get(nm, getattr(p, nm)))
+        p.errors.update(st.get('errors', {}))
+        self.log.warning(f'Broadcast resumed from checkpoint: {p}')
+
+    @staticmethod
+    def _writeJson(fnm: str, data: typing.Dict):
+        tmp = fnm + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, fnm)
+
+    async def _saveCheckpoint(self, force: bool = False):
+        if not self.checkpoint: return
+        now = time.monotonic()
+        if not force and now - self._saved < self.checkpoint_interval: return
+        self._saved = now
+        await self.executor.run(self._writeJson, (self.checkpoint, self.progress.asDict()), {})
+
+    async def _notify(self, force: bool = False):
+        if not self.on_progress: return
+        p = self.progress
+        if not force and p.position - self._notified < self.progress_every: return
+        self._notified = p.position
+        rc = self.on_progress(p)
+        if inspect.isawaitable(rc): await rc
+
+    def _complete(self, index: int):
+        """Mark target as processed and move position over all processed in order targets"""
+        self._completed.add(index)
+        p = self.progress
+        while p.position in self._completed:
+            self._completed.discard(p.position)
+            p.position += 1
+
+    # -----------------------
+    async def _send(self, chat_id: ChatId_t):
+        if self.media and self.progress.file_id is None:
+            # first message uploads media
+            async with self.loader.input(self.media) as photo:
+                msg = await self.bot.send_photo(chat_id, photo=photo, caption=self.text, reply_markup=self.markup)
+            photos = getattr(msg, 'photo', None)
+            if photos: self.progress.file_id = photos[-1].file_id
+        elif self.media:
+            await self.bot.send_photo(chat_id, photo=self.progress.file_id, caption=self.text, reply_markup=self.markup)
+        else:
+            await self.bot.send_message(chat_id, text=self.text, reply_markup=self.markup)
+
+    async def _deliver(self, index: int, chat_id: ChatId_t):
+        p = self.progress
+        last = self._lastSent.get(chat_id)
+        if last is not None and self.chat_interval > 0:
+            wait = last + self.chat_interval - time.monotonic()
+            if wait > 0: await timers.sleep(wait)
+
+        for attempt in range(self.retries + 1):
+            await self._limiter.acquire()
+            try:
+                with span('api.broadcast', chat=chat_id):
+                    await self._send(chat_id)
+                p.sent += 1
+                break
+            except exceptions.RetryAfter as e:
+                p.retries += 1
+                self._limiter.pause(e.timeout)
+                if attempt == self.retries:
+                    p.failed += 1
+                    p.errors[type(e).__name__] += 1
+            except Exception as e:
+                p.failed += 1
+                p.errors[type(e).__name__] += 1
+                if isinstance(e, _BLOCKED):
+                    p.blocked += 1
+                else:
+                    self.log.error(f'Broadcast to {chat_id} failed: {e}')
+                break
+
+        now = time.monotonic()
+        self._lastSent[chat_id] = now
+        p.elapsed = self._elapsed + now - self._started
+        self._complete(index)
+        await self._notify()
+        await self._saveCheckpoint()
+
+    async def run(self, targets: BroadcastTargets_t) -> BroadcastProgress:
+        """Send message to all targets
+
+        :return: final progress
+        """
+        p = self.progress
+        if isinstance(targets, typing.Sized): p.total = len(targets)
+        self._loadCheckpoint()
+        if p.done: return p
+
+        if isinstance(targets, typing.AsyncIterable):
+            it = targets.__aiter__()
+
+            async def _next():
+                return await it.__anext__()
+        else:
+            sit = iter(targets)
+
+            async def _next():
+                try:
+                    return next(sit)
+                except StopIteration:
+                    raise StopAsyncIteration
+
+        # skip targets processed before crash
+        index = 0
+        try:
+            while index < p.position:
+                await _next()
+                index += 1
+        except StopAsyncIteration:
+            pass
+
+        lock = asyncio.Lock()
+
+        async def _take() -> typing.Optional[typing.Tuple[int, ChatId_t]]:
+            nonlocal index
+            async with lock:
+                try:
+                    chat_id = await _next()
+                except StopAsyncIteration:
+                    return None
+                index += 1
+                return index - 1, chat_id
+
+        async def _worker():
+            while True:
+                item = await _take()
+                if item is None: return
+                await self._deliver(*item)
+
+        self._started = time.monotonic()
+        self._elapsed = p.elapsed
+        try:
+            # media must be uploaded before other workers can use its file_id
+            while self.media and p.file_id is None:
+                item = await _take()
+                if item is None: break
+                await self._deliver(*item)
+
+            await asyncio.gather(*(_worker() for _ in range(self.concurrency)))
+            p.done = True
+        finally:
+            p.elapsed = self._elapsed + time.monotonic() - self._started
+            await self._saveCheckpoint(True)
+            await self._notify(True)
+        return p
+
+
+# ------------------------------------------------------------------------
+# BENCHMARK
+# ------------------------------------------------------------------------
+def _bench_Broadcast(count: int = 2000, latency: float = 0.05, rate: float = 1000):
+    """Broadcast to ``count`` chats through fake bot with fixed request latency and print throughput"""
+
+    class _FakeBot:
+        async def send_message(self, chat_id, **kwargs):
+            await asyncio.sleep(latency)
+
+    async def _main():
+        for concurrency in (1, 10, 50):
+            b = Broadcast(typing.cast(Bot, _FakeBot()), 'text', rate=rate, concurrency=concurrency,
+                          progress_every=count)
+            p = await b.run(range(count))
+            print(f'concurrency {concurrency:3}: {p}')
+
+    asyncio.run(_main())
+
+# _bench_Broadcast()
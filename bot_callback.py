@@ -0,0 +1,195 @@
+import asyncio
+import collections
+import logging
+import time
+import typing
+
+from aiogram import Bot
+
+from bot_timers import TimerHandle, timers
+from bot_types import *
+
+
+class _Pending:
+    """Callback query waiting for automatic acknowledgement"""
+    __slots__ = ('bot', 'received', 'handle')
+
+    def __init__(self, bot: Bot, received: float):
+        self.bot = bot
+        self.received = received
+        self.handle: typing.Optional[TimerHandle] = None
+
+
+class CallbackAnswers:
+    """Automatic acknowledgement of callback queries.
+
+    Telegram client shows progress on the pressed button until query is answered, so without answer
+    user waits for the whole logic step. Every received query is answered by the library:
+
+    - if ``on_answer`` hook returns answer, it is sent at once
+    - otherwise plain acknowledgement is sent after ``window`` seconds, or at once if window is 0.
+      Logic can send its own, richer answer by ``BotChat.answer()`` inside the window: automatic one
+      is cancelled then. Answer sent after acknowledgement is dropped.
+
+    Latency is time from query receiving to the answer request.
+    """
+    log = logging.getLogger('CallbackAnswers')
+
+    def __init__(self, window: float = 0.1, on_answer: OnAnswerEvent = None, keep_answered: int = 1000):
+        """Create answers tracker
+
+        :param window: seconds to wait for the logic answer before automatic acknowledgement
+        :param on_answer: fast hook to decide answer at receiving
+        :param keep_answered: number of last answered queries to recognize late answers
+        """
+        self.window = window
+        self.on_answer = on_answer
+        self.keep_answered = keep_answered
+
+        self._pending: typing.Dict[str, _Pending] = {}
+        self._answered: typing.OrderedDict[str, None] = collections.OrderedDict()
+        self._tasks: typing.Set[asyncio.Task] = set()
+
+        self.received = 0
+        self.hooked = 0
+        self.auto = 0
+        self.logic = 0
+        self.late = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    # -----------------------
+    async def receive(self, chat: 'BotChat', data: Callback_t, window: float = None):
+        """Register received query. Answer decided by hook is sent at once, plain one is scheduled
+
+        :param window: acknowledgement window for this query, ``window`` attribute is used if not set
+        """
+        if window is None: window = self.window
+        self.received += 1
+        p = _Pending(chat.bot, time.monotonic())
+
+        rc = None
+        if self.on_answer:
+            try:
+                rc = await self.on_answer(chat, data)
+            except Exception as e:
+                self.log.error(f'on_answer: exception {e}')
+
+        if rc is not None:
+            self.hooked += 1
+            text, show_alert = (rc, None) if isinstance(rc, str) else rc
+            self._start(data.id, p, text=text, show_alert=show_alert)
+        elif window <= 0:
+            self.auto += 1
+            self._start(data.id, p)
+        else:
+            self._pending[data.id] = p
+            p.handle = timers.call_later(window, self._expire, data.id)
+
+    def _expire(self, query_id: str):
+        p = self._pending.pop(query_id, None)
+        if p is None: return
+        self.auto += 1
+        self._start(query_id, p)
+
+    def _start(self, query_id: str, p: _Pending, **kwargs):
+        self._answered[query_id] = None
+        while len(self._answered) > self.keep_answered:
+            self._answered.popitem(last=False)
+        task = asyncio.ensure_future(self._send(query_id, p, **kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, query_id: str, p: _Pending, **kwargs) -> bool:
+        lag = time.monotonic() - p.received
+        self.latency_total += lag
+        if lag > self.latency_max: self.latency_max = lag
+        try:
+            return await p.bot.answer_callback_query(query_id, **kwargs)
+        except Exception as e:
+            # query is too old or answered outside of the library
+            self.errors += 1
+            self.log.error(f'Callback answer failed: {e}')
+            return False
+
+    async def answer(self, bot: Bot, data: Callback_t, text: str = None, show_alert: bool = None,
+                     url: str = None, cache_time: int = None) -> bool:
+        """Send logic answer for query instead of automatic acknowledgement
+
+        :return: False if query is already answered
+        """
+        p = self._pending.pop(data.id, None)
+        if p is None:
+            if data.id in self._answered:
+                self.late += 1
+                self.log.warning(f'Callback is already answered, answer "{text}" is dropped')
+                return False
+            # query was not registered, f.i. received before session
+            p = _Pending(bot, time.monotonic())
+        elif p.handle is not None:
+            p.handle.cancel()
+
+        self.logic += 1
+        self._answered[data.id] = None
+        return await self._send(data.id, p, text=text, show_alert=show_alert, url=url, cache_time=cache_time)
+
+    async def flush(self):
+        """Send all scheduled acknowledgements and wait for requests"""
+        for query_id in list(self._pending):
+            p = self._pending[query_id]
+            if p.handle is not None: p.handle.cancel()
+            self._expire(query_id)
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        """Get current answers metrics"""
+        answered = self.hooked + self.auto + self.logic
+        return {
+            'received': self.received,
+            'pending': len(self._pending),
+            'hooked': self.hooked,
+            'auto': self.auto,
+            'logic': self.logic,
+            'late': self.late,
+            'errors': self.errors,
+            'latency_avg': self.latency_total / answered if answered else 0.0,
+            'latency_max': self.latency_max,
+        }
+
+
+# ------------------------------------------------------------------------
+# BENCHMARK
+# ------------------------------------------------------------------------
+def _bench_CallbackAnswers(count: int = 1000, step: float = 0.3, window: float = 0.1):
+    """Compare click-to-ack latency when logic answers at the end of its ``step`` seconds long step
+    (acknowledgement window is longer than step) and with automatic acknowledgement after ``window``"""
+
+    class _FakeBot:
+        async def answer_callback_query(self, query_id, **kwargs):
+            return True
+
+    class _Chat:
+        bot = _FakeBot()
+
+    async def _click(answers: CallbackAnswers, n: int):
+        data = Callback_t(id=str(n), data='1.a.1:ok')
+        await answers.receive(typing.cast('BotChat', _Chat), data)
+        await asyncio.sleep(step)
+        await answers.answer(typing.cast(Bot, _Chat.bot), data, 'Done')
+
+    async def _main():
+        # late answers are expected here
+        CallbackAnswers.log.setLevel(logging.ERROR)
+        for name, w in (('logic', step * 10), ('auto', window)):
+            answers = CallbackAnswers(w)
+            await asyncio.gather(*(_click(answers, n) for n in range(count)))
+            await answers.flush()
+            m = answers.metrics()
+            print(f'{name:5}: ack avg {m["latency_avg"] * 1000:6.1f}ms, max {m["latency_max"] * 1000:6.1f}ms, '
+                  f'auto {m["auto"]}, logic {m["logic"]}, late {m["late"]}')
+
+    asyncio.run(_main())
+
+# _bench_CallbackAnswers()
@@ -0,0 +1,146 @@
+import asyncio
+import concurrent.futures
+import functools
+import os
+import time
+import typing
+
+TResult_t = typing.TypeVar('TResult_t')
+
+
+def _timedCall(fn, args, kwargs):
+    """Executed inside pool. Return start time with result to measure time task waited in pool queue"""
+    return time.time(), fn(*args, **kwargs)
+
+
+class ExecutorPool:
+    """Shared thread and process pools to run blocking or CPU-bound code from chat logic
+    without blocking event loop.
+
+    Pools are created on first use. Used by ``BotChat.run_blocking()`` and ``BotChat.run_cpu()``,
+    which also limit the number of simultaneous jobs for every single chat.
+
+    Metrics:
+      :var submitted: number of jobs passed to pool
+      :var completed: number of jobs finished successfully
+      :var failed: number of jobs finished with exception
+      :var cancelled: number of jobs cancelled before or while run
+      :var waiting: number of jobs waiting for chat quota right now
+      :var active: number of jobs passed to pool and not finished yet (queued in pool or running)
+      :var wait_total: total seconds jobs waited in queues
+      :var wait_max: max seconds single job waited in queues
+      :var run_total: total seconds jobs was executing
+    """
+
+    def __init__(self, threads: int = None, processes: int = None):
+        """Create pools holder
+
+        :param threads: max number of threads for blocking jobs (default as in ``ThreadPoolExecutor``)
+        :param processes: max number of processes for CPU jobs (default is CPU count)
+        """
+        self.threads = threads
+        self.processes = processes
+        self._threadPool: typing.Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._processPool: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.waiting = 0
+        self.active = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+
+    @property
+    def thread_pool(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self._threadPool is None:
+            self._threadPool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.threads, thread_name_prefix='BotExecutor')
+        return self._threadPool
+
+    @property
+    def process_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._processPool is None:
+            self._processPool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.processes if self.processes else os.cpu_count())
+        return self._processPool
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        """Get current pool metrics"""
+        done = self.completed
+        return {
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+            'waiting': self.waiting,
+            'active': self.active,
+            'wait_avg': self.wait_total / done if done else 0.0,
+            'wait_max': self.wait_max,
+            'run_avg': self.run_total / done if done else 0.0,
+        }
+
+    def shutdown(self, wait: bool = True):
+        """Stop all pools. Pools will be recreated on next use"""
+        if self._threadPool:
+            self._threadPool.shutdown(wait=wait, cancel_futures=True)
+            self._threadPool = None
+        if self._processPool:
+            self._processPool.shutdown(wait=wait, cancel_futures=True)
+            self._processPool = None
+
+    async def run(self, fn: typing.Callable[..., TResult_t], args: typing.Sequence, kwargs: typing.Dict, /,
+                  cpu: bool = False, quota: typing.Optional[asyncio.Semaphore] = None) -> TResult_t:
+        """Run function in pool and wait for result.
+
+        :param fn: function to execute. For ``cpu`` mode function and all arguments must be picklable
+        :param args: positional arguments
+        :param kwargs: named arguments
+        :param cpu: use process pool instead of thread pool
+        :param quota: semaphore limiting number of jobs for caller
+        :return: function result
+        """
+        loop = asyncio.get_running_loop()
+        queued = time.time()
+        if quota is not None:
+            self.waiting += 1
+            try:
+                await quota.acquire()
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+            finally:
+                self.waiting -= 1
+
+        self.submitted += 1
+        self.active += 1
+        try:
+            started, rc = await loop.run_in_executor(
+                self.process_pool if cpu else self.thread_pool,
+                functools.partial(_timedCall, fn, args, kwargs))
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        else:
+            self.completed += 1
+            self._account(queued, started)
+            return rc
+        finally:
+            self.active -= 1
+            if quota is not None:
+                quota.release()
+
+    def _account(self, queued: float, started: float):
+        wait = started - queued
+        self.wait_total += wait
+        if wait > self.wait_max: self.wait_max = wait
+        self.run_total += time.time() - started
+
+
+executors = ExecutorPool()
+"""Default pools shared by all sessions"""
@@ -9,6 +9,9 @@ class ILogic(ISettings):
     functions. Each channel will have separate, unique logic object.
     """
     chat: 'BotChat'
+    stackless: bool = False
+    """If is set logic does not run ``main()`` coroutine and all updates are passed to ``OnUpdate()``.
+    See ``bot_steps.StepLogic``"""
 
     def __init__(self, chat: 'BotChat', cfg: ISettings):
         super().__init__(cfg)
@@ -45,3 +48,14 @@ class ILogic(ISettings):
         :return: True to restart logic task or False to stay dead.
         """
         return True
+
+    async def OnUpdate(self, chat: 'BotChat', message: typing.Optional[Message_t],
+                       callback: typing.Optional[Callback_t]) -> None:
+        """Called for every message or callback received in channel if logic is ``stackless``.
+        Used instead of ``main()`` and waiters.
+
+        :param chat: parent chat executing logic
+        :param message: received message or None
+        :param callback: received callback or None
+        """
+        pass
@@ -1,4 +1,6 @@
 from bot_keyboard import BotKeyboard, KeyboardType
+from bot_timers import timers
+from bot_trace import span
 from bot_types import *
 from utils import *
 
@@ -9,18 +11,21 @@ class BotIMessage(Applicable):
     """ Interface for telegram message which can be
         manipulated (send or modified).
     """
-    _keyboard: BotKeyboard = None
+    __slots__ = ('_keyboard', '_text', '_media', '_message_id', '_modal', '_result',
+                 'reply_to_message_id', 'remove_unused', 'timeout', 'on_message', 'on_callback', 'on_apply')
+    _apply_props = ['text', 'media', 'reply_to_message_id', 'remove_unused', 'timeout', 'on_message', 'on_callback', 'on_apply']
+    _keyboard: BotKeyboard
     _text: Changeable[str]
     _media: Changeable[typing.Optional[BotMedia_t]]
-    _message_id: MessageId_t = NoMessageId
-    _modal: bool = False
-    _result: BotKeyboardResult = RESULT_NONE
-    reply_to_message_id: MessageId_t = None
-    remove_unused: bool = None
-    timeout: float = None
-    on_message: OnMessageEvent = None
-    on_callback: OnCallbackEvent = None
-    on_apply: OnMessageApplyEvent = None
+    _message_id: MessageId_t
+    _modal: bool
+    _result: BotKeyboardResult
+    reply_to_message_id: MessageId_t
+    remove_unused: bool
+    timeout: float
+    on_message: OnMessageEvent
+    on_callback: OnCallbackEvent
+    on_apply: OnMessageApplyEvent
 
     def __init__(self,
                  text: str = None,
@@ -49,13 +54,21 @@ class BotIMessage(Applicable):
         :param on_callback: Called for any data notification send by telegram. Called in any form if message have inline keyboard.
         :param on_apply: Called before display or update message to allow user to modify its content.
         """
-        Applicable.__init__(self, ['text', 'media', 'reply_to_message_id', 'remove_unused', 'timeout','on_message','on_callback','on_apply'])
+        Applicable.__init__(self)
         self._keyboard = BotKeyboard(keyboard_type=keyboard_type, buttons=buttons, placeholder=placeholder)
         self._text = Changeable[str]('')
         self._media = Changeable[BotMedia_t](None)
+        self._message_id = NoMessageId
+        self._modal = False
+        self._result = RESULT_NONE
+        self.reply_to_message_id = None
+        self.remove_unused = None
+        self.timeout = None
+        self.on_message = None
+        self.on_callback = None
+        self.on_apply = None
         self.apply(locals())
         self._keyboard.apply(locals())
-        self.say = self.show
 
     async def __aenter__(self):
         return await self.show()
@@ -140,24 +153,26 @@ class BotIMessage(Applicable):
         if self._modal and not self.keyboard.hasKeyboard:
             raise ValueError('Cant popup message without keyboard')
 
-        if self.message_id:
-            if not self.keyboard.replaceable():
-                await self.delete()
-
-        try:
-            if not self.message_id:
-                self._message_id = await self._createMessage()
-                if self.message_id and not self.modal:
-                    await self._OnShowMessage(True)
-            else:
-                await self._updateMessage()
-                if not self.modal:
-                    await self._OnShowMessage(False)
-        finally:
-            self.unchange()
+        with span('display', message=self.message_id, modal=self._modal):
+            if self.message_id:
+                if not self._replaceable():
+                    await self.delete()
+
+            try:
+                if not self.message_id:
+                    self._message_id = await self._createMessage()
+                    self._keyboard.message_id = self._message_id
+                    if self.message_id and not self.modal:
+                        await self._OnShowMessage(True)
+                else:
+                    await self._updateMessage()
+                    if not self.modal:
+                        await self._OnShowMessage(False)
+            finally:
+                self.unchange()
 
         if self.message_id and not self.modal and wait_delay:
-            await asyncio.sleep(wait_delay)
+            await self._OnDelay(wait_delay)
 
         return self
 
@@ -184,6 +199,8 @@ class BotIMessage(Applicable):
         await self._display(wait_delay)
         return self
 
+    say = show
+
     async def popup(self, /,
                     text: str = None,
                     keyboard_type: KeyboardType = None,
@@ -222,9 +239,14 @@ class BotIMessage(Applicable):
             if not await self._deleteMessage():
                 return False
             self._message_id = NoMessageId
+            self._keyboard.message_id = NoMessageId
             await self._OnDeleteMessage()
         return True
 
+    def _replaceable(self) -> bool:
+        """Check if shown message can be updated in place or must be deleted and sent again"""
+        return self.keyboard.replaceable()
+
     async def _deleteMessage(self) -> bool:
         """Called to delete message. Its guaranteed what message was send and message_id is valid"""
         pass
@@ -248,3 +270,7 @@ class BotIMessage(Applicable):
     async def _OnPopupMessage(self) -> BotKeyboardResult:
         """Called to execute modal mode for message"""
         pass
+
+    async def _OnDelay(self, delay: float) -> None:
+        """Called to pause after NON-MODAL message was displayed with ``wait_delay``"""
+        await timers.sleep(delay)
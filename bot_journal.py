@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+import os
+import typing
+
+from bot_executor import ExecutorPool, executors
+from bot_types import *
+
+JournalEntry_t = typing.List[typing.Any]
+"""Journal entry: ``[kind, value, ...]``. All values must be JSON compatible"""
+
+
+def journalDump(message: typing.Union[Message_t, MessageSnapshot, Callback_t, None]) -> typing.Optional[typing.Dict]:
+    """Convert message (its snapshot or callback query) to JSON compatible form to store in journal"""
+    return message.to_python() if message else None
+
+
+def journalMessage(data: typing.Optional[typing.Dict]) -> typing.Optional[Message_t]:
+    """Restore message stored by ``journalDump()``"""
+    return Message_t.to_object(data) if data else None
+
+
+def journalCallback(data: typing.Optional[typing.Dict]) -> typing.Optional[Callback_t]:
+    """Restore callback query stored by ``journalDump()``"""
+    return Callback_t.to_object(data) if data else None
+
+
+# ------------------------------------------------------------------------
+# Storage
+# ------------------------------------------------------------------------
+class JournalStorage:
+    """Interface for replay journals storage"""
+
+    def chats(self) -> typing.List[ChatId_t]:
+        """Get ids of all chats which have journal"""
+        return []
+
+    def load(self, chat_id: ChatId_t) -> typing.List[JournalEntry_t]:
+        return []
+
+    def append(self, chat_id: ChatId_t, entry: JournalEntry_t):
+        pass
+
+    def truncate(self, chat_id: ChatId_t, entries: typing.List[JournalEntry_t]):
+        """Replace whole journal with specified entries"""
+        pass
+
+    def remove(self, chat_id: ChatId_t):
+        pass
+
+    async def flush(self):
+        """Wait until all changes are stored"""
+        pass
+
+
+_APPEND = 'a'
+_TRUNCATE = 't'
+_REMOVE = 'r'
+
+
+class FileJournalStorage(JournalStorage):
+    """Journals stored as append-only JSON lines files, one file per chat.
+
+    Changes are not written on the event loop: they are queued and written by executor thread, all
+    changes of chat made while previous write is in progress are written together. Order of changes
+    in chat is kept. Journal survives process crash except the last entries which were not written yet,
+    replay stops earlier then and logic continues live from that point.
+    """
+    log = logging.getLogger('FileJournalStorage')
+
+    def __init__(self, path: str, executor: ExecutorPool = None):
+        """:param path: directory for journal files. Will be created if not exists
+        :param executor: pools for file writes
+        """
+        self.path = path
+        self.executor = executor if executor is not None else executors
+        self._queue: typing.Dict[ChatId_t, typing.List[typing.Tuple[str, str]]] = {}
+        self._writers: typing.Dict[ChatId_t, asyncio.Task] = {}
+        os.makedirs(path, exist_ok=True)
+
+    def _fileName(self, chat_id: ChatId_t) -> str:
+        return os.path.join(self.path, f'{chat_id}.jsonl')
+
+    def chats(self) -> typing.List[ChatId_t]:
+        rc = []
+        for fnm in os.listdir(self.path):
+            name, ext = os.path.splitext(fnm)
+            if ext != '.jsonl': continue
+            try:
+                rc.append(int(name))
+            except ValueError:
+                pass
+        return rc
+
+    def load(self, chat_id: ChatId_t) -> typing.List[JournalEntry_t]:
+        rc = []
+        try:
+            with open(self._fileName(chat_id), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rc.append(json.loads(line))
+                    except ValueError:
+                        # last line can be partially written on crash
+                        self.log.error(f'Chat {chat_id}: broken journal entry, rest of journal is ignored')
+                        break
+        except FileNotFoundError:
+            pass
+        return rc
+
+    def append(self, chat_id: ChatId_t, entry: JournalEntry_t):
+        self._put(chat_id, _APPEND, json.dumps(entry, default=str) + '\n')
+
+    def truncate(self, chat_id: ChatId_t, entries: typing.List[JournalEntry_t]):
+        self._put(chat_id, _TRUNCATE, ''.join(json.dumps(e, default=str) + '\n' for e in entries))
+
+    def remove(self, chat_id: ChatId_t):
+        self._put(chat_id, _REMOVE, '')
+
+    async def flush(self):
+        while self._writers:
+            await asyncio.wait(list(self._writers.values()))
+
+    # -----------------------
+    def _put(self, chat_id: ChatId_t, op: str, data: str):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no loop, f.i. tools working with journals directly
+            self._write(chat_id, [(op, data)])
+            return
+        self._queue.setdefault(chat_id, []).append((op, data))
+        if chat_id not in self._writers:
+            self._writers[chat_id] = loop.create_task(self._writer(chat_id), name=f'journal:{chat_id}')
+
+    async def _writer(self, chat_id: ChatId_t):
+        try:
+            while True:
+                ops = self._queue.pop(chat_id, None)
+                if not ops: return
+                try:
+                    await self.executor.run(self._write, (chat_id, ops), {})
+                except Exception as e:
+                    self.log.error(f'Chat {chat_id}: journal write error: {e}')
+        finally:
+            del self._writers[chat_id]
+
+    def _write(self, chat_id: ChatId_t, ops: typing.List[typing.Tuple[str, str]]):
+        """Apply queued changes of chat. Called from executor thread, never concurrently for the same chat"""
+        # truncate and remove drop everything queued before them
+        data, rewrite, removed = [], False, False
+        for op, v in ops:
+            if op == _APPEND:
+                data.append(v)
+            else:
+                data, rewrite, removed = [v], op == _TRUNCATE, op == _REMOVE
+
+        fnm = self._fileName(chat_id)
+        if removed:
+            try:
+                os.remove(fnm)
+            except FileNotFoundError:
+                pass
+        data = ''.join(data)
+        if rewrite or data:
+            with open(fnm, 'w' if rewrite else 'a', encoding='utf-8') as f:
+                f.write(data)
+
+
+# ------------------------------------------------------------------------
+# ChatJournal
+# ------------------------------------------------------------------------
+class ChatJournal:
+    """Replay journal of single chat.
+
+    While logic works live, result of every awaited interaction (message creation, popup result,
+    ``waitmsg()`` result) is appended to journal. After process restart ``main()`` is started again
+    and the same interactions take their results from journal without any API calls until journal
+    end is reached. From this point logic continues live in place, without resending messages.
+
+    Logic must be deterministic for given interaction results: code which depends on time, random
+    values or external data between interactions can lead replay to the other path. Divergence is
+    detected if interaction differs from journaled one, in this case rest of journal is dropped and
+    logic continues live.
+    """
+    log = logging.getLogger('ChatJournal')
+
+    def __init__(self, storage: JournalStorage, chat_id: ChatId_t):
+        self.storage = storage
+        self.chat_id = chat_id
+        self.entries: typing.List[JournalEntry_t] = []
+        self.pos = 0
+
+    @property
+    def replaying(self) -> bool:
+        """True while logic has not reached journal end"""
+        return self.pos < len(self.entries)
+
+    def load(self):
+        """Load journal to replay it from the beginning"""
+        self.entries = self.storage.load(self.chat_id)
+        self.pos = 0
+
+    def start(self, *values):
+        """Start new journal with 'start' entry"""
+        self.entries = []
+        self.pos = 0
+        self.storage.truncate(self.chat_id, [])
+        self.record('start', *values)
+
+    def finish(self):
+        """Remove journal. Called when logic ends, so there is nothing to resume"""
+        self.entries = []
+        self.pos = 0
+        self.storage.remove(self.chat_id)
+
+    def replay(self, kind: str) -> typing.Optional[typing.List]:
+        """Get values of next journal entry in replay mode.
+
+        :return: entry values or None if journal end is reached or entry kind differs
+        """
+        if not self.replaying: return None
+        e = self.entries[self.pos]
+        if e[0] != kind:
+            self.log.error(f'Chat {self.chat_id}: journal diverged at {self.pos}: '
+                           f'expected "{e[0]}" but got "{kind}". Continue live')
+            del self.entries[self.pos:]
+            self.storage.truncate(self.chat_id, self.entries)
+            return None
+        self.pos += 1
+        return e[1:]
+
+    def record(self, kind: str, *values):
+        """Append new entry in live mode"""
+        if self.replaying: return
+        e = [kind, *values]
+        self.entries.append(e)
+        self.pos = len(self.entries)
+        self.storage.append(self.chat_id, e)
@@ -1,3 +1,5 @@
+import json
+
 from bot_types import *
 from utils import *
 
@@ -8,12 +10,111 @@ class KeyboardType(enum.Enum):
     REMOVE = 3
 
 
+_TOKEN = '\u0000'
+"""Placeholder for routing token in serialized template. Is escaped by JSON, so can not appear in button data"""
+_REPLY_ROW_WIDTH = 3
+"""Row width used by ``ReplyKeyboardMarkup`` to calculate button index"""
+
+
+class KeyboardTemplate:
+    """Immutable keyboard buttons shared by many messages.
+
+    Buttons are validated, laid out and serialized to JSON once on creation. Message keyboard made from
+    template only inserts its routing prefix into prepared JSON, so all chats showing the same menu
+    share single template. Template can be used anywhere instead of buttons list, for INLINE and
+    KEYBOARD keyboard types.
+
+    Only text buttons (str or tuple of text and data) are supported.
+
+    Usage::
+
+        MAIN_MENU = KeyboardTemplate([[('Start', 'start'), ('Help', 'help')], ['Close']])
+        ...
+        rc = await chat.menu('Choose', MAIN_MENU)
+    """
+    __slots__ = ('rows', '_inline', '_reply', '_byData', '_byText')
+    rows: typing.Tuple[typing.Tuple[typing.Tuple[str, str], ...], ...]
+    """Buttons as ``(text, data)`` tuples"""
+
+    def __init__(self, buttons: typing.List[typing.List[typing.Union[str, typing.Tuple[str, typing.Any]]]]):
+        if not buttons or not isinstance(buttons, typing.List): raise ValueError('Buttons must be a non empty list')
+
+        def _button(v) -> typing.Tuple[str, str]:
+            if isinstance(v, typing.Tuple):
+                if len(v) == 0: raise ValueError('Key tuple must have at least one element')
+                s, c = (v[0], '') if len(v) == 1 else v
+            elif isinstance(v, (types.InlineKeyboardButton, types.KeyboardButton)):
+                raise ValueError('Template supports text buttons only')
+            else:
+                s, c = v, ''
+            BotKeyboard._checkStr(s)
+            s = str(s)
+            c = s if not c or len(str(c)) == 0 else str(c)
+            return s, c
+
+        rows = tuple(
+            tuple(_button(v) for v in row) if isinstance(row, typing.List) else (_button(row),)
+            for row in buttons)
+        setattr_ = super().__setattr__
+        setattr_('rows', rows)
+
+        # index of button is calculated as in ``BotKeyboard.known()``
+        width = max(len(row) for row in rows)
+        byData = {}
+        byText = {}
+        for nRow, row in enumerate(rows):
+            for nCol, (s, c) in enumerate(row):
+                byData.setdefault(c, nRow * width + nCol)
+                byText.setdefault(s, nRow * _REPLY_ROW_WIDTH + nCol)
+        setattr_('_byData', byData)
+        setattr_('_byText', byText)
+
+        # prefix is inserted in place of _TOKEN
+        setattr_('_inline', json.dumps(
+            {'inline_keyboard': [[{'text': s, 'callback_data': _TOKEN + c} for s, c in row] for row in rows]},
+            ensure_ascii=False
+        ).split(json.dumps(_TOKEN)[1:-1]))
+        setattr_('_reply', json.dumps([[{'text': s} for s, _ in row] for row in rows], ensure_ascii=False))
+
+    def __setattr__(self, key, value):
+        raise AttributeError('KeyboardTemplate is immutable')
+
+    def __repr__(self):
+        return f'KeyboardTemplate({[[s for s, _ in row] for row in self.rows]})'
+
+    def markup(self, keyboard_type: 'KeyboardType', prefix: str, placeholder: str = None) -> str:
+        """Get serialized markup for keyboard type with routing prefix inserted in callback data"""
+        if keyboard_type == KeyboardType.INLINE:
+            return prefix.join(self._inline)
+        if keyboard_type == KeyboardType.KEYBOARD:
+            return '{"keyboard": ' + self._reply + ', "resize_keyboard": true' + \
+                (', "input_field_placeholder": ' + json.dumps(placeholder, ensure_ascii=False) if placeholder else '') + '}'
+        raise ValueError('Template can be used only for INLINE and KEYBOARD keyboards')
+
+    def known(self, keyboard_type: 'KeyboardType', prefix: str, data: str) -> BotKeyboardResult:
+        """Find button by callback data (INLINE) or text (KEYBOARD)"""
+        if keyboard_type == KeyboardType.INLINE:
+            if not data.startswith(prefix): return RESULT_NONE
+            data = data[len(prefix):]
+            index = self._byData.get(data)
+        else:
+            index = self._byText.get(data)
+        return RESULT_NONE if index is None else BotKeyboardResult(True, data, index)
+
+
 class BotKeyboard(Applicable):
     """Class to hold message keyboard data."""
+    __slots__ = ('_keyboard_type', '_placeholder', '_buttons', '_markup', 'keyboard_id', 'message_id')
+    _apply_props = ['keyboard_type', 'buttons', 'placeholder']
     _keyboard_type: Changeable[KeyboardType]
     _placeholder: Changeable[str]
     _buttons: Changeable[typing.Optional[BotUserKeyboard_t]]
-    _markup: typing.Optional[BotMarkup_t] = None
+    _markup: typing.Optional[BotMarkup_t]
+    keyboard_id: typing.Optional[str]
+    """Prefix for INLINE buttons callback data. Object id is used if not set.
+    Messages of ``BotChat`` use ids which do not depend on process, see ``BotChat.nextKeyboardId()``"""
+    message_id: MessageId_t
+    """Message keyboard is shown in. If set, only callbacks from this message are known"""
 
     def __init__(self,
                  keyboard_type: KeyboardType = None,
@@ -25,14 +126,16 @@ class BotKeyboard(Applicable):
         :param buttons: buttons set
         :param placeholder: placeholder text for KEYBOARD type
         """
-        Applicable.__init__(self, ['keyboard_type', 'buttons', 'placeholder'])
+        Applicable.__init__(self)
         self._placeholder = Changeable[str]('')
         self._keyboard_type = Changeable[KeyboardType](KeyboardType.NONE)
         self._buttons = Changeable[BotUserKeyboard_t](None)
+        self._markup = None
+        self.keyboard_id = None
+        self.message_id = NoMessageId
         self.apply(locals())
         if buttons and keyboard_type == KeyboardType.NONE:
             self.keyboard_type = KeyboardType.INLINE
-        self._dummy = 1
 
     @staticmethod
     def _checkStr(v):
@@ -56,6 +159,8 @@ class BotKeyboard(Applicable):
     def _check(self):
         if self.keyboard_type == KeyboardType.INLINE or self.keyboard_type == KeyboardType.KEYBOARD:
             if not self.buttons: raise ValueError('Buttons is not set!')
+            # template is validated on creation
+            if isinstance(self.buttons, KeyboardTemplate): return True
             if not isinstance(self.buttons, typing.List): raise ValueError('Buttons must be a list')
             for row in self.buttons:
                 if isinstance(row, typing.List):
@@ -66,7 +171,7 @@ class BotKeyboard(Applicable):
             return True
 
     def _prefix(self) -> str:
-        return str(id(self)) + ':'
+        return (self.keyboard_id if self.keyboard_id else str(id(self))) + ':'
 
     @property
     def changed(self):
@@ -162,10 +267,17 @@ class BotKeyboard(Applicable):
         """
         if not self._markup: return RESULT_NONE
 
+        template = self.buttons if isinstance(self.buttons, KeyboardTemplate) else None
         if self.keyboard_type == KeyboardType.INLINE:
-            return RESULT_NONE if not callback else self._locateCBButton(callback.data)
+            if not callback: return RESULT_NONE
+            if self.message_id and callback.message and callback.message.message_id != self.message_id:
+                return RESULT_NONE
+            if template: return template.known(KeyboardType.INLINE, self._prefix(), callback.data)
+            return self._locateCBButton(callback.data)
         elif self.keyboard_type == KeyboardType.KEYBOARD:
-            return RESULT_NONE if not message else self._locateKBButton(message.text)
+            if not message: return RESULT_NONE
+            if template: return template.known(KeyboardType.KEYBOARD, '', message.text)
+            return self._locateKBButton(message.text)
         else:
             return RESULT_NONE
 
@@ -190,9 +302,15 @@ class BotKeyboard(Applicable):
 
     @property
     def markup(self) -> BotMarkup_t:
-        """Create markup for current keyboard type and buttons set"""
+        """Create markup for current keyboard type and buttons set.
+        Markup of keyboard made from ``KeyboardTemplate`` is serialized JSON string"""
         self._check()
 
+        if isinstance(self.buttons, KeyboardTemplate) and \
+                (self.keyboard_type == KeyboardType.INLINE or self.keyboard_type == KeyboardType.KEYBOARD):
+            self._markup = self.buttons.markup(self.keyboard_type, self._prefix(), self._placeholder.value)
+            return self._markup
+
         def _calcWidth() -> typing.Optional[int]:
             if self.buttons is None or len(self.buttons) == 0: return None
             v = 0
@@ -0,0 +1,128 @@
+import json
+import time
+import typing
+import weakref
+
+from aiogram import types
+from aiogram.types import base, fields
+
+from bot_types import *
+
+TObject_t = typing.TypeVar('TObject_t', bound=base.TelegramObject)
+
+
+class _LazyValues(dict):
+    """Values storage of telegram object built from raw update data.
+
+    Field value is deserialized on the first read, nested objects are lazy too. So only fields
+    which are really used are converted: routing by ``message.chat.id`` builds ``Chat`` object but
+    not ``User``, entities, photos, reply markup, etc.
+    """
+    __slots__ = ('owner', 'props', 'parsed')
+
+    def __init__(self, owner: base.TelegramObject, data: typing.Dict[str, typing.Any]):
+        super().__init__(data)
+        self.owner = weakref.ref(owner)
+        self.props: typing.Dict[str, fields.BaseField] = owner.props
+        self.parsed: typing.Set[str] = set()
+
+    def get(self, key, default=None):
+        if key not in self: return default
+        v = dict.__getitem__(self, key)
+        if key in self.parsed: return v
+
+        prop = self.props.get(key)
+        if prop is not None:
+            owner = self.owner()
+            prop.resolve_base(owner)
+            if isinstance(v, dict) and prop.base_object is not None and type(prop) is fields.Field:
+                v = lazyObject(prop.base_object, v, owner)
+            else:
+                v = prop.deserialize(v, parent=owner)
+            dict.__setitem__(self, key, v)
+        self.parsed.add(key)
+        return v
+
+    def __setitem__(self, key, value):
+        # values assigned by fields are already deserialized
+        dict.__setitem__(self, key, value)
+        self.parsed.add(key)
+
+
+def lazyObject(cls: typing.Type[TObject_t], data: typing.Dict[str, typing.Any],
+               parent: base.TelegramObject = None) -> TObject_t:
+    """Create telegram object from raw data without deserialization of its fields.
+    Result is a normal object of class ``cls``, fields are converted on first access.
+
+    :param cls: object class, f.i. ``types.Message``
+    :param data: raw data parsed from JSON. Is used as object storage, so must not be changed after call
+    :param parent: parent object
+    """
+    obj = cls.__new__(cls)
+    obj._conf = {'parent': weakref.ref(parent)} if parent is not None else {}
+    values = _LazyValues(obj, data)
+    for key, prop in values.props.items():
+        if prop.default and key not in values:
+            values[key] = prop.default
+    setattr(obj, base.VALUES_ATTR_NAME, values)
+    return obj
+
+
+def lazyMessage(data: typing.Dict[str, typing.Any]) -> Message_t:
+    """Create lazy message from raw data of 'message' update field"""
+    return lazyObject(Message_t, data)
+
+
+def lazyCallback(data: typing.Dict[str, typing.Any]) -> Callback_t:
+    """Create lazy callback query from raw data of 'callback_query' update field"""
+    return lazyObject(Callback_t, data)
+
+
+# ------------------------------------------------------------------------
+# BENCHMARK
+# ------------------------------------------------------------------------
+def _bench_lazyUpdate(count: int = 20000):
+    """Measure cost of update parsing from raw JSON up to reading fields used for routing and waiters
+    dispatch: full aiogram deserialization vs lazy objects"""
+    user = {'id': 100500, 'is_bot': False, 'first_name': 'User', 'last_name': 'Name',
+            'username': 'user', 'language_code': 'en'}
+    chat = {'id': 100500, 'type': 'private', 'first_name': 'User', 'last_name': 'Name', 'username': 'user'}
+    msg = {'message_id': 10, 'from': user, 'chat': chat, 'date': 1700000000,
+           'text': '/start param', 'entities': [{'offset': 0, 'length': 6, 'type': 'bot_command'}]}
+    menu = {'message_id': 11, 'from': {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'bot'},
+            'chat': chat, 'date': 1700000000, 'text': 'Choose',
+            'reply_markup': {'inline_keyboard': [[{'text': f'Button {n}', 'callback_data': f'1.a.1:{n}'}
+                                                  for n in range(3)] for _ in range(3)]}}
+    samples = {
+        'message': json.dumps({'update_id': 1, 'message': msg}).encode(),
+        'callback': json.dumps({'update_id': 2, 'callback_query': {
+            'id': '123', 'from': user, 'message': menu, 'chat_instance': '-1', 'data': '1.a.1:2'}}).encode(),
+    }
+
+    def _full(raw: bytes):
+        u = types.Update.to_object(json.loads(raw))
+        if u.message:
+            m = u.message
+            return m.chat.id, m.message_id, m.text
+        cb = u.callback_query
+        return cb.message.chat.id, cb.message.message_id, cb.data
+
+    def _lazy(raw: bytes):
+        data = json.loads(raw)
+        if 'message' in data:
+            m = lazyMessage(data['message'])
+            return m.chat.id, m.message_id, m.text
+        cb = lazyCallback(data['callback_query'])
+        return cb.message.chat.id, cb.message.message_id, cb.data
+
+    for name, raw in samples.items():
+        assert _full(raw) == _lazy(raw)
+        rc = []
+        for fn in (_full, _lazy):
+            tm = time.perf_counter()
+            for _ in range(count):
+                fn(raw)
+            rc.append((time.perf_counter() - tm) / count * 1e6)
+        print(f'{name:8}: full {rc[0]:6.1f}us, lazy {rc[1]:6.1f}us per update, x{rc[0] / rc[1]:.1f}')
+
+# _bench_lazyUpdate()
@@ -0,0 +1,238 @@
+import asyncio
+import collections
+import contextlib
+import io
+import mmap
+import os
+import time
+import typing
+
+from aiogram.types import InputFile
+
+from bot_executor import ExecutorPool, executors
+from bot_types import BotMedia_t
+
+Runner_t = typing.Callable[..., typing.Awaitable[typing.Any]]
+"""Function used to run blocking code outside event loop, f.i. ``BotChat.run_blocking``"""
+
+_StatKey_t = typing.Tuple[int, int]
+
+
+def _isLocalFile(media) -> bool:
+    return isinstance(media, str) and \
+        not media.startswith('http:') and \
+        not media.startswith('https:')
+
+
+class _MappedFile(io.RawIOBase):
+    """Read-only file object over memory-mapped file. Closes map and file handle on close()"""
+
+    def __init__(self, fnm: str):
+        super().__init__()
+        self.name = fnm
+        self._f = open(fnm, 'rb')
+        try:
+            self._map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self._f.close()
+            raise
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        pos = self._map.tell()
+        n = min(len(b), self._map.size() - pos)
+        if n <= 0: return 0
+        b[:n] = self._map[pos:pos + n]
+        self._map.seek(pos + n)
+        return n
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        self._map.seek(pos, whence)
+        return self._map.tell()
+
+    def tell(self) -> int:
+        return self._map.tell()
+
+    def close(self):
+        if not self.closed:
+            self._map.close()
+            self._f.close()
+        super().close()
+
+
+class MediaLoader:
+    """Loader for local media files used in messages.
+
+    - Files are read outside event loop (thread pool) and all file handles are closed right after
+      read or after upload for memory-mapped files.
+    - Small, frequently used files are kept in bounded LRU cache in memory. Cached data is
+      invalidated if file size or modification time changes.
+    - Files larger than ``mmap_threshold`` are memory-mapped instead of read, if enabled.
+
+    Metrics:
+      :var loads: number of local files requested
+      :var hits: number of requests served from cache
+      :var bytes_read: number of bytes read from disk
+      :var read_time: seconds spent in disk reads
+      :var open_files: number of file handles opened by loader right now
+    """
+
+    def __init__(self, executor: ExecutorPool = None,
+                 max_bytes: int = 16 * 1024 * 1024,
+                 max_item: int = 1024 * 1024,
+                 mmap_threshold: typing.Optional[int] = 8 * 1024 * 1024):
+        """Create media loader
+
+        :param executor: pools used to read files if caller do not pass own runner
+        :param max_bytes: max total size of cached data
+        :param max_item: max size of single cached file
+        :param mmap_threshold: files greater this size will be memory-mapped. None to disable
+        """
+        self.executor = executor if executor is not None else executors
+        self.max_bytes = max_bytes
+        self.max_item = max_item
+        self.mmap_threshold = mmap_threshold
+        self._cache: typing.OrderedDict[str, typing.Tuple[_StatKey_t, bytes]] = collections.OrderedDict()
+        self._cacheSize = 0
+
+        self.loads = 0
+        self.hits = 0
+        self.bytes_read = 0
+        self.read_time = 0.0
+        self.open_files = 0
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        """Get current loader metrics"""
+        return {
+            'loads': self.loads,
+            'hits': self.hits,
+            'hit_rate': self.hits / self.loads if self.loads else 0.0,
+            'bytes_read': self.bytes_read,
+            'read_throughput': self.bytes_read / self.read_time if self.read_time else 0.0,
+            'cached_files': len(self._cache),
+            'cached_bytes': self._cacheSize,
+            'open_files': self.open_files,
+        }
+
+    def clear(self):
+        """Drop all cached data"""
+        self._cache.clear()
+        self._cacheSize = 0
+
+    # -----------------------
+    def _read(self, fnm: str, known: typing.Optional[_StatKey_t]) -> typing.Tuple[_StatKey_t, typing.Any, float]:
+        """Executed in thread. Returns stat key, data (None if known is actual, bytes or _MappedFile) and read time"""
+        st = os.stat(fnm)
+        key = (st.st_size, st.st_mtime_ns)
+        if key == known: return key, None, 0.0
+
+        tm = time.perf_counter()
+        if self.mmap_threshold is not None and st.st_size >= self.mmap_threshold and st.st_size > 0:
+            return key, _MappedFile(fnm), 0.0
+        with open(fnm, 'rb') as f:
+            data = f.read()
+        return key, data, time.perf_counter() - tm
+
+    def _put(self, fnm: str, key: _StatKey_t, data: bytes):
+        old = self._cache.pop(fnm, None)
+        if old: self._cacheSize -= len(old[1])
+        if len(data) > self.max_item: return
+
+        self._cache[fnm] = (key, data)
+        self._cacheSize += len(data)
+        while self._cacheSize > self.max_bytes and self._cache:
+            _, (_, v) = self._cache.popitem(last=False)
+            self._cacheSize -= len(v)
+
+    async def load(self, fnm: str, run: Runner_t = None) -> typing.Union[bytes, _MappedFile]:
+        """Get content of local file as bytes or as memory-mapped file object. Mapped file must be closed by caller.
+
+        :param fnm: file name
+        :param run: function used to run blocking code, f.i. ``BotChat.run_blocking``
+        """
+        self.loads += 1
+        cached = self._cache.get(fnm)
+        if run is None:
+            run = lambda fn, *args: self.executor.run(fn, args, {})
+
+        key, data, tm = await run(self._read, fnm, cached[0] if cached else None)
+        if data is None:
+            self.hits += 1
+            # entry may be evicted by concurrent loads while reading
+            if fnm in self._cache:
+                self._cache.move_to_end(fnm)
+            else:
+                self._put(fnm, *cached)
+            return cached[1]
+
+        if isinstance(data, _MappedFile):
+            self.open_files += 1
+            return data
+
+        self.bytes_read += len(data)
+        self.read_time += tm
+        self._put(fnm, key, data)
+        return data
+
+    @contextlib.asynccontextmanager
+    async def input(self, media: BotMedia_t, run: Runner_t = None) -> typing.AsyncIterator[BotMedia_t]:
+        """Prepare media to upload. Local files are loaded by ``load()``, all other values are passed as is.
+        All resources are released on exit from context, so upload must be done inside it.
+
+        Usage::
+
+            async with loader.input(self.media, self.chat.run_blocking) as photo:
+                await bot.send_photo(chat_id, photo=photo)
+        """
+        if not _isLocalFile(media):
+            yield media
+            return
+
+        data = await self.load(media, run)
+        if isinstance(data, _MappedFile):
+            try:
+                yield InputFile(io.BufferedReader(data), filename=os.path.basename(media))
+            finally:
+                data.close()
+                self.open_files -= 1
+        else:
+            yield InputFile(io.BytesIO(data), filename=os.path.basename(media))
+
+
+# ------------------------------------------------------------------------
+# SOAK TEST
+# ------------------------------------------------------------------------
+def _openFds() -> int:
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return -1
+
+
+def _soak_MediaLoader(files: typing.List[str], count: int = 10000, parallel: int = 50):
+    """Load files many times in parallel and print throughput and open descriptors count"""
+    loader = MediaLoader(mmap_threshold=256 * 1024)
+
+    async def _one(n: int):
+        async with loader.input(files[n % len(files)]) as f:
+            f.file.read()
+
+    async def _main():
+        fds = _openFds()
+        tm = time.perf_counter()
+        for n in range(0, count, parallel):
+            await asyncio.gather(*(_one(i) for i in range(n, min(n + parallel, count))))
+        tm = time.perf_counter() - tm
+        print(f'{count} loads in {tm:.3f}s: {count / tm:.0f} loads/s')
+        print('fds before:', fds, 'after:', _openFds())
+        print(loader.metrics())
+        loader.executor.shutdown()
+
+    asyncio.run(_main())
+
+# _soak_MediaLoader(['data/Icon-Hi.png', 'data/calc.jpg', 'data/cat1_s.jpg', 'data/cat_s.jpg'])
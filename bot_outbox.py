@@ -0,0 +1,287 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+import typing
+
+from aiogram import Bot
+from aiogram.utils import exceptions
+
+from bot_executor import ExecutorPool, executors
+from bot_media import MediaLoader
+from bot_timers import timers
+from bot_types import *
+
+OutboxEntry_t = typing.List[typing.Any]
+"""Outbox record: ``['op', key, chat_id, method, kwargs]`` or ``['ack', key]``"""
+
+_OP = 'op'
+_ACK = 'ack'
+_REPLAY_RETRIES = 3
+
+REPLAYABLE = ('send_message', 'send_photo', 'edit_message_text', 'edit_message_caption',
+              'edit_message_reply_markup', 'delete_message', 'delete_messages')
+"""Bot methods which can be stored in outbox. Arguments of other requests are not JSON compatible"""
+
+
+def jsonMarkup(markup: typing.Optional[BotMarkup_t]) -> typing.Optional[str]:
+    """Get markup in JSON compatible form to store in outbox"""
+    return markup if markup is None or isinstance(markup, str) else markup.as_json()
+
+
+class Outbox:
+    """Durable queue of outgoing API requests.
+
+    Request is appended to the log file before it is sent and acknowledged after it completes.
+    Requests which were not acknowledged when process died are sent again by ``replay()`` on next start.
+    Writes of all requests which come while previous write is in progress are committed together
+    with single ``fsync``, so many chats can send at once without waiting for disk one by one.
+
+    Every request has idempotency key: request with key acknowledged in this run is not sent
+    again, stored result is returned instead. Log is compacted on open, so keys live only
+    until restart. Delivery is at-least-once: request sent right before crash but not acknowledged
+    yet will be sent again.
+
+    Usage::
+
+        botSession = BotSession(dp, Logic, outbox=Outbox('data/outbox.jsonl'))
+
+        async def on_startup(dp):
+            await botSession.outboxReplay()
+    """
+    log = logging.getLogger('Outbox')
+
+    def __init__(self, fnm: str, fsync: bool = True, keep_acked: int = 10000,
+                 max_size: int = 16 * 1024 * 1024, executor: ExecutorPool = None):
+        """Open outbox log
+
+        :param fnm: log file name. Directory will be created if not exists
+        :param fsync: flush every commit to disk. Without it data survive process crash but not OS crash
+        :param keep_acked: number of last acknowledged keys to check for duplicates
+        :param max_size: log size in bytes to compact it to pending requests only
+        :param executor: pools for disk writes
+        """
+        self.fnm = fnm
+        self.fsync = fsync
+        self.keep_acked = keep_acked
+        self.max_size = max_size
+        self.executor = executor if executor is not None else executors
+
+        self.pending: typing.Dict[str, OutboxEntry_t] = {}
+        self._acked: typing.OrderedDict[str, typing.Any] = collections.OrderedDict()
+        self._lines: typing.List[str] = []
+        self._waiters: typing.List[asyncio.Future] = []
+        self._task: typing.Optional[asyncio.Task] = None
+        self._file: typing.Optional[typing.TextIO] = None
+        self._size = 0
+
+        self.ops = 0
+        self.acks = 0
+        self.commits = 0
+        self.duplicates = 0
+        self.replayed = 0
+        self.commit_time = 0.0
+
+        self._load()
+
+    @staticmethod
+    def _dump(e: OutboxEntry_t) -> str:
+        return json.dumps(e, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+    def _load(self):
+        d = os.path.dirname(self.fnm)
+        if d: os.makedirs(d, exist_ok=True)
+        try:
+            with open(self.fnm, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                    except ValueError:
+                        # last line can be partially written on crash
+                        self.log.error('Broken outbox entry, rest of log is ignored')
+                        break
+                    if e[0] == _OP:
+                        self.pending[e[1]] = e
+                    elif e[0] == _ACK:
+                        self.pending.pop(e[1], None)
+        except FileNotFoundError:
+            pass
+        if self.pending: self.log.warning(f'Outbox has {len(self.pending)} not completed requests')
+        # only pending requests are left
+        self._write(''.join(self._dump(e) for e in self.pending.values()), True)
+
+    def _write(self, data: str, rewrite: bool) -> int:
+        """Write data to log. Called from executor thread, never concurrently"""
+        if rewrite and self._file:
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            self._file = open(self.fnm, 'w' if rewrite else 'a', encoding='utf-8')
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync: os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def _kick(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._committer(), name='outbox')
+
+    async def _committer(self):
+        try:
+            while self._lines:
+                lines, self._lines = self._lines, []
+                waiters, self._waiters = self._waiters, []
+                data = ''.join(lines)
+                rewrite = self._size + len(data) > self.max_size
+                if rewrite: data = ''.join(self._dump(e) for e in self.pending.values())
+
+                started = time.monotonic()
+                try:
+                    self._size = await self.executor.run(self._write, (data, rewrite), {})
+                except Exception as e:
+                    self.log.error(f'Outbox write error: {e}')
+                    for w in waiters:
+                        if not w.done(): w.set_exception(e)
+                    continue
+                self.commits += 1
+                self.commit_time += time.monotonic() - started
+                for w in waiters:
+                    if not w.done(): w.set_result(None)
+        finally:
+            self._task = None
+
+    # -----------------------
+    def result(self, key: str) -> typing.Tuple[bool, typing.Any]:
+        """Check if request with specified key is already completed.
+        Request completed with error or without known result is not treated as completed.
+
+        :return: (True, stored result) for completed request, (False, None) otherwise
+        """
+        if self._acked.get(key) is not None:
+            self.duplicates += 1
+            return True, self._acked[key]
+        return False, None
+
+    async def put(self, key: str, chat_id: ChatId_t, method: str, kwargs: typing.Dict[str, typing.Any]):
+        """Store request and wait until it is written to disk
+
+        :param key: idempotency key
+        :param chat_id: chat id
+        :param method: bot method name from ``REPLAYABLE``
+        :param kwargs: JSON compatible method arguments except ``chat_id``
+        """
+        e = [_OP, key, chat_id, method, kwargs]
+        self.pending[key] = e
+        self.ops += 1
+        w = asyncio.get_event_loop().create_future()
+        self._lines.append(self._dump(e))
+        self._waiters.append(w)
+        self._kick()
+        await w
+
+    def ack(self, key: str, result: typing.Any = None):
+        """Mark request completed. Acknowledgement is written with the next commit, caller does not wait for it"""
+        if self.pending.pop(key, None) is None: return
+        self._acked[key] = result
+        while len(self._acked) > self.keep_acked:
+            self._acked.popitem(last=False)
+        self.acks += 1
+        self._lines.append(self._dump([_ACK, key]))
+        self._kick()
+
+    async def flush(self):
+        """Wait until all stored data is written"""
+        while self._task is not None:
+            await asyncio.wait([self._task])
+
+    async def close(self):
+        await self.flush()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    async def replay(self, bot: Bot, loader: MediaLoader = None) -> int:
+        """Send requests which were not completed in previous run
+
+        :param bot: bot to send requests
+        :param loader: loader for local media files
+        :return: number of sent requests
+        """
+        n = 0
+        for key, e in list(self.pending.items()):
+            _, _, chat_id, method, kwargs = e
+            if method not in REPLAYABLE:
+                self.log.error(f'Outbox request "{method}" can not be replayed')
+                self.ack(key)
+                continue
+
+            fn = getattr(bot, method)
+            rc = None
+            for _ in range(_REPLAY_RETRIES):
+                try:
+                    if method == 'send_photo' and loader is not None:
+                        async with loader.input(kwargs['photo']) as photo:
+                            rc = await fn(chat_id=chat_id, **{**kwargs, 'photo': photo})
+                    else:
+                        rc = await fn(chat_id=chat_id, **kwargs)
+                    n += 1
+                    break
+                except exceptions.RetryAfter as ex:
+                    # request stays in log while waiting
+                    await timers.sleep(ex.timeout)
+                except Exception as ex:
+                    self.log.error(f'Outbox replay "{method}" to {chat_id} failed: {ex}')
+                    break
+            # result is stored in the same form as ``BotChat.outboxCall()`` does
+            self.ack(key, rc.to_python() if isinstance(rc, Message_t) else rc)
+
+        self.replayed += n
+        await self.flush()
+        return n
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        """Get current outbox metrics"""
+        return {
+            'pending': len(self.pending),
+            'ops': self.ops,
+            'acks': self.acks,
+            'commits': self.commits,
+            'ops_per_commit': self.ops / self.commits if self.commits else 0.0,
+            'commit_avg': self.commit_time / self.commits if self.commits else 0.0,
+            'duplicates': self.duplicates,
+            'replayed': self.replayed,
+            'size': self._size,
+        }
+
+
+# ------------------------------------------------------------------------
+# BENCHMARK
+# ------------------------------------------------------------------------
+def _bench_Outbox(count: int = 20000, concurrency: int = 200, fnm: str = 'data/outbox.bench.jsonl'):
+    """Store and acknowledge ``count`` requests from ``concurrency`` simultaneous senders and print throughput"""
+
+    async def _main():
+        for fsync in (True, False):
+            ob = Outbox(fnm, fsync=fsync)
+            seq = iter(range(count))
+
+            async def _sender():
+                for n in seq:
+                    key = f'k{n}'
+                    await ob.put(key, n % 1000, 'send_message', {'text': f'message {n}'})
+                    ob.ack(key, n)
+
+            started = time.monotonic()
+            await asyncio.gather(*(_sender() for _ in range(concurrency)))
+            await ob.close()
+            elapsed = time.monotonic() - started
+            m = ob.metrics()
+            print(f'fsync={fsync}: {count / elapsed:.0f} ops/s, {m["commits"]} commits, '
+                  f'{m["ops_per_commit"]:.1f} ops/commit, {m["commit_avg"] * 1000:.2f} ms/commit')
+        os.remove(fnm)
+
+    asyncio.run(_main())
+
+# _bench_Outbox()
@@ -0,0 +1,147 @@
+from bot_keyboard import KeyboardType
+from bot_types import *
+
+CALL_SEND_MESSAGE = 'send_message'
+CALL_SEND_PHOTO = 'send_photo'
+CALL_DELETE = 'delete_message'
+CALL_EDIT_TEXT = 'edit_message_text'
+CALL_EDIT_CAPTION = 'edit_message_caption'
+CALL_EDIT_MEDIA = 'edit_message_media'
+CALL_EDIT_MARKUP = 'edit_message_reply_markup'
+
+REPLY_KEYBOARDS = (KeyboardType.KEYBOARD, KeyboardType.REMOVE)
+"""Keyboards which are not attached to message and can not be changed by edit requests"""
+
+
+class MessageState:
+    """Message content which defines API calls needed to show it"""
+    __slots__ = ('text', 'media', 'keyboard_type', 'buttons', 'placeholder')
+
+    def __init__(self, text: str = '', media: BotMedia_t = None,
+                 keyboard_type: KeyboardType = KeyboardType.NONE,
+                 buttons: BotUserKeyboard_t = None, placeholder: str = ''):
+        self.text = text
+        self.media = media
+        self.keyboard_type = keyboard_type
+        self.buttons = buttons
+        self.placeholder = placeholder
+
+    def keyboardEquals(self, other: 'MessageState') -> bool:
+        if self.keyboard_type != other.keyboard_type: return False
+        if self.keyboard_type in (KeyboardType.NONE, KeyboardType.REMOVE): return True
+        if self.buttons != other.buttons: return False
+        return self.keyboard_type != KeyboardType.KEYBOARD or self.placeholder == other.placeholder
+
+
+Payload_t = typing.Tuple[int, typing.Any]
+"""Message content fingerprint, see ``payloadHash()``"""
+
+
+def payloadHash(text: str, media: BotMedia_t, markup: typing.Optional[BotMarkup_t]) -> Payload_t:
+    """Fingerprint of message content as it is sent to API: escaped text, media and serialized markup.
+
+    Media object which is not a file id or URL is kept in fingerprint itself and compared by identity:
+    its ``id()`` can be reused by other object after the first one is freed.
+    """
+    local = media is not None and not isinstance(media, str)
+    return hash((
+        text,
+        None if local else media,
+        markup if markup is None or isinstance(markup, str) else markup.as_json()
+    )), media if local else None
+
+
+def planCalls(old: typing.Optional[MessageState], new: MessageState) -> typing.List[str]:
+    """Get cheapest sequence of API calls to change message shown with ``old`` state to ``new`` state.
+
+    - message without media can not get media by edit and vice versa
+    - reply keyboards (KEYBOARD and REMOVE) can be changed only with new message, but message
+      with unchanged reply keyboard can be edited
+    - media edit sends caption and inline keyboard too, text and caption edits send inline keyboard
+
+    :param old: state of shown message or None if message is not shown
+    :param new: required state
+    :return: list of ``CALL_*`` names. Empty if nothing to do
+    """
+    send = CALL_SEND_PHOTO if new.media else CALL_SEND_MESSAGE
+    if old is None: return [send]
+
+    sameKeyboard = old.keyboardEquals(new)
+    if bool(old.media) != bool(new.media) or \
+            (not sameKeyboard and (old.keyboard_type in REPLY_KEYBOARDS or new.keyboard_type in REPLY_KEYBOARDS)):
+        return [CALL_DELETE, send]
+
+    if new.media:
+        if old.media != new.media: return [CALL_EDIT_MEDIA]
+        if old.text != new.text: return [CALL_EDIT_CAPTION]
+    elif old.text != new.text:
+        return [CALL_EDIT_TEXT]
+
+    return [] if sameKeyboard else [CALL_EDIT_MARKUP]
+
+
+# ------------------------------------------------------------------------
+# TESTS
+# ------------------------------------------------------------------------
+def _test_planCalls():
+    K = KeyboardType
+    A = [['a', 'b']]
+    B = [['c']]
+
+    def S(text='t', media=None, kbd=K.NONE, buttons=None, placeholder=''):
+        return MessageState(text, media, kbd, buttons, placeholder)
+
+    table = [
+        # name, old, new, calls
+        ('new text', None, S(), [CALL_SEND_MESSAGE]),
+        ('new photo', None, S(media='p'), [CALL_SEND_PHOTO]),
+        ('unchanged', S(kbd=K.INLINE, buttons=A), S(kbd=K.INLINE, buttons=A), []),
+        ('text', S(), S('x'), [CALL_EDIT_TEXT]),
+        ('text+inline', S(kbd=K.INLINE, buttons=A), S('x', kbd=K.INLINE, buttons=B), [CALL_EDIT_TEXT]),
+        ('inline only', S(kbd=K.INLINE, buttons=A), S(kbd=K.INLINE, buttons=B), [CALL_EDIT_MARKUP]),
+        ('add inline', S(), S(kbd=K.INLINE, buttons=A), [CALL_EDIT_MARKUP]),
+        ('drop inline', S(kbd=K.INLINE, buttons=A), S(), [CALL_EDIT_MARKUP]),
+        ('caption', S(media='p'), S('x', media='p'), [CALL_EDIT_CAPTION]),
+        ('caption+inline', S(media='p', kbd=K.INLINE, buttons=A), S('x', media='p', kbd=K.INLINE, buttons=B), [CALL_EDIT_CAPTION]),
+        ('photo inline only', S(media='p', kbd=K.INLINE, buttons=A), S(media='p', kbd=K.INLINE, buttons=B), [CALL_EDIT_MARKUP]),
+        ('media', S(media='p'), S(media='q'), [CALL_EDIT_MEDIA]),
+        ('media+caption+inline', S(media='p'), S('x', media='q', kbd=K.INLINE, buttons=A), [CALL_EDIT_MEDIA]),
+        ('add media', S(), S(media='p'), [CALL_DELETE, CALL_SEND_PHOTO]),
+        ('drop media', S(media='p'), S(), [CALL_DELETE, CALL_SEND_MESSAGE]),
+        ('text with same reply kbd', S(kbd=K.KEYBOARD, buttons=A), S('x', kbd=K.KEYBOARD, buttons=A), [CALL_EDIT_TEXT]),
+        ('reply kbd buttons', S(kbd=K.KEYBOARD, buttons=A), S(kbd=K.KEYBOARD, buttons=B), [CALL_DELETE, CALL_SEND_MESSAGE]),
+        ('reply kbd placeholder', S(kbd=K.KEYBOARD, buttons=A), S(kbd=K.KEYBOARD, buttons=A, placeholder='p'), [CALL_DELETE, CALL_SEND_MESSAGE]),
+        ('reply kbd to inline', S(kbd=K.KEYBOARD, buttons=A), S(kbd=K.INLINE, buttons=A), [CALL_DELETE, CALL_SEND_MESSAGE]),
+        ('inline to reply kbd', S(kbd=K.INLINE, buttons=A), S(kbd=K.KEYBOARD, buttons=A), [CALL_DELETE, CALL_SEND_MESSAGE]),
+        ('remove kbd', S(kbd=K.INLINE, buttons=A), S(kbd=K.REMOVE), [CALL_DELETE, CALL_SEND_MESSAGE]),
+        ('text with remove kbd', S(kbd=K.REMOVE), S('x', kbd=K.REMOVE), [CALL_EDIT_TEXT]),
+        ('photo reply kbd', S(media='p', kbd=K.KEYBOARD, buttons=A), S(media='p', kbd=K.KEYBOARD, buttons=B), [CALL_DELETE, CALL_SEND_PHOTO]),
+    ]
+
+    failed = 0
+    for name, old, new, calls in table:
+        rc = planCalls(old, new)
+        if rc != calls:
+            failed += 1
+            print(f'FAIL {name}: {rc} != {calls}')
+    print(f'{len(table) - failed} of {len(table)} transitions passed, '
+          f'{sum(len(c) for _, _, _, c in table)} calls planned')
+    assert not failed
+
+# _test_planCalls()
+
+
+def _test_payloadHash():
+    import io
+
+    a, b = io.BytesIO(b'a'), io.BytesIO(b'a')
+    assert payloadHash('t', 'file_id', None) == payloadHash('t', 'file_id', None)
+    assert payloadHash('t', a, None) == payloadHash('t', a, None)
+    assert payloadHash('t', a, None) != payloadHash('t', b, None)
+
+    # freed media object id is reused by the new one, but fingerprint holds the old object
+    p = payloadHash('t', io.BytesIO(b'a'), None)
+    assert p != payloadHash('t', io.BytesIO(b'b'), None)
+    print('payloadHash test passed')
+
+# _test_payloadHash()
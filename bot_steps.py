@@ -0,0 +1,284 @@
+import asyncio
+import inspect
+
+from bot_ilogic import ILogic
+from bot_keyboard import BotKeyboard, KeyboardType
+from bot_outbox import jsonMarkup
+from bot_trace import span
+from bot_types import *
+from utils import toBase36
+
+StepText_t = typing.Union[str, typing.Callable[['StepContext'], str]]
+"""Step text or function to build it from context"""
+
+StepButtons_t = typing.Union[BotUserKeyboard_t, typing.Callable[['StepContext'], BotUserKeyboard_t], None]
+"""Step buttons or function to build them from context"""
+
+StepNext_t = typing.Union[
+    None, str,
+    typing.Dict[typing.Any, typing.Optional[str]],
+    typing.Callable[['StepContext', typing.Any], typing.Union[typing.Optional[str], typing.Awaitable[typing.Optional[str]]]]
+]
+"""Transition to the next step:
+ - None: conversation ends after step
+ - str: name of the next step
+ - Dict: step result to next step name map. Key ``None`` is used for unlisted results
+ - Callable: function (sync or async) which gets context and step result and returns next step name or None
+"""
+
+_STATE = 'state'
+_MAX_TRANSITIONS = 100
+
+
+# ------------------------------------------------------------------------
+# StepContext
+# ------------------------------------------------------------------------
+class StepContext:
+    """Context passed to step functions.
+
+    :var chat: chat executing conversation
+    :var logic: logic object
+    :var state: conversation state record. It is a branch of chat settings, so it must contain only
+        primitive values and dictionaries
+    """
+    __slots__ = ('chat', 'logic', 'state')
+
+    def __init__(self, chat: 'BotChat', logic: 'StepLogic', state: typing.Dict):
+        self.chat = chat
+        self.logic = logic
+        self.state = state
+
+    @property
+    def vars(self) -> typing.Dict[str, typing.Any]:
+        """User variables of the conversation"""
+        return self.state.setdefault('vars', {})
+
+    @property
+    def step(self) -> typing.Optional[str]:
+        """Current step name"""
+        return self.state.get('step')
+
+    @property
+    def params(self) -> str:
+        """Parameters passed to '/start' command"""
+        return self.state.get('params', '')
+
+
+# ------------------------------------------------------------------------
+# Steps
+# ------------------------------------------------------------------------
+class Step:
+    """Base conversation step. Step shows message and waits for user input if needed.
+
+    Step result is passed to the transition (``next``) and stored to ``ctx.vars[store]`` if ``store`` is set.
+    """
+    keyboard_type: KeyboardType = KeyboardType.NONE
+    waits: bool = True
+
+    def __init__(self, text: StepText_t = None,
+                 buttons: StepButtons_t = None,
+                 next: StepNext_t = None,
+                 store: str = None,
+                 remove_unused: bool = None):
+        """Create step
+
+        :param text: message text
+        :param buttons: keyboard buttons
+        :param next: transition to the next step
+        :param store: name of the variable in ``ctx.vars`` to store step result
+        :param remove_unused: delete user messages unknown for the step
+        """
+        self.text = text
+        self.buttons = buttons
+        self.next = next
+        self.store = store
+        self.remove_unused = remove_unused
+
+    def keyboard(self, ctx: StepContext) -> typing.Optional[BotKeyboard]:
+        """Build step keyboard. Keyboard id depends on step render counter so buttons from old messages are unknown"""
+        if self.keyboard_type == KeyboardType.NONE: return None
+        buttons = self.buttons(ctx) if callable(self.buttons) else self.buttons
+        kbd = BotKeyboard(keyboard_type=self.keyboard_type, buttons=buttons)
+        kbd.keyboard_id = f'{ctx.step}.{ctx.state.get("seq", 0)}'
+        kbd.message_id = ctx.state.get('msg', NoMessageId)
+        # build markup to allow ``known()`` work
+        _ = kbd.markup
+        return kbd
+
+    async def enter(self, ctx: StepContext) -> None:
+        """Show step message"""
+        text = self.text(ctx) if callable(self.text) else self.text
+        if not text: return
+        kbd = self.keyboard(ctx)
+        chat = ctx.chat
+        text = chat.escape_soft(text)
+        markup = kbd.markup if kbd else None
+
+        async def _send():
+            with span('api.send_message', step=ctx.step):
+                return await chat.bot.send_message(chat.chat_id, text=text, reply_markup=markup)
+
+        # render counter is stored in state and only grows, so key is unique for chat after eviction
+        # or conversation restart
+        key = f'{toBase36(chat.chat_id)}.s.{ctx.step}.{ctx.state.get("seq", 0)}'
+        msg = await chat.outboxCall(key, 'send_message', _send, text=text, reply_markup=jsonMarkup(markup))
+        chat.seenMessage(msg.message_id)
+        ctx.state['msg'] = msg.message_id
+
+    async def leave(self, ctx: StepContext) -> None:
+        """Called after step get its result. Deletes step message by default"""
+        msg = ctx.state.pop('msg', NoMessageId)
+        if msg: await ctx.chat.delete(msg)
+
+    def result(self, ctx: StepContext, kbd: typing.Optional[BotKeyboard],
+               message: typing.Optional[Message_t], callback: typing.Optional[Callback_t]) -> typing.Any:
+        """Get step result from received update.
+
+        :return: result or None if update is unknown for step
+        """
+        return None
+
+    async def transition(self, ctx: StepContext, result: typing.Any) -> typing.Optional[str]:
+        """Get name of the next step"""
+        nxt = self.next
+        if callable(nxt):
+            nxt = nxt(ctx, result)
+            if inspect.isawaitable(nxt): nxt = await nxt
+            return nxt
+        if isinstance(nxt, typing.Dict):
+            return nxt.get(result, nxt.get(None))
+        return nxt
+
+
+class SayStep(Step):
+    """Show message and go to next step immediately. Message is not deleted."""
+    waits = False
+
+    async def leave(self, ctx: StepContext) -> None:
+        ctx.state.pop('msg', None)
+
+
+class MenuStep(Step):
+    """Show message with INLINE keyboard like ``BotChat.menu()``. Result is ``data`` of selected button."""
+    keyboard_type = KeyboardType.INLINE
+
+    def result(self, ctx, kbd, message, callback) -> typing.Any:
+        if not callback: return None
+        rc = kbd.known(callback=callback)
+        return rc.data if rc.known else None
+
+
+class AskStep(Step):
+    """Show message with KEYBOARD keyboard like ``BotChat.ask()``. Result is index of selected button."""
+    keyboard_type = KeyboardType.KEYBOARD
+
+    def result(self, ctx, kbd, message, callback) -> typing.Any:
+        if not message: return None
+        rc = kbd.known(message=message)
+        return rc.index if rc.known else None
+
+
+class WaitStep(Step):
+    """Show message (if set) and wait for any text message like ``BotChat.waitmsg()``. Result is message text."""
+
+    def result(self, ctx, kbd, message, callback) -> typing.Any:
+        return message.text if message else None
+
+
+# ------------------------------------------------------------------------
+# StepLogic
+# ------------------------------------------------------------------------
+class StepLogic(ILogic):
+    """Stackless logic. Conversation is a graph of steps and its whole state is small record
+    in chat settings, so there is no coroutine for idle conversation and chat can be evicted from
+    memory between any steps.
+
+    '/start' and '/restart' commands start conversation from ``start`` step. If conversation is
+    finished, any update is passed to ``OnDownDecide()`` to decide if it must be started again.
+
+    Usage::
+
+        class Logic(StepLogic):
+            start = 'main'
+            steps = {
+                'main': MenuStep('Choose', [[('Name', 'name'), ('Bye', 'bye')]], next={'name': 'ask', 'bye': 'bye'}),
+                'ask': WaitStep('Enter your name', store='name', next='hello'),
+                'hello': SayStep(lambda ctx: f'Hi, {escape_md(ctx.vars["name"])}', next='main'),
+                'bye': SayStep('Bye!'),
+            }
+    """
+    stackless = True
+    start: str = 'start'
+    steps: typing.Dict[str, Step] = {}
+    _lock: typing.Optional[asyncio.Lock] = None
+
+    def context(self, chat: 'BotChat') -> StepContext:
+        """Get context with current conversation state"""
+        return StepContext(chat, self, self.gopt(_STATE, {}))
+
+    def OnFinish(self, ctx: StepContext) -> None:
+        """Called after conversation reaches end (transition to None)"""
+        pass
+
+    async def OnUpdate(self, chat: 'BotChat', message: typing.Optional[Message_t],
+                       callback: typing.Optional[Callback_t]) -> None:
+        if self._lock is None: self._lock = asyncio.Lock()
+        async with self._lock:
+            ctx = self.context(chat)
+
+            if message and message.text and message.text[0] == '/':
+                cmd = message.text[1:]
+                params = None
+                if cmd in ('start', 'restart'):
+                    params = ''
+                elif cmd.startswith('start@') or cmd.startswith('restart@'):
+                    params = cmd[cmd.index('@') + 1:]
+                if params is not None:
+                    await chat.delete()
+                    await self.restart(ctx, params)
+                    return
+
+            if not ctx.step or ctx.step not in self.steps:
+                if await self.OnDownDecide(chat, chat.last):
+                    await self.restart(ctx, '')
+                return
+
+            step = self.steps[ctx.step]
+            rc = step.result(ctx, step.keyboard(ctx), message, callback)
+            if rc is None:
+                if message and step.remove_unused: await chat.delete(message)
+                return
+
+            if step.store: ctx.vars[step.store] = rc
+            await step.leave(ctx)
+            await self.goto(ctx, await step.transition(ctx, rc))
+
+    async def restart(self, ctx: StepContext, params: str):
+        """Remove current step message and start conversation from the beginning"""
+        msg = ctx.state.get('msg', NoMessageId)
+        if msg: await ctx.chat.delete(msg)
+        # render counter is never reset: keyboard ids and outbox keys must not repeat ones of old messages
+        seq = ctx.state.get('seq', 0)
+        ctx.state.clear()
+        ctx.state['seq'] = seq
+        ctx.state['params'] = params
+        await self.goto(ctx, self.start)
+
+    async def goto(self, ctx: StepContext, name: typing.Optional[str]):
+        """Enter step with specified name and all following non-waiting steps"""
+        for _ in range(_MAX_TRANSITIONS):
+            if name is None:
+                ctx.state['step'] = None
+                self.OnFinish(ctx)
+                return
+            step = self.steps.get(name)
+            if step is None: raise KeyError(f'Unknown step "{name}"')
+
+            ctx.state['step'] = name
+            ctx.state['seq'] = ctx.state.get('seq', 0) + 1
+            await step.enter(ctx)
+            if step.waits: return
+
+            await step.leave(ctx)
+            name = await step.transition(ctx, None)
+        raise RuntimeError(f'Too many steps without user input, last "{name}"')
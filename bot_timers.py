@@ -0,0 +1,321 @@
+import asyncio
+import logging
+import time
+import typing
+
+
+class TimerHandle:
+    """Timer registered in ``TimerWheel``. Use ``cancel()`` to remove it"""
+    __slots__ = ('when', 'callback', 'args', '_slot', '_wheel')
+
+    def __init__(self, wheel: 'TimerWheel', when: int, callback: typing.Callable, args: typing.Tuple):
+        self._wheel = wheel
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self._slot: typing.Optional[typing.Dict['TimerHandle', None]] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.callback is None
+
+    def cancel(self):
+        """Remove timer from wheel. O(1)"""
+        if self._slot is not None:
+            del self._slot[self]
+            self._slot = None
+            self._wheel._count -= 1
+        self.callback = None
+        self.args = None
+
+
+class _Timeout:
+    """Async context manager which cancels current task on timeout and raises ``asyncio.TimeoutError``"""
+    __slots__ = ('_wheel', '_delay', '_task', '_handle', '_expired')
+
+    def __init__(self, wheel: 'TimerWheel', delay: typing.Optional[float]):
+        self._wheel = wheel
+        self._delay = delay
+        self._task = None
+        self._handle = None
+        self._expired = False
+
+    def _expire(self):
+        self._expired = True
+        self._task.cancel()
+
+    async def __aenter__(self):
+        if self._delay is not None:
+            self._task = asyncio.current_task()
+            self._handle = self._wheel.call_later(self._delay, self._expire)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._expired and exc_type is asyncio.CancelledError:
+            if self._task.uncancel() == 0:
+                raise asyncio.TimeoutError from exc_val
+
+
+class TimerWheel:
+    """Shared hierarchical timer wheel for large number of coarse timers (waiter timeouts, delays etc).
+
+    All timers share single event loop timer handle, which is scheduled only while wheel has pending
+    timers. Insert and cancel are O(1), timers expired in the same tick are fired in one batch.
+
+    Wheel has ``levels`` levels of ``2**bits`` slots each. Level 0 slot is ``resolution`` seconds,
+    every next level slot covers the whole previous level. Timers from higher levels are moved
+    to lower ones when wheel time reaches their slot.
+
+    Timers are never fired early, but can be fired up to ``resolution`` seconds late.
+    """
+    log = logging.getLogger('TimerWheel')
+
+    def __init__(self, resolution: float = 0.02, bits: int = 8, levels: int = 4):
+        """Create timer wheel
+
+        :param resolution: length of single tick in seconds
+        :param bits: number of bits in slot index for every level
+        :param levels: number of levels
+        """
+        self.resolution = resolution
+        self.bits = bits
+        self.levels = levels
+        self._mask = (1 << bits) - 1
+        self._wheel: typing.List[typing.List[typing.Dict[TimerHandle, None]]] = \
+            [[{} for _ in range(1 << bits)] for _ in range(levels)]
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._origin = 0.0
+        self._now = 0
+        self._driver: typing.Optional[asyncio.TimerHandle] = None
+        self._count = 0
+
+        self.fired = 0
+        self.batches = 0
+
+    def __len__(self) -> int:
+        """Number of pending timers"""
+        return self._count
+
+    # -----------------------
+    def _ensureLoop(self) -> asyncio.AbstractEventLoop:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # new loop: old timers are useless
+            for level in self._wheel:
+                for slot in level:
+                    for h in list(slot): h.cancel()
+            self._loop = loop
+            self._origin = loop.time()
+            self._now = 0
+            self._driver = None
+            self._count = 0
+        return loop
+
+    def _tickNow(self) -> int:
+        return int((self._loop.time() - self._origin) / self.resolution)
+
+    def _insert(self, h: TimerHandle):
+        when = h.when
+        if when <= self._now: when = self._now + 1
+
+        lvl = 0
+        shift = 0
+        while lvl < self.levels - 1 and (when >> (shift + self.bits)) != (self._now >> (shift + self.bits)):
+            lvl += 1
+            shift += self.bits
+
+        slot = self._wheel[lvl][(when >> shift) & self._mask]
+        slot[h] = None
+        h._slot = slot
+
+    def _schedule(self):
+        if self._driver is None:
+            self._driver = self._loop.call_at(
+                self._origin + (self._now + 1) * self.resolution, self._drive)
+
+    def _drive(self):
+        self._driver = None
+        target = self._tickNow()
+        while self._now < target and self._count:
+            self._now += 1
+            self._advance()
+        if self._count:
+            self._schedule()
+
+    def _advance(self):
+        now = self._now
+        # cascade upper levels from top to bottom
+        for lvl in range(self.levels - 1, 0, -1):
+            shift = self.bits * lvl
+            if now & ((1 << shift) - 1): continue
+            slot = self._wheel[lvl][(now >> shift) & self._mask]
+            if not slot: continue
+            items = list(slot)
+            slot.clear()
+            for h in items:
+                h._slot = None
+                self._insert(h)
+
+        slot = self._wheel[0][now & self._mask]
+        if not slot: return
+        items = list(slot)
+        slot.clear()
+        self.batches += 1
+        for h in items:
+            h._slot = None
+            if h.when > now:
+                self._insert(h)
+                continue
+            cb, args = h.callback, h.args
+            h.callback = h.args = None
+            self._count -= 1
+            self.fired += 1
+            try:
+                cb(*args)
+            except Exception as e:
+                self.log.exception(f'Timer callback error: {e}', exc_info=e)
+
+    # -----------------------
+    def call_later(self, delay: float, callback: typing.Callable, *args) -> TimerHandle:
+        """Call ``callback(*args)`` after ``delay`` seconds. Must be called from running event loop."""
+        self._ensureLoop()
+        # wheel cursor can be behind real time while loop is lagging, so deadline is counted from real time
+        now = self._tickNow()
+        if not self._count:
+            # wheel was idle: skip empty ticks
+            self._now = now
+        # round absolute deadline up, so timer is never fired early
+        when = int((self._loop.time() - self._origin + delay) / self.resolution + 0.999999)
+        h = TimerHandle(self, max(now + 1, when), callback, args)
+        self._insert(h)
+        self._count += 1
+        self._schedule()
+        return h
+
+    def timeout(self, delay: typing.Optional[float]) -> _Timeout:
+        """Async context manager like ``asyncio.timeout()``. ``None`` delay means no timeout.
+
+        Usage::
+
+            async with timers.timeout(5):
+                await event.wait()
+        """
+        return _Timeout(self, delay)
+
+    async def sleep(self, delay: float):
+        """Like ``asyncio.sleep()``, but uses wheel"""
+        loop = self._ensureLoop()
+        fut = loop.create_future()
+        h = self.call_later(delay, _setResult, fut, None)
+        try:
+            await fut
+        finally:
+            h.cancel()
+
+    async def wait_done(self, fut: asyncio.Future, timeout: float) -> bool:
+        """Wait until future or task is done, but no longer than ``timeout`` seconds. Do not cancel ``fut``.
+
+        :return: True if ``fut`` is done
+        """
+        if fut.done(): return True
+        loop = self._ensureLoop()
+        waiter = loop.create_future()
+
+        def _done(_): _setResult(waiter, True)
+
+        fut.add_done_callback(_done)
+        h = self.call_later(timeout, _setResult, waiter, False)
+        try:
+            return await waiter
+        finally:
+            h.cancel()
+            fut.remove_done_callback(_done)
+
+
+def _setResult(fut: asyncio.Future, v):
+    if not fut.done(): fut.set_result(v)
+
+
+timers = TimerWheel()
+"""Timer wheel shared by all library objects"""
+
+
+# ------------------------------------------------------------------------
+# TESTS
+# ------------------------------------------------------------------------
+def _test_TimerWheel():
+    """Timers added while wheel has pending timers and loop is stalled must not fire early"""
+
+    async def _main():
+        loop = asyncio.get_running_loop()
+        fired = loop.create_future()
+        pending = timers.call_later(60, print)
+        await timers.sleep(0.05)
+        # block the loop: wheel cursor stays behind real time
+        time.sleep(1)
+        started = loop.time()
+        timers.call_later(0.5, _setResult, fired, None)
+        await fired
+        elapsed = loop.time() - started
+        pending.cancel()
+        print(f'call_later(0.5) after stall fired in {elapsed:.3f}s')
+        assert elapsed >= 0.5
+
+    asyncio.run(_main())
+
+# _test_TimerWheel()
+
+
+# ------------------------------------------------------------------------
+# BENCHMARK
+# ------------------------------------------------------------------------
+def _bench_TimerWheel(count: int = 100000):
+    """Compare ``count`` pending waiter timeouts registered in wheel and in ``asyncio.wait_for``"""
+
+    async def _wheelWait(ev: asyncio.Event):
+        try:
+            async with timers.timeout(60):
+                await ev.wait()
+        except asyncio.TimeoutError:
+            pass
+
+    async def _asyncioWait(ev: asyncio.Event):
+        try:
+            await asyncio.wait_for(ev.wait(), 60)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(name: str, proc):
+        loop = asyncio.get_running_loop()
+        evs = [asyncio.Event() for _ in range(count)]
+        tm = time.perf_counter()
+        tasks = [asyncio.create_task(proc(ev)) for ev in evs]
+        await asyncio.sleep(0)
+        insert = time.perf_counter() - tm
+
+        # noinspection PyProtectedMember,PyUnresolvedReferences
+        heap = len(loop._scheduled)
+
+        tm = time.perf_counter()
+        for ev in evs: ev.set()
+        await asyncio.gather(*tasks)
+        done = time.perf_counter() - tm
+        print(f'{name:8}: {count} timeouts: register {insert:.3f}s, complete {done:.3f}s, loop timer heap {heap}')
+
+    async def _main():
+        await _run('wheel', _wheelWait)
+        await _run('asyncio', _asyncioWait)
+
+        tm = time.perf_counter()
+        hs = [timers.call_later(60, print) for _ in range(count)]
+        ins = time.perf_counter() - tm
+        tm = time.perf_counter()
+        for h in hs: h.cancel()
+        print(f'raw wheel: insert {ins / count * 1e9:.0f}ns, cancel {(time.perf_counter() - tm) / count * 1e9:.0f}ns per timer')
+
+    asyncio.run(_main())
+
+# _bench_TimerWheel()
@@ -0,0 +1,239 @@
+import collections
+import contextvars
+import heapq
+import itertools
+import json
+import time
+import typing
+
+# ------------------------------------------------------------------------
+# Span
+# ------------------------------------------------------------------------
+class Span:
+    """Single timed operation inside trace.
+
+    :var name: operation name (f.i. 'update.message', 'api.edit_message_text')
+    :var trace_id: id of the trace this span belongs to
+    :var span_id: unique span id
+    :var parent_id: id of parent span or 0 for trace root
+    :var start: start time in nanoseconds (``time.perf_counter_ns``)
+    :var end: end time in nanoseconds or 0 if span is still open
+    :var attrs: user attributes (chat id, message id, etc)
+    """
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start', 'end', 'attrs', '_token', '_tracer')
+
+    def __init__(self, tracer: 'Tracer', name: str, trace_id: int, parent_id: int, attrs: typing.Dict):
+        self._tracer = tracer
+        self._token = None
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = next(tracer._ids)
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.start = time.perf_counter_ns()
+        self.end = 0
+
+    @property
+    def duration(self) -> float:
+        """Span duration in seconds. For open span returns time passed since start"""
+        return ((self.end if self.end else time.perf_counter_ns()) - self.start) / 1e9
+
+    def set(self, **attrs) -> 'Span':
+        """Add attributes to span"""
+        self.attrs.update(attrs)
+        return self
+
+    def finish(self):
+        """Close span and pass it to tracer. Closing already closed span do nothing"""
+        if self.end: return
+        self.end = time.perf_counter_ns()
+        self._tracer._finished(self)
+
+    def asDict(self) -> typing.Dict:
+        return {
+            'name': self.name,
+            'trace': self.trace_id,
+            'span': self.span_id,
+            'parent': self.parent_id,
+            'start': self.start,
+            'end': self.end,
+            'attrs': self.attrs,
+        }
+
+    def __enter__(self):
+        self._token = _currentSpan.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.finish()
+        if self._token is not None:
+            _currentSpan.reset(self._token)
+            self._token = None
+
+
+class _NoSpan:
+    """Span replacement used when tracing is disabled"""
+    trace_id = 0
+    span_id = 0
+
+    def set(self, **attrs): return self
+
+    def finish(self): pass
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb): pass
+
+
+NO_SPAN = _NoSpan()
+
+_currentSpan: contextvars.ContextVar[typing.Optional[Span]] = contextvars.ContextVar('bot_trace_span', default=None)
+
+
+# ------------------------------------------------------------------------
+# Tracer
+# ------------------------------------------------------------------------
+class Tracer:
+    """In-process span collector.
+
+    Finished spans go to ring buffer of ``capacity`` size. All spans of ``keep_slowest`` slowest
+    traces (measured by trace root span) are kept separately and survive ring buffer rotation.
+
+    Span context is stored in ``contextvars`` so it automatically propagates thru ``await``
+    and into tasks created inside span (f.i. logic task started by '/start' command).
+
+    Usage::
+
+        with tracer.span('update.message', chat=chat_id):
+            ...
+        tracer.export_chrome(open('trace.json', 'wt'))
+    """
+    enabled: bool
+
+    def __init__(self, capacity: int = 10000, keep_slowest: int = 20, enabled: bool = False):
+        """Create tracer
+
+        :param capacity: number of last finished spans to hold
+        :param keep_slowest: number of slowest traces to hold
+        :param enabled: if False all spans will be ``NO_SPAN``
+        """
+        self.enabled = enabled
+        self.spans: typing.Deque[Span] = collections.deque(maxlen=capacity)
+        self.keep_slowest = keep_slowest
+        self._ids = itertools.count(1)
+        self._open: typing.Dict[int, typing.List[Span]] = {}
+        self._slowest: typing.List[typing.Tuple[float, int, typing.List[Span]]] = []
+        self._slowestIds: typing.Dict[int, typing.List[Span]] = {}
+
+    def span(self, name: str, **attrs) -> typing.Union[Span, _NoSpan]:
+        """Create new span as child of current one. New trace is started if there is no current span.
+        Must be used as context manager to became current."""
+        if not self.enabled: return NO_SPAN
+        parent = _currentSpan.get()
+        if parent is None:
+            trace_id = next(self._ids)
+            self._open[trace_id] = []
+            return Span(self, name, trace_id, 0, attrs)
+        return Span(self, name, parent.trace_id, parent.span_id, attrs)
+
+    @staticmethod
+    def current() -> typing.Optional[Span]:
+        """Get current span or None"""
+        return _currentSpan.get()
+
+    def resume(self, parent: typing.Optional[Span], name: str, **attrs) -> typing.Optional[Span]:
+        """Open span as child of ``parent`` and make it current for the rest of current task.
+        Used to link logic task continuation to update which wakes it up.
+        Span must be closed by ``suspend()``.
+        """
+        self.suspend()
+        if not self.enabled or parent is None or isinstance(parent, _NoSpan): return None
+        sp = Span(self, name, parent.trace_id, parent.span_id, attrs)
+        _currentSpan.set(sp)
+        return sp
+
+    def suspend(self):
+        """Close span opened by ``resume()`` in current task"""
+        sp = _currentSpan.get()
+        if sp is not None and sp._token is None:
+            sp.finish()
+            _currentSpan.set(None)
+
+    # -----------------------
+    def _finished(self, span: Span):
+        self.spans.append(span)
+
+        slow = self._slowestIds.get(span.trace_id)
+        if slow is not None:
+            slow.append(span)
+            return
+
+        bucket = self._open.get(span.trace_id)
+        if bucket is None: return
+        bucket.append(span)
+        if span.parent_id: return
+
+        # root closed: decide if trace is one of slowest
+        del self._open[span.trace_id]
+        if self.keep_slowest <= 0: return
+        item = (span.duration, span.trace_id, bucket)
+        if len(self._slowest) < self.keep_slowest:
+            heapq.heappush(self._slowest, item)
+        elif item[0] > self._slowest[0][0]:
+            _, old_id, _ = heapq.heapreplace(self._slowest, item)
+            self._slowestIds.pop(old_id, None)
+        else:
+            return
+        self._slowestIds[span.trace_id] = bucket
+
+    def slowest(self) -> typing.List[typing.List[Span]]:
+        """Get span lists for slowest traces, slowest first"""
+        return [spans for _, _, spans in sorted(self._slowest, key=lambda v: v[0], reverse=True)]
+
+    def clear(self):
+        self.spans.clear()
+        self._open.clear()
+        self._slowest.clear()
+        self._slowestIds.clear()
+
+    # -----------------------
+    def export_jsonl(self, fp: typing.TextIO, spans: typing.Iterable[Span] = None) -> int:
+        """Write spans (ring buffer by default) as JSON lines.
+
+        :return: number of spans written
+        """
+        n = 0
+        for sp in (self.spans if spans is None else spans):
+            fp.write(json.dumps(sp.asDict(), default=str))
+            fp.write('\n')
+            n += 1
+        return n
+
+    def export_chrome(self, fp: typing.TextIO, spans: typing.Iterable[Span] = None) -> int:
+        """Write spans (ring buffer by default) in Chrome trace format (chrome://tracing, Perfetto).
+        Every trace is shown as separate thread.
+
+        :return: number of spans written
+        """
+        events = [{
+            'name': sp.name,
+            'ph': 'X',
+            'ts': sp.start / 1000,
+            'dur': (sp.end - sp.start) / 1000,
+            'pid': 1,
+            'tid': sp.trace_id,
+            'args': {k: str(v) for k, v in sp.attrs.items()},
+        } for sp in (self.spans if spans is None else spans)]
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+        return len(events)
+
+
+tracer = Tracer()
+"""Global tracer used by the library. Disabled by default, set ``tracer.enabled = True`` to collect spans"""
+
+
+def span(name: str, **attrs) -> typing.Union[Span, _NoSpan]:
+    """Create span in global tracer"""
+    return tracer.span(name, **attrs)
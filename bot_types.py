@@ -13,8 +13,8 @@ Callback_t = types.CallbackQuery
 
 BotMarkup_t = typing.Union[types.InlineKeyboardMarkup, types.ReplyKeyboardMarkup, types.ReplyKeyboardRemove]
 BotUserKey_t = typing.Union[typing.Tuple[str, typing.Any], str, types.InlineKeyboardButton, types.KeyboardButton]
-BotUserKeyboard_t = typing.List[typing.List[BotUserKey_t]]
-BotMessageTypes_t = typing.Optional[typing.Union['BotIMessage', Message_t, MessageId_t]]
+BotUserKeyboard_t = typing.Union[typing.List[typing.List[BotUserKey_t]], 'KeyboardTemplate']
+BotMessageTypes_t = typing.Optional[typing.Union['BotIMessage', Message_t, 'MessageSnapshot', MessageId_t]]
 
 
 class BotKeyboardResult:
@@ -23,6 +23,7 @@ class BotKeyboardResult:
     :var data: Is set to data for known button or ''
     :var index: Is set to index of known button or -1.
     """
+    __slots__ = ('known', 'data', 'index')
     known: bool
     data: str
     index: int
@@ -35,6 +36,64 @@ class BotKeyboardResult:
 RESULT_NONE = BotKeyboardResult(False)
 """Type used to indicate unknown result"""
 
+
+class UserSnapshot:
+    """Compact copy of message sender"""
+    __slots__ = ('id', 'is_bot', 'first_name', 'last_name', 'username', 'language_code')
+
+    def __init__(self, user: types.User):
+        self.id = user.id
+        self.is_bot = user.is_bot
+        self.first_name = user.first_name
+        self.last_name = user.last_name
+        self.username = user.username
+        self.language_code = user.language_code
+
+    @property
+    def full_name(self) -> str:
+        return f'{self.first_name} {self.last_name}' if self.last_name else self.first_name
+
+    def to_python(self) -> typing.Dict[str, typing.Any]:
+        return {nm: getattr(self, nm) for nm in self.__slots__ if getattr(self, nm) is not None}
+
+
+class MessageSnapshot:
+    """Compact copy of received message with fields used by library and logic: ids, text and sender.
+    Full message object is held only if ``keep`` is set, all other attributes are taken from it.
+
+    :var message: full message object or None
+    """
+    __slots__ = ('message_id', 'chat_id', 'text', 'caption', 'from_user', 'message')
+
+    def __init__(self, message: typing.Optional[Message_t] = None, keep: bool = False):
+        self.message = message if keep else None
+        if message is None:
+            self.message_id = NoMessageId
+            self.chat_id = NoChatId
+            self.text = None
+            self.caption = None
+            self.from_user = None
+            return
+        self.message_id = message.message_id
+        self.chat_id = message.chat.id if message.chat else NoChatId
+        self.text = message.text
+        self.caption = message.caption
+        self.from_user = UserSnapshot(message.from_user) if message.from_user else None
+
+    def __getattr__(self, item):
+        if item == 'message': raise AttributeError(item)
+        if self.message is None:
+            raise AttributeError(f'Message snapshot has no "{item}", use "keepMessages" option to hold full messages')
+        return getattr(self.message, item)
+
+    def to_python(self) -> typing.Dict[str, typing.Any]:
+        if self.message is not None: return self.message.to_python()
+        rc = {'message_id': self.message_id, 'chat': {'id': self.chat_id}}
+        if self.text is not None: rc['text'] = self.text
+        if self.caption is not None: rc['caption'] = self.caption
+        if self.from_user is not None: rc['from'] = self.from_user.to_python()
+        return rc
+
 BotMedia_t = typing.Union[InputFile, io.BytesIO, io.FileIO, str]
 
 # ------------------------------------------------------------------------
@@ -72,6 +131,15 @@ If return is True caller will check message and if its known modal mode will be
 If return is False caller will stop message processing and pass message to the next waiting.    
 """
 
+OnAnswerEvent = typing.Callable[['BotChat', Callback_t],
+                                typing.Awaitable[typing.Union[None, str, typing.Tuple[str, bool]]]]
+"""Called for every callback query right after it is received, before any processing. Used by ``CallbackAnswers``
+
+Must be fast: query is not acknowledged until it returns.
+
+Return text or (text, show_alert) tuple to answer query with it at once, or None to leave answer to the logic.
+"""
+
 OnCommandEvent = typing.Callable[['BotChat', str, str], typing.Awaitable[bool]]
 """Called for process bot commands passed by user using '/command' form. Used by ``CommandsWaiter``
 
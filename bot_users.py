@@ -1,3 +1,5 @@
+import weakref
+
 from bot_types import *
 from settings import *
 
@@ -9,6 +11,7 @@ _USER_SETTINGS = {
 
 class BotUser(ISettings):
     """Class for single user parameters"""
+    __slots__ = ('user_id', '__weakref__')
     user_id: UserId_t
 
     def __init__(self, cfg: ISettings, user_id: UserId_t):
@@ -27,18 +30,68 @@ class BotUser(ISettings):
 
 # -------------------------------------------------------------------
 class BotUsers(typing.Dict[str, typing.Optional[BotUser]]):
-    """List of all users"""
+    """Cache of recently used users.
+
+    Holds at most ``max_size`` users ordered from least to most recently used. All user data is stored in
+    settings, so evicted users are just recreated from settings on next access. Evicted users which are
+    still referenced by someone (f.i. by running logic) are found thru weak references, so there is
+    never more than one ``BotUser`` object for the same user.
+    """
     _cfg: ISettings
 
-    def __init__(self, cfg: ISettings):
+    def __init__(self, cfg: ISettings, max_size: typing.Union[int, typing.Callable[[], int]] = 0):
+        """Create users cache
+
+        :param cfg: settings branch for all users
+        :param max_size: max number of users held in memory, 0 for unlimited. Can be a function
+            to read limit from settings on every check
+        """
         super().__init__()
         self._cfg = cfg
+        self._maxSize = max_size
+        self._weak: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.weak_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_size(self) -> int:
+        """Current limit of users held in memory"""
+        return self._maxSize() if callable(self._maxSize) else self._maxSize
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        """Get users cache metrics"""
+        total = self.hits + self.weak_hits + self.misses
+        return {
+            'resident': len(self),
+            'referenced': len(self._weak),
+            'hits': self.hits,
+            'weak_hits': self.weak_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.weak_hits) / total if total else 0.0,
+            'evictions': self.evictions,
+        }
 
     def user(self, message: Message_t) -> BotUser:
         user_id = message.from_user.id  # let it traps here if something wrong w data
-        user = self.setdefault(user_id, None)
-        if user is None:
-            self[user_id] = BotUser(cfg=self._cfg.sub_cfg(str(user_id)), user_id=user_id)
-            return self[user_id]
+        user = self.pop(user_id, None)
+        if user is not None:
+            self.hits += 1
         else:
-            return user
+            user = self._weak.get(user_id)
+            if user is not None:
+                self.weak_hits += 1
+            else:
+                self.misses += 1
+                user = BotUser(cfg=self._cfg.sub_cfg(str(user_id)), user_id=user_id)
+                self._weak[user_id] = user
+
+        # move to the end as most recently used
+        self[user_id] = user
+        # limit can be lowered at runtime, so cache is shrunk to it at once
+        maxSize = self.max_size
+        while 0 < maxSize < len(self):
+            del self[next(iter(self))]
+            self.evictions += 1
+        return user
@@ -0,0 +1,206 @@
+import asyncio
+import collections
+import ctypes
+import logging
+import sys
+import threading
+import time
+import traceback
+import typing
+
+
+class BlockingLogicError(RuntimeError):
+    """Raised in strict mode inside code which blocks event loop longer than allowed"""
+    pass
+
+
+class StallReport:
+    """Information about single event loop stall
+
+    :var lag: seconds event loop was blocked (or blocked up to detection moment if ``ongoing``)
+    :var task: name of the task was running while loop stalled
+    :var chat_id: id of the chat which code blocks the loop or None if unknown
+    :var logic: name of the logic class for that chat or None
+    :var stack: formatted stack of the blocking code
+    :var ongoing: True if report was made while loop still blocked
+    """
+    __slots__ = ('lag', 'task', 'chat_id', 'logic', 'stack', 'ongoing', 'time')
+
+    def __init__(self, lag: float, task: typing.Optional[str], chat_id, logic: typing.Optional[str],
+                 stack: typing.List[str], ongoing: bool):
+        self.lag = lag
+        self.task = task
+        self.chat_id = chat_id
+        self.logic = logic
+        self.stack = stack
+        self.ongoing = ongoing
+        self.time = time.time()
+
+    def __str__(self):
+        return f'loop blocked for {self.lag:.3f}s in task "{self.task}" chat: {self.chat_id} logic: {self.logic}\n' + \
+               ''.join(self.stack)
+
+
+OnStallEvent = typing.Callable[[StallReport], None]
+"""Called from watchdog thread for every detected stall. Must be fast and thread-safe"""
+
+
+class LoopWatchdog:
+    """Event loop lag watchdog.
+
+    Measures loop lag continuously by small periodic coroutine. Separate daemon thread checks
+    heartbeat of this coroutine and if loop does not respond longer than ``threshold`` it captures the
+    stack of the code which is blocking loop right now and tries to attribute it to the chat
+    and logic (by task name and by ``chat`` / ``self`` locals in the stack).
+
+    In ``strict`` mode ``BlockingLogicError`` will be raised inside blocking code. This is intended
+    ONLY for development since exception can be raised at any point of the blocking code.
+
+    Usage::
+
+        watchdog = LoopWatchdog(threshold=0.2)
+        botSession = BotSession(dp, Logic, watchdog=watchdog)
+        ...
+        print(watchdog.metrics())
+    """
+    log = logging.getLogger('LoopWatchdog')
+
+    def __init__(self, threshold: float = 0.25, interval: float = 0.05, strict: bool = False,
+                 on_stall: typing.Optional[OnStallEvent] = None, history: int = 100):
+        """Create watchdog
+
+        :param threshold: seconds of loop lag which is treated as stall
+        :param interval: heartbeat interval in seconds
+        :param strict: raise ``BlockingLogicError`` inside blocking code
+        :param on_stall: user notification for every stall
+        :param history: number of last stall reports to hold
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.strict = strict
+        self.on_stall = on_stall
+        self.reports: typing.Deque[StallReport] = collections.deque(maxlen=history)
+
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._loopThread: int = 0
+        self._task: typing.Optional[asyncio.Task] = None
+        self._thread: typing.Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._beat = time.monotonic()
+        self._reported = False
+
+        self.ticks = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+        self.stalls = 0
+        self.stalls_by_chat: typing.Dict[typing.Any, int] = collections.Counter()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Start watchdog for current event loop. Must be called from running loop. Can be called many times."""
+        if self.running: return
+        self._loop = asyncio.get_running_loop()
+        self._loopThread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = self._loop.create_task(self._heartbeat(), name='LoopWatchdog')
+        self._thread = threading.Thread(target=self._monitor, name='LoopWatchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop watchdog"""
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        """Get current watchdog metrics"""
+        return {
+            'ticks': self.ticks,
+            'lag_last': self.lag_last,
+            'lag_max': self.lag_max,
+            'lag_avg': self.lag_total / self.ticks if self.ticks else 0.0,
+            'stalls': self.stalls,
+            'stalls_by_chat': dict(self.stalls_by_chat),
+        }
+
+    # -----------------------
+    async def _heartbeat(self):
+        while not self._stop.is_set():
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - start - self.interval)
+            self._beat = now
+
+            self.ticks += 1
+            self.lag_last = lag
+            self.lag_total += lag
+            if lag > self.lag_max: self.lag_max = lag
+
+            if self._reported:
+                # monitor already reported this stall, fix total lag
+                self._reported = False
+                if self.reports: self.reports[-1].lag = lag
+                self.log.warning(f'Event loop was blocked for {lag:.3f}s')
+            elif lag >= self.threshold:
+                # stall was shorter than monitor can detect
+                self._report(lag, ongoing=False)
+
+    def _monitor(self):
+        while not self._stop.wait(self.interval):
+            if self._reported: continue
+            lag = time.monotonic() - self._beat - self.interval
+            if lag >= self.threshold:
+                self._reported = True
+                self._report(lag, ongoing=True)
+                if self.strict:
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                        ctypes.c_ulong(self._loopThread), ctypes.py_object(BlockingLogicError))
+
+    def _report(self, lag: float, ongoing: bool):
+        stack = []
+        chat_id = None
+        logic = None
+        taskName = None
+        try:
+            task = asyncio.current_task(self._loop)
+            if task is not None: taskName = task.get_name()
+
+            frame = sys._current_frames().get(self._loopThread) if ongoing else None
+            if frame is not None:
+                stack = traceback.format_stack(frame)
+                chat_id, logic = self._attribute(frame)
+        except Exception as e:
+            self.log.error(f'Stall inspection error: {e}')
+
+        rep = StallReport(lag, taskName, chat_id, logic, stack, ongoing)
+        self.reports.append(rep)
+        self.stalls += 1
+        self.stalls_by_chat[chat_id] += 1
+        self.log.warning(str(rep))
+        if self.on_stall:
+            try:
+                self.on_stall(rep)
+            except Exception as e:
+                self.log.error(f'on_stall error: {e}')
+
+    @staticmethod
+    def _attribute(frame) -> typing.Tuple[typing.Any, typing.Optional[str]]:
+        """Search stack from innermost frame for ``chat`` or ``self`` object which looks like BotChat"""
+        while frame is not None:
+            for nm in ('chat', 'self'):
+                v = frame.f_locals.get(nm)
+                chat = getattr(v, 'chat', v) if nm == 'self' else v
+                chat_id = getattr(chat, 'chat_id', None)
+                if chat_id is not None:
+                    # do not touch lazy ``logic`` property from this thread
+                    logic = getattr(chat, '_logic', None)
+                    return chat_id, type(logic).__name__ if logic is not None else None
+            frame = frame.f_back
+        return None, None
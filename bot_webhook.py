@@ -0,0 +1,332 @@
+import asyncio
+import collections
+import hmac
+import json
+import logging
+import time
+import typing
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+from bot_lazy import lazyCallback, lazyMessage
+from bot_types import *
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+_MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+
+def updateChatId(data: typing.Dict[str, typing.Any]) -> typing.Optional[ChatId_t]:
+    """Get chat id of raw update without building update object
+
+    :return: chat id or None for updates not bound to chat (inline queries, polls, etc.)
+    """
+    for nm in _MESSAGE_FIELDS:
+        m = data.get(nm)
+        if m: return m['chat']['id']
+    cb = data.get('callback_query')
+    if cb and cb.get('message'): return cb['message']['chat']['id']
+    return None
+
+
+class WebhookServer:
+    """Webhook ingestion endpoint for ``BotSession``. Alternative for ``executor.start_polling()``.
+
+    Request is validated by secret token, update is put to the per-chat queue and request is answered
+    at once, before update processing. Updates of the same chat are processed one by one in order of
+    receiving, different chats are processed in parallel.
+
+    Not more than ``queue_size`` updates can wait for processing. If queue is full, request is answered
+    with 503 status, so Telegram will deliver update later.
+
+    Text messages and callbacks are passed directly to ``BotSession`` as lazy objects (see ``bot_lazy``),
+    all other updates to the dispatcher. With ``dispatch=True`` all updates go through the dispatcher
+    handlers as in polling mode.
+
+    Usage::
+
+        botSession.webhook('https://example.com/bot', secret_token='...', port=8080)
+    """
+    log = logging.getLogger('WebhookServer')
+
+    def __init__(self, session: 'BotSession', /,
+                 url: str = None,
+                 path: str = '/webhook',
+                 secret_token: str = None,
+                 queue_size: int = 10000,
+                 max_connections: int = 40,
+                 dispatch: bool = False):
+        """Create webhook server
+
+        :param session: bot session to process updates
+        :param url: public URL of the endpoint. If set, webhook is registered on startup and removed on shutdown
+        :param path: local path of the endpoint
+        :param secret_token: value of ``X-Telegram-Bot-Api-Secret-Token`` header. Requests without it are rejected
+        :param queue_size: max number of received but not processed updates
+        :param max_connections: max number of simultaneous connections from Telegram to register with webhook
+        :param dispatch: process all updates by dispatcher handlers
+        """
+        self.session = session
+        self.url = url
+        self.path = path
+        self.secret_token = secret_token
+        self.queue_size = queue_size
+        self.max_connections = max_connections
+        self.dispatch = dispatch
+
+        self._chats: typing.Dict[typing.Optional[ChatId_t], typing.Deque] = {}
+        self._idle: typing.Optional[asyncio.Event] = None
+
+        self.pending = 0
+        self.received = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    # -----------------------
+    def app(self, app: web.Application = None) -> web.Application:
+        """Add endpoint to application
+
+        :param app: existing application or None to create new one
+        """
+        if app is None: app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_startup.append(self._onStartup)
+        app.on_shutdown.append(self._onShutdown)
+        return app
+
+    def run(self, host: str = None, port: int = None, **kwargs):
+        """Run server until interrupted. Other parameters are passed to ``aiohttp.web.run_app()``"""
+        web.run_app(self.app(), host=host, port=port, **kwargs)
+
+    async def _onStartup(self, app: web.Application):
+        Dispatcher.set_current(self.session.dispatcher)
+        Bot.set_current(self.session.bot)
+        if self.url:
+            await self.session.bot.set_webhook(
+                self.url, secret_token=self.secret_token, max_connections=self.max_connections)
+            self.log.warning(f'Webhook is set to {self.url}')
+
+    async def _onShutdown(self, app: web.Application):
+        await self.flush()
+        if self.session.journal is not None:
+            await self.session.journal.flush()
+        if self.url:
+            await self.session.bot.delete_webhook()
+
+    async def flush(self):
+        """Wait until all received updates are processed"""
+        while self.pending:
+            if self._idle is None: self._idle = asyncio.Event()
+            self._idle.clear()
+            await self._idle.wait()
+
+    # -----------------------
+    async def handle(self, request: web.Request) -> web.Response:
+        """Endpoint handler: accept update and answer without waiting for its processing"""
+        if self.secret_token and \
+                not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ''), self.secret_token):
+            self.rejected += 1
+            return web.Response(status=401)
+
+        if self.pending >= self.queue_size:
+            self.dropped += 1
+            return web.Response(status=503)
+
+        try:
+            data = json.loads(await request.read())
+        except ValueError:
+            self.rejected += 1
+            return web.Response(status=400)
+
+        self.accept(data)
+        return web.Response()
+
+    def accept(self, data: typing.Dict[str, typing.Any]):
+        """Put raw update to the queue of its chat"""
+        self.received += 1
+        self.pending += 1
+        chat_id = updateChatId(data)
+        q = self._chats.get(chat_id)
+        if q is not None:
+            q.append((time.monotonic(), data))
+            return
+        q = self._chats[chat_id] = collections.deque([(time.monotonic(), data)])
+        asyncio.get_event_loop().create_task(self._chatWorker(chat_id, q), name=f'webhook:{chat_id}')
+
+    async def _chatWorker(self, chat_id: typing.Optional[ChatId_t], q: typing.Deque):
+        try:
+            while q:
+                received, data = q.popleft()
+                lag = time.monotonic() - received
+                self.latency_total += lag
+                if lag > self.latency_max: self.latency_max = lag
+                try:
+                    await self._process(data)
+                except Exception as e:
+                    self.errors += 1
+                    self.log.exception(f'Chat {chat_id}: update processing error', exc_info=e)
+                finally:
+                    self.processed += 1
+                    self.pending -= 1
+        finally:
+            del self._chats[chat_id]
+            if not self.pending and self._idle is not None: self._idle.set()
+
+    async def _process(self, data: typing.Dict[str, typing.Any]):
+        if not self.dispatch:
+            # fast path: objects fields are deserialized only if logic reads them
+            message = data.get('message') or data.get('channel_post')
+            # like text handlers in polling mode, other content goes to dispatcher
+            if message and 'text' in message:
+                return await self.session.process_message(lazyMessage(message))
+            cb = data.get('callback_query')
+            if cb and cb.get('message'):
+                return await self.session.process_callback(lazyCallback(cb))
+        await self.session.dispatcher.process_update(types.Update.to_object(data))
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        """Get current ingestion metrics. Latency is time from request to start of update processing"""
+        return {
+            'pending': self.pending,
+            'chats': len(self._chats),
+            'received': self.received,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'processed': self.processed,
+            'errors': self.errors,
+            'latency_avg': self.latency_total / self.processed if self.processed else 0.0,
+            'latency_max': self.latency_max,
+        }
+
+
+# ------------------------------------------------------------------------
+# BENCHMARK
+# ------------------------------------------------------------------------
+def _bench_Webhook(count: int = 5000, rate: float = 2000, delay: float = 0.05, chats: int = 500,
+                   port: int = 18081):
+    """Compare update delivery through webhook and through aiogram long polling.
+
+    Local fake Telegram produces ``count`` text messages from ``chats`` chats with ``rate`` updates per
+    second. Every network leg between Telegram and bot costs ``delay`` / 2 seconds. Latency is measured
+    from update creation to ``BotSession.OnMessage`` call, the hook stops processing, so no API calls are made.
+    """
+    import aiohttp
+
+    from bot import BotSession
+    from bot_ilogic import ILogic
+
+    token = '123456:BENCH'
+    secret = 'bench-secret'
+
+    def _update(n: int) -> typing.Dict[str, typing.Any]:
+        chat = {'id': n % chats + 1, 'type': 'private', 'first_name': 'User'}
+        return {'update_id': n + 1, 'message': {
+            'message_id': n + 1, 'date': int(time.time()), 'chat': chat,
+            'from': {'id': chat['id'], 'is_bot': False, 'first_name': 'User'}, 'text': f'message {n}'}}
+
+    def _session(bot: Bot, created: typing.Dict[int, float], latency: typing.List[float], done: asyncio.Event):
+        async def _onMessage(chat, message: Message_t) -> bool:
+            latency.append(time.monotonic() - created[message.message_id])
+            if len(latency) == count: done.set()
+            return True
+
+        return BotSession(Dispatcher(bot), ILogic, on_message=_onMessage)
+
+    def _report(name: str, latency: typing.List[float], elapsed: float):
+        latency.sort()
+        print(f'{name:8}: {count / elapsed:7.0f} upd/s, latency avg {sum(latency) / len(latency) * 1000:6.1f}ms, '
+              f'p50 {latency[len(latency) // 2] * 1000:6.1f}ms, p99 {latency[int(len(latency) * 0.99)] * 1000:6.1f}ms')
+
+    async def _produce(emit: typing.Callable[[int], typing.Any], created: typing.Dict[int, float]):
+        started = time.monotonic()
+        for n in range(count):
+            wait = started + n / rate - time.monotonic()
+            if wait > 0: await asyncio.sleep(wait)
+            created[n + 1] = time.monotonic()
+            emit(n)
+
+    async def _webhook():
+        created, latency, done = {}, [], asyncio.Event()
+        session = _session(Bot(token=token), created, latency, done)
+        server = WebhookServer(session, secret_token=secret)
+        runner = web.AppRunner(server.app())
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+
+        # Telegram uses up to ``max_connections`` connections to webhook
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=server.max_connections)) as http:
+            async def _post(n: int):
+                await asyncio.sleep(delay / 2)
+                async with http.post(f'http://127.0.0.1:{port}{server.path}', json=_update(n),
+                                     headers={SECRET_TOKEN_HEADER: secret}) as r:
+                    assert r.status == 200
+
+            started = time.monotonic()
+            await _produce(lambda n: asyncio.ensure_future(_post(n)), created)
+            await done.wait()
+            _report('webhook', latency, time.monotonic() - started)
+        await runner.cleanup()
+
+    async def _polling():
+        from aiogram.bot.api import TelegramAPIServer
+
+        created, latency, done = {}, [], asyncio.Event()
+        updates: typing.List[typing.Dict] = []
+        arrived = asyncio.Event()
+
+        async def _api(request: web.Request) -> web.Response:
+            await asyncio.sleep(delay / 2)
+            if request.match_info['method'].lower() == 'getupdates':
+                form = await request.post()
+                offset = int(form.get('offset') or 0)
+                while updates and updates[0]['update_id'] < offset: updates.pop(0)
+                if not updates:
+                    arrived.clear()
+                    try:
+                        await asyncio.wait_for(arrived.wait(), float(form.get('timeout') or 0))
+                    except asyncio.TimeoutError:
+                        pass
+                rc = updates[:100]
+                await asyncio.sleep(delay / 2)
+                return web.json_response({'ok': True, 'result': rc})
+            return web.json_response({'ok': True, 'result': True})
+
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', _api)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+
+        bot = Bot(token=token, server=TelegramAPIServer.from_base(f'http://127.0.0.1:{port}'))
+        session = _session(bot, created, latency, done)
+
+        @session.dispatcher.message_handler()
+        async def _handler(message: Message_t):
+            await session.process_message(message)
+
+        def _emit(n: int):
+            updates.append(_update(n))
+            arrived.set()
+
+        poll = asyncio.ensure_future(session.dispatcher.start_polling())
+        started = time.monotonic()
+        await _produce(_emit, created)
+        await done.wait()
+        _report('polling', latency, time.monotonic() - started)
+        session.dispatcher.stop_polling()
+        await poll
+        await (await bot.get_session()).close()
+        await runner.cleanup()
+
+    async def _main():
+        await _webhook()
+        await _polling()
+
+    asyncio.run(_main())
+
+# _bench_Webhook()
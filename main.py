@@ -13,7 +13,7 @@ from aiogram.utils.markdown import escape_md
 from bot import BotChat, BotSession
 from bot_ilogic import ILogic
 from bot_imessage import BotIMessage
-from bot_keyboard import KeyboardType
+from bot_keyboard import KeyboardTemplate, KeyboardType
 from bot_types import *
 from utils import readAPIToken
 
@@ -156,7 +156,7 @@ async def logic_MENU_Animation(chat: BotChat, name):
     # answer() can be called JUST AFTER receive, so we need callback less delay in processing
     async def idCB(chat, data: Callback_t) -> bool:
         if data.data.isdigit():
-            await data.answer(f'Stats:\nDev1: {counter}\n,Dev2: {counter1}\n,Dev3: {counter2}')
+            await chat.answer(data, f'Stats:\nDev1: {counter}\n,Dev2: {counter1}\n,Dev3: {counter2}')
         return True
 
     # we can use 'with' operation with any message. On exit it will delete self
@@ -314,6 +314,15 @@ async def logic_ASK(chat: BotChat, name):
     await chat.say(f'reply2: {rc.data}')
 
 
+# keyboards shared by all chats
+CALC_KEYS = KeyboardTemplate([
+    ['close', '<<'],
+    ['1', '2', '3', '4', '5'],
+    ['6', '7', '8', '9', '0'],
+    ['+', '-', '*', '/', '=']
+])
+
+
 async def logic_CALC(chat: BotChat, name):
     await chat.say('We can implement calculator with **callback** processing or in **separate "While"** cycle.',
                    media='data/calc.jpg', )
@@ -330,12 +339,7 @@ async def logic_CALC(chat: BotChat, name):
         f'Try to enter something to calculate',
         keyboard_type=KeyboardType.KEYBOARD,
         placeholder='Enter numbers and signs to calculate',
-        buttons=[
-            ['close', '<<'],
-            ['1', '2', '3', '4', '5'],
-            ['6', '7', '8', '9', '0'],
-            ['+', '-', '*', '/', '=']
-        ])
+        buttons=CALC_KEYS)
     # here we will display accumulated formula, result and error
     totalMsg = await chat.say('\(enter formula\)')
 
@@ -361,7 +365,7 @@ async def logic_CALC(chat: BotChat, name):
             # execute formula
             if len(total):
                 try:
-                    rc = eval(total)
+                    rc = await chat.run_cpu(eval, total)
                     await totalMsg.say(f'Result: {escape_md(rc)}')
                 except Exception as e:
                     await totalMsg.say(f'Calculation error!\nError: {escape_md(e.args[0])}')
@@ -381,13 +385,12 @@ async def logic_CALC(chat: BotChat, name):
         await keysMsg.popup(keysMsg.text, on_message=idMsg)
     else:
         # until 'close' selected or entered from keyboard
-        while True:
-            # get any input
-            await chat.waitmsg()
+        # stream queues input, so fast typing is not lost while result is calculated
+        async for message in chat.messages():
             # remember it
-            rc = chat.last.text
+            rc = message.text
             # del its message
-            await chat.delete()
+            await chat.delete(message)
 
             # do calc
             if rc == 'close':
@@ -395,7 +398,7 @@ async def logic_CALC(chat: BotChat, name):
             elif rc == '=':
                 if len(total):
                     try:
-                        rc = eval(total)
+                        rc = await chat.run_cpu(eval, total)
                         await totalMsg.say(f'Result: {escape_md(rc)}')
                     except Exception as e:
                         await totalMsg.say(f'Calculation error!\nError: {escape_md(e.args[0])}')
@@ -439,6 +442,13 @@ async def TEST(chat: BotChat, name):
     await chat.waitmsg()
 
 
+MAIN_MENU = KeyboardTemplate([
+    [('➡ Menu tests...', 'menu')],
+    [('❓ Some asking', 'ask'), ('✌ Funny one :)', 'wait'), ('🍱', 'calc')],
+    [('❌ Close', 0), ('❌ Cancel', 0), ('❎ Abandon!', 0), ('➰ F* off!!', 0)],
+])
+
+
 class Logic(ILogic):
     async def main(self, chat: BotChat, params: str) -> None:
         chat.user().name = chat.last.from_user.full_name
@@ -459,14 +469,7 @@ class Logic(ILogic):
         )
 
         while True:
-            rc = await chat.menu(
-                'Choose test group to go',
-                [[('➡ Menu tests...', 'menu')],
-                 [('❓ Some asking', 'ask'), ('✌ Funny one :)', 'wait'), ('🍱', 'calc')],
-                 [('❌ Close', 0), ('❌ Cancel', 0), ('❎ Abandon!', 0), ('➰ F* off!!', 0)],
-                 ],
-                remove_unused=True
-            )
+            rc = await chat.menu('Choose test group to go', MAIN_MENU, remove_unused=True)
             if not rc.known: break
             if rc.data == 'menu':
                 await logic_MENU(chat, name)
@@ -503,4 +506,5 @@ async def callback_handler(cbd: types.CallbackQuery):
 # ------------------------------------------------------------------------
 if __name__ == '__main__':
     executor.start_polling(dp, skip_updates=True)
+    # botSession.webhook('https://example.com/bot', port=8080, secret_token='change-me')
     pass
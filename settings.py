@@ -12,6 +12,7 @@ TSettingsOption_t = typing.TypeVar('TSettingsOption_t')
 # ------------------------------------------------------------------------
 class ISettings(typing.Sized):
     """Interface for ``Settings`` class"""
+    __slots__ = ('_cfg',)
     _cfg: 'ISettings'
 
     def __init__(self,cfg:'ISettings'):
@@ -45,6 +46,11 @@ class ISettings(typing.Sized):
         return self._cfg.__next__()
 
 
+class _NoValue:
+    """Marker for "no value" result in ``Settings.opt()``"""
+    pass
+
+
 def newSettings() -> ISettings:
     """Create new settings storage"""
     return Settings()
@@ -63,14 +69,15 @@ class Settings(ISettings):
     def __init__(self, cfg: typing.Optional['Settings'] = None, key_name: str = ''):
         ISettings.__init__(self,cfg)
         self._selfKey = key_name
-        if cfg:
-            self.gopt(key_name, {})
+        if cfg is not None:
+            # create own branch in parent
+            cfg.gopt(key_name, {})
             self._dict = None
         else:
             self._dict = {}
 
     def __len__(self) -> int:
-        if self._cfg:
+        if self._cfg is not None:
             return len(self._cfg)
         else:
             return len(self._dict)
@@ -82,13 +89,13 @@ class Settings(ISettings):
         self.sopt(key, value)
 
     def __iter__(self):
-        if self._cfg:
+        if self._cfg is not None:
             return self._cfg.__iter__()
         else:
             return self._dict.__iter__()
 
     def __next__(self):
-        if self._cfg:
+        if self._cfg is not None:
             return self._cfg.__next__()
         else:
             return self._dict.__next__()
@@ -132,7 +139,7 @@ class Settings(ISettings):
         :return: setting or cfg sub-key branch
         """
         if not path or not path.strip(' \r\n\t\b'): path = ''
-        if self._cfg:
+        if self._cfg is not None:
             return self._cfg.gopt(f'{self._selfKey}.{path}', default)
         else:
             return self.opt(path, default, write_data=False)
@@ -146,7 +153,7 @@ class Settings(ISettings):
         :return: setting value or cfg sub-key branch
         """
         if not path or not path.strip(' \r\n\t\b'): path = ''
-        if self._cfg:
+        if self._cfg is not None:
             return self._cfg.sopt(f'{self._selfKey}.{path}', default)
         else:
             return self.opt(path, default, write_data=True)
@@ -168,7 +175,7 @@ class Settings(ISettings):
         :param path: full path-name of child delimited by '.'
         :return: (SettingsData_t,str) tuple with branch containing specified child and child name
         """
-        if self._cfg:
+        if self._cfg is not None:
             return self._cfg.key_path(f'{self._selfKey}.{path}')
 
         ar = []
@@ -391,10 +398,7 @@ class Settings(ISettings):
         def _is_valid_name(nm: str):
             return len(nm) > 1 and nm[0] == '_' and nm[1].isalpha()
 
-        class __NoValue:
-            pass
-
-        _NoValue = __NoValue()
+        __NoValue = _NoValue
 
         def _getOrUpdate(key, nm, val, is_write_data):
             if val is None:
@@ -78,9 +78,9 @@ Changeable_t = typing.TypeVar('Changeable_t')
 
 
 class Changeable(typing.Generic[Changeable_t]):
+    __slots__ = ('_value', '_old')
     _value: Changeable_t
     _old: Changeable_t
-    changed : bool
 
     def __init__(self, val: Changeable_t) -> None:
         super().__init__()
@@ -118,20 +118,25 @@ class Applicable:
         Usage::
 
         class A(Applicable):
+            # tell Applicable which attributes need to be taken from args
+            _apply_props = ['a', 'b']
             # some class attributes
             a:int
             b:str
 
             def __init__(..):
-                # tell Applicable which attributes need to be taken from args
-                super().__init__(self,['a','b'])
+                super().__init__()
                 self.apply( locals() ) # will set class attributes from parameters
+
+        List of attributes can also be passed to constructor, but it needs instance ``__dict__``.
     """
-    _apply_props: typing.List[str]
+    __slots__ = ()
+    _apply_props: typing.List[str] = []
 
-    def __init__(self, props: typing.List[str]) -> None:
+    def __init__(self, props: typing.Optional[typing.List[str]] = None) -> None:
         super().__init__()
-        self._apply_props = props
+        if props is not None:
+            self._apply_props = props
 
     def apply(self, vals_list) -> None:
         """ Set class attributes from values list.
@@ -158,6 +163,19 @@ def isPrimitive(v) -> bool:
     return v is None or isinstance(v, (int, str, float, complex, tuple, range))
 
 
+_BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def toBase36(v: int) -> str:
+    """Compact text form of integer, f.i. to use in callback data"""
+    if v < 0: return '-' + toBase36(-v)
+    s = ''
+    while True:
+        v, d = divmod(v, 36)
+        s = _BASE36[d] + s
+        if not v: return s
+
+
 def PProps(self, level=0):
     for v in self.__dir__():
         if v.startswith('__'): continue